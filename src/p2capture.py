@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-#
+
+# Copyright 2013, 2014 Weber Yann, Weber Laurent
+#
+# This file is part of pyP2Monitor.
+#
+#        pyP2Monitor is free software: you can redistribute it and/or modify
+#        it under the terms of the GNU General Public License as published by
+#        the Free Software Foundation, either version 3 of the License, or
+#        (at your option) any later version.
+#
+#        pyP2Monitor is distributed in the hope that it will be useful,
+#        but WITHOUT ANY WARRANTY; without even the implied warranty of
+#        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#        GNU General Public License for more details.
+#
+#        You should have received a copy of the GNU General Public License
+#        along with pyP2Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+##@package p2capture Raw frame capture and replay
+#
+# A capture file begins with P2Capture::MAGIC followed by records. Each record
+# is a little endian header (monotonic timestamp as a double, direction byte,
+# 16 bits length) followed by the raw frame bytes.
+#
+# Monotonic timestamps are converted to dates using the last
+# P2Capture::DIR_SYNC record, whose payload is the wall clock time (a double)
+# at the record's monotonic time. A sync record is written each time a
+# capture file is opened.
+#
+
+import os
+import time
+import struct
+import datetime
+import logging
+
+import p2msg
+from p2msg import P2Msg
+
+import p2frame
+from p2frame import P2FrameParser
+
+import utils
+
+##Use to log
+#@see utils.getLogger()
+logger = utils.getLogger()
+
+##Capture file format constants
+# @ingroup lowlevel
+class P2Capture:
+	##Capture file magic string
+	MAGIC = "P2CAP\x01"
+	##Record header format
+	RECORD = struct.Struct('<dBH')
+	##Number of records between two file flushes
+	FLUSH_RECORDS = 32
+	##Sync record payload format
+	SYNC = struct.Struct('<d')
+
+	##Frame received from the furnace
+	DIR_IN	= 0
+	##Frame sent to the furnace
+	DIR_OUT	= 1
+	##Clock synchronisation record
+	DIR_SYNC = 2
+
+##Write frames in a capture file
+# @ingroup lowlevel
+class P2CaptureWriter:
+
+	##Open a capture file
+	#
+	# Records are appended if the file already exists
+	#
+	# @param filename The capture file name
+	def __init__(self, filename):
+		##The capture file
+		self.fd = open(filename, 'ab')
+		##Number of records written since the last flush
+		self.unflushed = 0
+		if self.fd.tell() == 0:
+			self.fd.write(P2Capture.MAGIC)
+		self.write(P2Capture.DIR_SYNC, P2Capture.SYNC.pack(time.time()))
+
+	##Write a record
+	#
+	# @param direction One of P2Capture::DIR_IN, P2Capture::DIR_OUT, P2Capture::DIR_SYNC
+	# @param raw The raw frame
+	def write(self, direction, raw):
+		self.fd.write(P2Capture.RECORD.pack(utils.monotonic(), direction, len(raw)))
+		self.fd.write(raw)
+		self.unflushed += 1
+		if self.unflushed >= P2Capture.FLUSH_RECORDS:
+			self.fd.flush()
+			self.unflushed = 0
+
+	##Flush and close the capture file
+	def close(self):
+		self.fd.close()
+
+##Read records from a capture file
+# @ingroup lowlevel
+class P2CaptureReader:
+
+	##Open a capture file
+	#
+	# @param filename The capture file name
+	#
+	# @exception ValueError If the file is not a capture file
+	def __init__(self, filename):
+		##The capture file
+		self.fd = open(filename, 'rb')
+		if self.fd.read(len(P2Capture.MAGIC)) != P2Capture.MAGIC:
+			raise ValueError("'"+filename+"' is not a capture file")
+		##Wall clock time minus monotonic time, from the last sync record
+		self.clockOffset = None
+
+	##Iterate over frame records
+	#
+	# Sync records are processed and not returned
+	#
+	# @return An iterator of tuples (monotonic time, direction, raw frame)
+	def __iter__(self):
+		hsz = P2Capture.RECORD.size
+		while True:
+			head = self.fd.read(hsz)
+			if len(head) < hsz:
+				if len(head) > 0:
+					logger.warning("Truncated record at the end of the capture file")
+				return
+			(ts, direction, length) = P2Capture.RECORD.unpack(head)
+			raw = self.fd.read(length)
+			if len(raw) < length:
+				logger.warning("Truncated record at the end of the capture file")
+				return
+			if direction == P2Capture.DIR_SYNC:
+				self.clockOffset = P2Capture.SYNC.unpack(raw)[0] - ts
+			else:
+				yield (ts, direction, raw)
+
+	##Return the wall clock time of a record
+	#
+	# @param ts A record's monotonic time
+	# @return A timestamp
+	def wallTime(self, ts):
+		if self.clockOffset == None:
+			return ts
+		return ts + self.clockOffset
+
+	##Close the capture file
+	def close(self):
+		self.fd.close()
+
+
+##Replay a capture through frame parsing and data storage
+#
+# Received frames are parsed again with a p2frame::P2FrameParser and M1
+# frames are stored using p2proto::P2Furn::storeData() as the monitor does.
+# @ingroup comproto
+class P2Replay:
+
+	##Instanciate a new P2Replay
+	#
+	# @param filename The capture file name
+	# @param storObj A list of storages returned by p2proto::P2Furn::openStorage()
+	# @param speed Replay speed relative to real time, 0 means as fast as possible
+	# @param dateFromP2 If True, data dates are taken from M2 frames, else from capture records
+	def __init__(self, filename, storObj, speed = 0, dateFromP2 = False):
+		##The capture reader
+		self.reader = P2CaptureReader(filename)
+		##The storages
+		self.storObj = storObj
+		##Replay speed
+		self.speed = speed
+		##Date source
+		self.dateFromP2 = dateFromP2
+		##Counters (data frames rejected by storages because of their checksum are counted in rejected)
+		self.stats = {'frames' : 0, 'stored' : 0, 'invalid' : 0, 'rejected' : 0}
+
+	##Run the replay
+	#
+	# @return The replay duration in seconds
+	def run(self):
+		import p2proto
+
+		parser = P2FrameParser()
+		curDate = None
+		start = utils.monotonic()
+		first = None
+
+		for (ts, direction, raw) in self.reader:
+			if direction != P2Capture.DIR_IN:
+				continue
+			if first == None:
+				first = ts
+			if self.speed > 0:
+				delay = (ts - first) / self.speed - (utils.monotonic() - start)
+				if delay > 0:
+					time.sleep(delay)
+
+			parser.feed(raw)
+			inMsg = parser.next()
+			if inMsg == None:
+				inMsg = parser.salvage()
+			if inMsg == None:
+				#Incomplete frame captured on a receive error
+				parser.reset()
+				continue
+			self.stats['frames'] += 1
+			if inMsg.failed():
+				self.stats['invalid'] += 1
+
+			header = inMsg.getHeader(P2Msg.FMT_LIST)
+			if header == [0x4D, 0x31] and (curDate != None or not self.dateFromP2):
+				if not self.dateFromP2:
+					curDate = datetime.datetime.fromtimestamp(self.reader.wallTime(ts))
+				p2proto.P2Furn.storeData(self.storObj, curDate, inMsg)
+				#Same test as P2Furn::storeData()
+				if inMsg.check():
+					self.stats['stored'] += 1
+				else:
+					self.stats['rejected'] += 1
+			elif self.dateFromP2 and header == [0x4D, 0x32] and not inMsg.failed():
+				msgData = inMsg.getData(P2Msg.FMT_LIST)
+				curDate = datetime.datetime(msgData[0]+2000,msgData[2],msgData[3],msgData[4],msgData[5],msgData[6])
+
+		self.reader.close()
+		p2proto.P2Furn.closeStorage(self.storObj)
+		res = utils.monotonic() - start
+		logger.info("Replay done in %.3fs : %d frames (%d invalid), %d data stored, %d data rejected" % (res, self.stats['frames'], self.stats['invalid'], self.stats['stored'], self.stats['rejected']))
+		return res
@@ -24,12 +24,25 @@
 #
 
 import sys
-import serial
+import errno
+import select
 import logging
 
 import p2msg
 from p2msg import P2Msg
 
+import p2frame
+from p2frame import P2FrameParser
+
+import p2transport
+from p2transport import P2Transport, P2TransportError
+
+import p2capture
+from p2capture import P2Capture
+
+import p2stats
+from p2stats import P2ComStats
+
 import utils
 
 ##Use to log
@@ -47,6 +60,7 @@ class P2ComError(Exception):
 			11: "Timeout on data size recv",
 			12: "Incomplete or timeout data recv",
 			13: "Incomplete message or checksum or timeout on checksum recv",
+			14: "Link closed",
 			2 : "Invalid checksum",
 			9 : "Global timeout, no frame received"}
 	
@@ -62,6 +76,8 @@ class P2ComError(Exception):
 	ERR_CHKSUM_RECV	= 13
 	##Error code for checksum error
 	ERR_CHKSUM	= 2
+	##Error code for a link closed by the peer
+	ERR_LINK	= 14
 
 	##Instanciate a P2ComError object
 	#
@@ -93,33 +109,79 @@ class P2ComError(Exception):
 	
 
 ##The class managing the communication with the furnace on serial port
+#
+# The bytes are sent and received using a p2transport::P2Transport
 # @ingroup lowlevel
 class P2Com:
 	
 
 	##Instanciate a new P2Com object and open the serial port with the good parameters
 	#
-	#@param portFile The file name of the serial port (/dev/ttyS0 by default)
-	def __init__(self, portFile):
+	#@param portFile The transport URL (a serial port file name like /dev/ttyS0, see p2transport) or a P2Transport object
+	#@param stats A p2stats::P2ComStats to record statistics in, if None a new one is created
+	#@exception P2ComError If the transport can not be opened
+	def __init__(self, portFile, stats = None):
 		##A small timeout
 		#
-		# This small tiemout is used as time between each read retry
+		# This small tiemout is used as time between each read retry when
+		# the serial port cannot be watched with select()
 		self.timeout = 0.01
 		##Read fail timeout
+		#
+		# Maximum time in seconds to wait for a whole frame
 		self.failTimeout = 10
+		##Idle line delay
+		#
+		# When an incomplete frame is buffered and no bytes are received
+		# during this delay, the end of the buffered bytes is taken as the end of a frame
+		self.idleGap = 0.05
+
+		##The transport object
+		if isinstance(portFile, P2Transport):
+			self.ser = portFile
+		else:
+			try:
+				self.ser = p2transport.openTransport(portFile)
+			except P2TransportError as e:
+				logger.error(str(e))
+				raise P2ComError(14)
 
-		##The serial port object
-		#self.ser = serial.Serial(portFile,9600,serial.EIGHTBITS,serial.PARITY_NONE,serial.STOPBITS_ONE,self.timeout,)
-		self.ser = serial.Serial(portFile,9600,serial.EIGHTBITS,serial.PARITY_NONE,serial.STOPBITS_ONE,self.timeout,)
+		##The frame parser storing received bytes between two reads
+		self.parser = P2FrameParser()
+
+		##The transport file descriptor or None if not selectable
+		self.fd = self.ser.fileno()
+		if self.fd == None:
+			logger.info("Serial port file descriptor not available, falling back on polling reads")
+
+		##The p2capture::P2CaptureWriter recording frames or None
+		self.capture = None
+
+		##The p2stats::P2ComStats recording round trip times and errors
+		if stats == None:
+			stats = P2ComStats()
+		self.stats = stats
 
 		##The last char of a sended frame "\r"
 		self.FRAME_END=0x0D;
 		##The last char sended by the furnace in a frame (obsolete and false)
 		self.RECV_END=231;
 	
-	##Return the serial port object
+	##Return the transport object
 	def getCom(self):
 		return self.ser
+
+	##Return the communication statistics
+	#
+	#@return A p2stats::P2ComStats object
+	def getStats(self):
+		return self.stats
+
+	##Record every sent and received frame
+	#
+	#@param capture A p2capture::P2CaptureWriter or None to stop recording
+	def setCapture(self, capture):
+		self.capture = capture
 	
 	##Obsolete function (the checksum is not processed here now)
 	#
@@ -151,6 +213,7 @@ class P2Com:
 	#
 	# @param msg a string representing an hexadecimal number
 	# @return None
+	# @exception P2ComError If the link is closed
 	def write(self,msg):
 		msg_bck = msg
 		checksum = 0
@@ -174,7 +237,11 @@ class P2Com:
 		res.append(self.FRAME_END)
 
 		#Send datas on the serial port
-		self.ser.write(str(bytearray(res)))
+		raw = str(bytearray(res))
+		self.writeRaw(raw)
+		self.stats.requestSent(msg_bck[0:4])
+		if self.capture != None:
+			self.capture.write(P2Capture.DIR_OUT, raw)
 
 		logger.debug("Send '"+msg_bck+"%04X" % checksum+"'")
 		
@@ -184,46 +251,148 @@ class P2Com:
 	#
 	#@param msg a P2Msg object
 	#@return None
+	#@exception P2ComError If the link is closed
 	def sendMsg(self, msg):
-		self.ser.write(msg.getRaw()+"\r")
+		raw = msg.getRaw()+"\r"
+		self.writeRaw(raw)
+		self.stats.requestSent(msg.getHeader(P2Msg.FMT_HEX_STR))
+		if self.capture != None:
+			self.capture.write(P2Capture.DIR_OUT, raw)
 
-		logger.debug("Send '"+msg.getStr()+"'")
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug("Send '"+msg.getStr()+"'")
 		pass
 
+	##Write a precompiled frame to serial port
+	#
+	#@param frame a p2msg::P2ConstFrame object (see p2msg::P2FrameRegistry)
+	#@param timed If False the reply round trip time is not recorded (the reply is not read right after the request)
+	#@return None
+	#@exception P2ComError If the link is closed
+	def sendFrame(self, frame, timed = True):
+		self.writeRaw(frame.wire)
+		self.stats.requestSent(frame.headerHex, timed)
+		if self.capture != None:
+			self.capture.write(P2Capture.DIR_OUT, frame.wire)
+
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug("Send '"+frame.str+"'")
+
+	##Write raw bytes on the serial port
+	#
+	#@param raw A raw string
+	#@exception P2ComError If the link is closed
+	def writeRaw(self, raw):
+		try:
+			self.ser.write(raw)
+		except P2TransportError as e:
+			logger.error(str(e))
+			self.stats.error(14)
+			raise P2ComError(14)
+
 	##Read datas on the serial port
 	#
-	#	Reads datas from the serial port and returns a P2Msg
+	#	Reads datas from the serial port and returns a P2Msg. Received bytes
+	#	are given to P2Com::parser, bytes following the returned frame are
+	#	kept for the next call.
+	#
+	#	The serial port file descriptor is watched with select() until bytes
+	#	arrive or until P2Com::failTimeout seconds are elapsed since the call.
 	#
 	#@exception P2ComError On receive error
 	#@return P2Msg object
 	def read(self):
-		recvBuff = ""
-		res = P2Msg()
-		retry = 0
+		deadline = utils.monotonic() + self.failTimeout
 		
 		logger.debug("Waiting for data on serial port")
 
-		while retry * self.timeout <= self.failTimeout:
-			recvBuff = self.ser.read(1024)
-			if len(recvBuff) > 0:
-				#Frame receive
-				if len(recvBuff) >= 1 and not res.setHeader(recvBuff[0:2]):
-					raise P2ComError(10,res)
-				if len(recvBuff) >= 3 and not res.setDataSz(recvBuff[2:3]):
-					raise P2ComError(11,res)
-				if len(recvBuff) >= 5 and not res.setData(recvBuff[3:-2]):
-					raise P2ComError(12,res)
-				if not res.setChecksum(recvBuff[-2:]):
-					raise P2ComError(13,res)
+		while True:
+			res = self.parser.next()
+			if res != None:
 				logger.debug("Frame received "+res.getStr())
+				self.captureRecv(res)
 				return res
 
-			retry += 1
+			remaining = deadline - utils.monotonic()
+			if remaining <= 0:
+				break
+			if len(self.parser) > 0 and self.fd != None:
+				data = self.recv(min(remaining, self.idleGap))
+				if len(data) == 0:
+					#Idle line, trying to get a frame with an invalid checksum
+					res = self.parser.salvage()
+					if res != None:
+						logger.debug("Frame received on idle line "+res.getStr())
+						self.captureRecv(res)
+						return res
+			else:
+				data = self.recv(remaining)
+			self.parser.feed(data)
+
+		pending = len(self.parser)
+		if pending > 0:
+			#Giving up waiting for the end of the frame
+			res = self.parser.flush()
+			self.captureRecv()
+			if pending < 2:
+				code = 10
+			elif pending < 3:
+				code = 11
+			else:
+				code = 12
+			self.stats.error(code)
+			raise P2ComError(code,res)
+		self.stats.error(9)
 		raise P2ComError(9)
+
+	##Record the last frame returned by P2Com::parser
+	#
+	# Update P2Com::stats and the capture file if capture is enabled
+	#
+	#@param msg The returned P2Msg or None if the frame is incomplete
+	def captureRecv(self, msg = None):
+		if msg != None:
+			self.stats.replyReceived(not msg.failed())
+		if self.capture != None:
+			self.capture.write(P2Capture.DIR_IN, self.parser.lastRaw)
+
+	##Wait for bytes on the serial port and return them
+	#
+	#@param timeout Maximum time to wait in seconds
+	#@return A raw string, empty on timeout
+	#@exception P2ComError If the link is closed
+	def recv(self, timeout):
+		try:
+			if self.fd == None:
+				#Polling read, returns after the transport timeout
+				return self.ser.read(1024)
+
+			try:
+				ready = select.select([self.fd], [], [], timeout)[0]
+			except select.error as e:
+				if e.args[0] == errno.EINTR:
+					return ""
+				raise
+			if len(ready) == 0:
+				return ""
+			return self.ser.read(max(1, self.ser.inWaiting()))
+		except P2TransportError as e:
+			logger.error(str(e))
+			self.stats.error(14)
+			raise P2ComError(14)
+
+	##Return the number of received bytes not yet read
+	#
+	#@return An integer
+	def inWaiting(self):
+		return len(self.parser) + self.ser.inWaiting()
 	
-	##Close the serial port
+	##Close the serial port and the capture file
 	#
 	#@return None
 	def close(self):
 		self.ser.close();
+		if self.capture != None:
+			self.capture.close()
+			self.capture = None
 
@@ -29,19 +29,41 @@ import datetime
 import json
 import logging
 import tempfile
+import binascii
+import bisect
+import copy
+import operator
+from array import array
 
 
 import os, string, tempfile, types, sys, time
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 import p2msg
 import p2dbstore
 import p2data
+import p2schema
+from p2schema import SCHEMA
 import utils
 
 ##Use to log
 #@see utils.getLogger()
 logger = utils.getLogger()
 
+##Number of bytes in the data of a data frame
+DATA_LEN = SCHEMA.dataLen
+
+##Number of rows decoded at once by functions processing a whole result set
+DECODE_BATCH = 4096
+
+##Minimum number of values of a query read from a rollup table
+#@see p2dbstore::P2DbStore::rollupFor()
+ROLLUP_POINTS = 1000
+
 ##Class used to store a range of data in tuples like (time, value)
 #
 # This class is used by pyP2DataReader to store query result.
@@ -61,10 +83,18 @@ class P2Query:
 		self.beg = None
 		##The smaller date and time of the date range. Stored as a timestamp.
 		self.end = None
-		##A dict storing query's data. Keys are timestamp, and value are data
-		self.datas=dict()
+		##Sorted array of the query's data timestamps
+		self.timestamps = array('l')
+		##Array of the query's data values, in the same order than P2Query::timestamps
+		self.values = array('d')
 		##Store the column number
 		self.colNum=int(colNum)
+		##Predicates on values, a list of tuples (operator, value)
+		self.where = []
+		##If not 0, values are aggregated by time slices of group seconds
+		self.group = 0
+		##The aggregate function (avg, min, max, sum or count)
+		self.agg = 'avg'
 		
 		
 		#store the first timestamp
@@ -139,6 +169,78 @@ class P2Query:
 		
 		return secs
 	
+	##Parse a where argument
+	#
+	# A where argument is a list of predicates separated by '&', a predicate
+	# is an operator (<, <=, >, >=, = or !=) followed by a number. Example : ">80&<=90"
+	#
+	#@param where The where argument
+	#@return A list of tuples (operator, value)
+	@staticmethod
+	def parseWhere(where):
+		res = []
+		for pred in where.split('&'):
+			pred = pred.strip()
+			for op in ['<=', '>=', '!=', '<', '>', '=']:
+				if pred.startswith(op):
+					res.append((op, float(pred[len(op):])))
+					break
+			else:
+				logger.critical('Invalid predicate : '+pred)
+				exit(1)
+		return res
+
+	##Return the key of the query's column in the p2fields table
+	def getFieldKey(self):
+		if self.colNum == 0:
+			return 'date'
+		return SCHEMA.fields[self.colNum - 1].key
+
+	##Keep only the values matching P2Query::where predicates
+	def applyWhere(self):
+		ops = {'<' : operator.lt, '<=' : operator.le, '>' : operator.gt, '>=' : operator.ge, '=' : operator.eq, '!=' : operator.ne}
+		timestamps = []
+		values = []
+		for i in range(len(self.timestamps)):
+			ok = True
+			for (op, value) in self.where:
+				if not ops[op](self.values[i], value):
+					ok = False
+					break
+			if ok:
+				timestamps.append(self.timestamps[i])
+				values.append(self.values[i])
+		self.setValues(timestamps, values)
+
+	##Aggregate values by time slices of P2Query::group seconds using P2Query::agg function
+	#
+	# The timestamp of a slice is its begin.
+	def aggregate(self):
+		if self.agg not in ['avg', 'min', 'max', 'sum', 'count']:
+			logger.critical("Unknown aggregate function '"+self.agg+"'")
+			exit(1)
+		timestamps = []
+		values = []
+		slices = []
+		for i in range(len(self.timestamps)):
+			ts = (self.timestamps[i] // self.group) * self.group
+			if len(timestamps) == 0 or timestamps[-1] != ts:
+				timestamps.append(ts)
+				slices.append([])
+			slices[-1].append(self.values[i])
+		for vals in slices:
+			if self.agg == 'avg':
+				values.append(sum(vals) / len(vals))
+			elif self.agg == 'min':
+				values.append(min(vals))
+			elif self.agg == 'max':
+				values.append(max(vals))
+			elif self.agg == 'sum':
+				values.append(sum(vals))
+			else:
+				values.append(len(vals))
+		self.setValues(timestamps, values)
+
 	##Set the data's content of the query object
 	#	Set the content with an array of the form [[timestamp0,val0],[timestamp1,val1], ... ]
 	#	with val the array of value associated with a data
@@ -146,21 +248,65 @@ class P2Query:
 	#@param content An array storing arrays of the form [timestamp,val]
 	#@return True
 	def setContent(self, content):
-		self.datas=dict()
-		for (ts,vals) in content:
-			self.datas[ts] = vals[self.colNum]
-		return True
+		return self.setValues([ts for (ts,vals) in content], [vals[self.colNum] for (ts,vals) in content])
 	
 	
+	##Set the data's content of the query object from a column of values
+	#
+	# When a timestamp appears more than once the last value is kept.
+	#
+	#@param timestamps The timestamps list
+	#@param values The values list, in the same order than timestamps
+	#@return True
+	def setValues(self, timestamps, values):
+		self.timestamps = array('l')
+		self.values = array('d')
+		return self.appendValues(timestamps, values)
+
+	##Add data to the query object
+	#
+	# When a timestamp appears more than once the last value is kept.
+	#
+	#@param timestamps The timestamps list
+	#@param values The values list, in the same order than timestamps
+	#@return True
+	def appendValues(self, timestamps, values):
+		if len(timestamps) == 0:
+			return True
+		ordered = len(self.timestamps) == 0 or timestamps[0] > self.timestamps[-1]
+		for i in range(1, len(timestamps)):
+			if not ordered:
+				break
+			if timestamps[i] <= timestamps[i-1]:
+				ordered = False
+		if not ordered:
+			datas = dict(zip(self.timestamps, self.values))
+			datas.update(zip(timestamps, values))
+			timestamps = sorted(datas.keys())
+			values = [datas[ts] for ts in timestamps]
+			self.timestamps = array('l')
+			self.values = array('d')
+		self.timestamps.extend(timestamps)
+		self.values.extend(values)
+		return True
+
 	##Return a value given a timestamp
 	#
 	#@param timestamp The wanted timestamp
 	#@return An integer value or False if there is no data's associated with this timestamp
 	def getVal(self,timestamp):
-		if timestamp not in self.datas:
-			return False
-		else:
-			return self.datas[timestamp]
+		i = bisect.bisect_left(self.timestamps, timestamp)
+		if i < len(self.timestamps) and self.timestamps[i] == timestamp:
+			return self.values[i]
+		return False
+
+	##Return the sorted timestamps array
+	def getTimestamps(self):
+		return self.timestamps
+
+	##Return the values array
+	def getValues(self):
+		return self.values
 	
 	
 	##Return the first timestamp ( P2Query::beg )
@@ -170,9 +316,21 @@ class P2Query:
 	##Return the last timestamp ( P2Query::end )
 	def getEnd(self):
 		return self.end
+
+	##Return the date range as integers, a missing bound is replaced by the smallest or biggest possible timestamp
+	#
+	#@return A tuple (begin, end)
+	def getBounds(self):
+		beg = self.beg
+		end = self.end
+		if beg == None or beg <= 0:
+			beg = 0
+		if end == None or end <= 0:
+			end = sys.maxint
+		return (int(beg), int(end))
 		
 	def getKeys(self):
-		return self.datas.keys();
+		return list(self.timestamps)
 	
 
 
@@ -183,7 +341,7 @@ class P2Query:
 class P2Datas:
 	
 	##Alias for one letter query parameter to string parameter
-	argsShort = {'b' : 'begin', 'e' : 'end', 't' : 'time', 'f' : 'format', 'd':'data', 'n':'num', 'y':'yaxe', 's':'style', 'c':'color', 'l':'label', 'sc':'scale', 'a':'add' }
+	argsShort = {'b' : 'begin', 'e' : 'end', 't' : 'time', 'f' : 'format', 'd':'data', 'n':'num', 'y':'yaxe', 's':'style', 'c':'color', 'l':'label', 'sc':'scale', 'a':'add', 'w':'where', 'g':'group', 'ag':'agg' }
 	##List of argument that have to be set to None after the P2Query creation
 	argsToNone = ['begin','end','time']
 	
@@ -192,10 +350,14 @@ class P2Datas:
 	#@param dbFile is the sqlite db file
 	#@param queries is a query string array
 	#@param queryArgSep is the separator between two query's argument
-	def __init__(self, dbFile, queries, queryArgSep):
+	#@param busyTimeout The time in seconds sqlite waits for a lock (see p2dbstore::P2DbStore::__init__())
+	#@param useRollups If True not aggregated queries can be read from the rollup tables (see P2Datas::populate())
+	def __init__(self, dbFile, queries, queryArgSep, busyTimeout = None, useRollups = False):
 		
 		##The Sqlite database object
-		self.db = p2dbstore.P2DbStore(dbFile)
+		self.db = p2dbstore.P2DbStore(dbFile, busyTimeout = busyTimeout)
+		##If True not aggregated queries can be read from the rollup tables
+		self.useRollups = useRollups
 		##The query list
 		self.queries = []
 		##The larger range between a begin and a end in seconds
@@ -222,6 +384,12 @@ class P2Datas:
 				print >> sys.stderr, 'Error no data id number specified in query '+query
 			self.queries.append(P2Query(args['format'], args['num'], firstTs, args['begin'],args['end'],args['time']))
 			curq = self.queries[-1:][0]
+			if 'where' in args:
+				curq.where = P2Query.parseWhere(args['where'])
+			if 'group' in args:
+				curq.group = P2Query.fromInterval(args['group'])
+			if 'agg' in args:
+				curq.agg = args['agg']
 			diff = curq.getEnd() - curq.getBeg()
 			if diff > self.maxDiff:
 				self.maxDiff = diff
@@ -258,53 +426,137 @@ class P2Datas:
 	
 	##Fill a query with datas
 	#
-	#@param datas An array of data
+	#@param datas An array of data ordered by date
 	#@param queries An array of query to fill
+	#@see P2Datas::fillQueryBatches()
 	@staticmethod
 	def fillQuery(datas,queries):
-		#format content
-		content = []
-		for data in datas:
-			dataList = p2msg.P2Msg.hex2list(data[1])
-			if len(dataList) != 48:
-				logger.warning('Data as not the waited length ('+str(len(dataList))+' \''+data[1]+'\'')
-			else:
-				dataList = data2List(data[0], dataList )
-				content.append([data[0],dataList])
-			
-		#fill queries
+		P2Datas.fillQueryBatches([datas], queries)
+
+	##Fill queries with batches of datas
+	#
+	# Batches are decoded and routed one after the other, so only one batch
+	# of rows is in memory at a time. Only the columns used by the queries
+	# are decoded, column 0 (the date) is the integer timestamp. Each query
+	# gets the rows that are in its date range.
+	#
+	#@param batches An iterable of arrays of data, ordered by date
+	#@param queries An array of query to fill
+	@staticmethod
+	def fillQueryBatches(batches, queries):
+		#Fields needed by the queries
+		cols = sorted(set([q.colNum for q in queries if q.colNum > 0]))
+		schema = SCHEMA.subset([c - 1 for c in cols])
+
 		for query in queries:
-			query.setContent(content)
+			query.setValues([], [])
+
+		for datas in batches:
+			(timestamps, rows) = hexDecode(datas)
+			columns = dict()
+			if len(cols) > 0 and numpy != None:
+				block = schema.decodeBlock(rows)
+				for i in range(len(cols)):
+					columns[cols[i]] = block[:, i].tolist()
+			elif len(cols) > 0:
+				decoded = [schema.decode(row) for row in rows]
+				for i in range(len(cols)):
+					columns[cols[i]] = [vals[i] for vals in decoded]
+			columns[0] = timestamps
+
+			#route rows to queries
+			for query in queries:
+				(beg, end) = query.getBounds()
+				lo = bisect.bisect_left(timestamps, beg)
+				hi = bisect.bisect_right(timestamps, end)
+				query.appendValues(timestamps[lo:hi], columns[query.colNum][lo:hi])
+
+	##Merge overlapping or adjacent intervals
+	#
+	#@param intervals A list of tuples (begin, end)
+	#@return A sorted list of disjoint intervals
+	@staticmethod
+	def mergeIntervals(intervals):
+		res = []
+		for (beg, end) in sorted(intervals):
+			if len(res) > 0 and beg <= res[-1][1] + 1:
+				if end > res[-1][1]:
+					res[-1] = (res[-1][0], end)
+			else:
+				res.append((beg, end))
+		return res
 	
 	##Trigger the queries filling with data from the database
 	#
 	# When called this function tells to the P2Datas object to get datas from the database and to fill its handled P2Query object.
-	def populate(self):
-		
-		if self.sameRange:
-			#Get th data
-			datas = self.db.getData(self.queries[0].getBeg(),self.queries[0].getEnd())
-			P2Datas.fillQuery(datas,self.queries)
+	# The union of the queries' date ranges is read with a single ordered
+	# scan and each row is routed to every query whose range contains it.
+	#
+	#@param batchSize The number of rows read and decoded at once
+	#
+	# When the database has complete rollup tables (see
+	# p2dbstore::P2DbStore::fillRollups()) aggregated queries without
+	# predicates are read from a table whose slices divide the query's ones.
+	# The groups only partially in the query's dates range are computed from
+	# the stored datas, like queries without rollups, so the results are
+	# the same. With P2Datas::useRollups the other queries without predicates
+	# and with more than ROLLUP_POINTS stored datas are also read from the
+	# coarsest rollup table still giving ROLLUP_POINTS values over the stored
+	# datas : a value is then the mean of a slice, not a stored data.
+	#
+	# When the database has a complete p2fields table (see
+	# p2dbstore::P2DbStore::fillFields()) the other queries are run by sqlite
+	# on it, with their predicates and aggregation.
+	def populate(self, batchSize = DECODE_BATCH):
+		queries = []
+		#Tuples (query, edge query) of groups partially in the query's range
+		edges = []
+		rollups = self.db.rollupsComplete()
+		for q in self.queries:
+			(beg, end) = q.getBounds()
+			length = 0
+			if rollups and q.colNum > 0 and len(q.where) == 0 and (q.group > 0 or self.useRollups):
+				length = self.db.rollupFor(beg, end, ROLLUP_POINTS, q.group)
+			if length > 0 and q.group > 0:
+				#groups entirely in the range
+				inBeg = ((beg + q.group - 1) // q.group) * q.group
+				inEnd = ((end + 1) // q.group) * q.group - 1
+				if inBeg > inEnd:
+					length = 0
+			if length == 0:
+				queries.append(q)
+			elif q.group > 0:
+				rows = self.db.queryRollup(q.getFieldKey(), length, inBeg, inEnd, q.group, q.agg)
+				q.setValues([r[0] for r in rows], [r[1] for r in rows])
+				for (edgeBeg, edgeEnd) in [(beg, inBeg - 1), (inEnd + 1, end)]:
+					if edgeBeg <= edgeEnd:
+						edge = copy.copy(q)
+						edge.beg = edgeBeg
+						edge.end = edgeEnd
+						edges.append((q, edge))
+						queries.append(edge)
+			else:
+				rows = self.db.queryRollup(q.getFieldKey(), length, beg, end, q.group, q.agg)
+				q.setValues([r[0] for r in rows], [r[1] for r in rows])
+		if len(queries) == 0:
+			return
+
+		if self.db.fieldsComplete():
+			for q in queries:
+				(beg, end) = q.getBounds()
+				rows = self.db.queryFields(q.getFieldKey(), beg, end, q.where, q.group, q.agg)
+				q.setValues([r[0] for r in rows], [r[1] for r in rows])
 		else:
-			filled = []
-			"""The goal is to look for queries with same begin and end
-			to make only one db query per group"""
-			for i in range(len(self.queries)):
-				if i not in filled:
-					tofill=[i]
-					#Look for same range
-					for j in range(i,len(self.queries)):
-						if self.queries[j].getBeg() == self.queries[i].getBeg() and self.queries[j].getEnd() == self.queries[i].getEnd():
-							tofill.append(i)
-					#Fill the group
-					filled += tofill
-					datas = self.db.getData(self.queries[i].getBeg(),self.queries[i].getEnd())
-					tmp = tofill
-					tofill = []
-					for t in tmp:
-						tofill.append(self.queries[t])
-					P2Datas.fillQuery(datas, tofill)
-		pass
+			intervals = P2Datas.mergeIntervals([q.getBounds() for q in queries])
+			P2Datas.fillQueryBatches(self.db.iterDataIntervals(intervals, batchSize), queries)
+			for q in queries:
+				if len(q.where) > 0:
+					q.applyWhere()
+				if q.group > 0:
+					q.aggregate()
+
+		for (q, edge) in edges:
+			q.appendValues(edge.getTimestamps(), edge.getValues())
 			
 			
 	##Write GnuPlot's datas temporary file
@@ -324,18 +576,43 @@ class P2Datas:
 				self.tmpfile.append(tempfile.NamedTemporaryFile('w+b',-1,'pyP2gnuplotdatas'))
 			tmpfd=self.tmpfile
 		
-		#Creating a dataSet foreach query
-		
-				
-		#Formating datas from P2Query
-		datasRes = []
-		
+		#Alignment of the queries : rows are offsets from each query's begin
+		#(or timestamps if every query has the same range)
+		nq = len(self.queries)
+		bases = []
+		scales = []
+		adds = []
+		for i in range(nq):
+			args = self.qArgs[i] #The query args
+			if self.sameRange:
+				bases.append(0)
+			else:
+				bases.append(self.queries[i].getBeg())
+			#Retrieving scale and correction
+			if 'add' in args:
+				adds.append(float(args['add']))
+			else:
+				adds.append(0.0)
+			if 'scale' in args:
+				scales.append(float(args['scale']))
+			else:
+				scales.append(1.0)
+
 		#Processing optimisation if same range
 		if self.sameRange:
-			trange = sorted(self.queries[0].getKeys())
+			trange = self.queries[0].getKeys()
 		else:
-			trange = range(0,self.maxDiff)
-		
+			#Union of the offsets of every query in [0, maxDiff[
+			offsets = set()
+			for i in range(nq):
+				tss = self.queries[i].getTimestamps()
+				lo = bisect.bisect_left(tss, bases[i])
+				hi = bisect.bisect_left(tss, bases[i] + self.maxDiff)
+				offsets.update([ts - bases[i] for ts in tss[lo:hi]])
+			trange = sorted(offsets)
+
+		#Merge join : one cursor per query, moving forward only
+		cursors = [0] * nq
 		for t in trange:
 			
 			#vars for csv output
@@ -343,43 +620,33 @@ class P2Datas:
 			okData = False
 			
 			#Then put data
-			for i in range(len(self.queries)):
-				
-				query = self.queries[i] #the query
-				args = self.qArgs[i] #The query args
-				
-				ts = t
-				if not self.sameRange:
-					ts = ts + query.getBeg()
-				ts = int(ts)
-				
-				#Retrieving scale and correction
-				if 'add' in args:
-					add = args['add']
-				else:
-					add=0
-				if 'scale' in args:
-					scale = args['scale']
-				else:
-					scale = 1
-				val = query.getVal(ts)
+			for i in range(nq):
+				tss = self.queries[i].getTimestamps()
+				ts = int(t + bases[i])
+				cur = cursors[i]
+				while cur < len(tss) and tss[cur] < ts:
+					cur += 1
+				cursors[i] = cur
 				
-				
-				if val is not False:
+				if cur < len(tss) and tss[cur] == ts:
+					val = str(self.queries[i].getValues()[cur]*scales[i]+adds[i])
 					if csv:
 						#csv formating
 						okData = True
-						dataBuff+=sep+str(float(val)*float(scale)+float(add))
+						dataBuff+=sep+val
 					else:
 						#gnuplot formating
-						tmpfd[i].write(str(ts)+' '+str(float(val)*float(scale)+float(add))+'\n')
-						tmpfd[i].flush()
+						tmpfd[i].write(str(ts)+' '+val+'\n')
 				elif csv:
 					dataBuff+=sep
 						
 			if csv and okData:
 				#csv line output
 				outfd.write(str(ts)+dataBuff+'\n');
+
+		if not csv:
+			for fd in tmpfd:
+				fd.flush()
 		pass
 	
 	##Return the GnuPlot's plot command with the good arguments
@@ -468,42 +735,18 @@ class P2Datas:
 
 ##Take data and return a well formated integer array
 #
-# Take a string representing a huge hexadecimal number (the data field of a data frame from the furnace)
-# and format it as an integer array applying number correction on some fields
+# Take the data field of a data frame from the furnace and decode it using
+# p2schema::SCHEMA
 #
 #@param timestamp The timestamp to associate with this datas
-#@param data The datas
+#@param data The datas as a bytearray, a raw string or an integer list
 #@param dateFormat The date's display format
 #@return An integer array (except for the first item wich is a date as a string)
 def data2List(timestamp, data, dateFormat="%Y/%m/%d_%H:%M:%S"):
-	res = []
 	date = datetime.datetime.fromtimestamp(float(timestamp))
-
-	#Adding timestamp
-	res.append(date.strftime(dateFormat))
-	#Adding datas
-	"""
-	for d in data:
-		res.append(d)
-	"""
-	for i in range(0,len(data),2):
-		res.append(data[i]*0x100+data[i+1])
-	#Applying number corrections on datas
-	res[5] /= 2.0
-	res[12] /= 10.0
-	res[14] *= 0.0029
-	res[15] /= 2.0
-	
-	if res[16] & 0x8000 != 0:
-		#negative temperature
-		res[16] = res[16] - ( 1 << 16 ) #twos complement on 16 bits
-	res[16] /= 2.0
-		
-	res[17] /= 2.0
-	res[18] /= 2.0
-	res[24] /= 2.0
-	
-	return res
+	if type(data) is list:
+		data = bytearray(data)
+	return [date.strftime(dateFormat)] + SCHEMA.decode(data)
 
 
 ##Return an array with data column's name
@@ -511,48 +754,18 @@ def data2List(timestamp, data, dateFormat="%Y/%m/%d_%H:%M:%S"):
 # Return an array with P2 furnace data's column's name.
 #
 #@see data2List
+#@see p2schema::FIELDS
 def colNames():
-	res = []
-	
-	res.append("Date et heure")
-	res.append("a")
-	res.append("Etat")
-	res.append("c")
-	res.append("d")
-	res.append("Temp chaudiere")
-	res.append("Temp fumee")
-	res.append("Temp gaz brules")
-	res.append("Puissance momentanee")
-	res.append("Ventil. depart")
-	res.append("Ventil. air combustion")
-	res.append("Alimentation")
-	res.append("O2 residuel")
-	res.append("Regulation O2")
-	res.append("Pellets restants (kg)")
-	res.append("o")
-	res.append("Temp exterieur")
-	res.append("Temp consigne depart 1")
-	res.append("Temp depart 1")
-	res.append("s")
-	res.append("t")
-	res.append("Demarages")
-	res.append("Duree fonctionnement (h)")
-	res.append("Temp tableau")
-	res.append("Consigne temp chaudiere")
-	res.append("y")
-	res.append("z")
-
-	return res
+	return ["Date et heure"] + SCHEMA.names()
 
 ##Return a json string from datas (OBSOLETE)
 def datas2Json(datas):
 
 	res = [colNames()]
 
-	for data in datas:
-		dataList = p2msg.P2Msg.hex2list(data[1])
-		if len(dataList) == 48:
-			res.append(data2List(data[0], dataList ))
+	(timestamps, rows) = hexDecode(datas, False)
+	for i in range(len(timestamps)):
+		res.append(data2List(timestamps[i], rows[i]))
 	
 	return json.dumps(res)
 
@@ -560,12 +773,13 @@ def datas2Json(datas):
 #
 # @param filename The filename to write csv in. If - output to stdout
 # @param headers If true put a header with colnames
+# @param busyTimeout The time in seconds sqlite waits for a lock (see p2dbstore::P2DbStore::__init__())
 #
 # @return a string representing the db dump in csv format
 
-def csvDump(dbname, filename = '-', header = True, sep="; "):
+def csvDump(dbname, filename = '-', header = True, sep="; ", busyTimeout = None):
 	
-	db = p2dbstore.P2DbStore(dbname)
+	db = p2dbstore.P2DbStore(dbname, busyTimeout = busyTimeout)
 	
 	fd = None
 	
@@ -585,8 +799,9 @@ def csvDump(dbname, filename = '-', header = True, sep="; "):
 	
 	datas = db.getLastData() #fetch all datas
 	
-	for (timestamp,data) in datas:
-		csvOutputData(fdout, timestamp, data, sep)
+	for i in range(0, len(datas), DECODE_BATCH):
+		(timestamps, rows) = hexDecode(datas[i:i+DECODE_BATCH], False)
+		csvOutputRows(fdout, timestamps, rows, sep)
 
 ##Print the last data on stdout formated in csv
 #
@@ -617,17 +832,80 @@ def csvLastDataDump(lfname, sep = ";"):
 # @param data The datas
 # @param sep The csv separator
 def csvOutputData(fdout, timestamp, data, sep):
-	dataList = p2msg.P2Msg.hex2list(data)
-		
-	if len(dataList) != 48:
-		#bad len
-		logger.warning("Bad data length "+str(len(dataList))+" : '"+(str(timestamp)+" "+data)+"'")
-	else:
-		dataNums = data2List(timestamp, dataList)
-		for i in range(len(dataNums)):
-			fdout.write(str(dataNums[i]))
-			if i < len(dataNums)-1:
-				fdout.write(sep)
-		fdout.write("\n")
-	
+	(timestamps, rows) = hexDecode([(timestamp, data)], False)
+	csvOutputRows(fdout, timestamps, rows, sep)
 
+##Output decoded datas in csv format
+#
+# @param fdout The file where we will write the data
+# @param timestamps The datas timestamps
+# @param rows The datas as returned by hexDecode()
+# @param sep The csv separator
+def csvOutputRows(fdout, timestamps, rows, sep):
+	for i in range(len(timestamps)):
+		dataNums = data2List(timestamps[i], rows[i])
+		fdout.write(sep.join([str(v) for v in dataNums])+"\n")
+
+##Decode a whole result set of datas at once
+#
+# Datas are stored either as hexadecimal text or as binary blobs (see
+# p2dbstore::P2DbStore), both can be mixed in a result set. Consecutive
+# hexadecimal rows are joined and decoded with a single binascii.unhexlify()
+# call, blobs are used as they are. Rows with a bad length or invalid
+# hexadecimal digits are dropped with a warning.
+#
+# @param datas An iterable of rows (timestamp, hexadecimal data or blob)
+# @param asArray If True and NumPy is available the datas are returned as a (rows, DATA_LEN) uint8 numpy array
+# @return A tuple (timestamps list, datas) with datas a list of bytearray or a numpy array
+def hexDecode(datas, asArray = True):
+	timestamps = []
+	parts = []
+	hexTs = []
+	hexs = []
+	for (timestamp, data) in datas:
+		if isinstance(data, basestring):
+			if len(data) != DATA_LEN * 2:
+				logger.warning("Bad data length "+str(len(data) / 2)+" : '"+(str(timestamp)+" "+data)+"'")
+			else:
+				hexTs.append(timestamp)
+				hexs.append(data)
+		elif len(data) != DATA_LEN:
+			logger.warning("Bad data length "+str(len(data))+" : '"+(str(timestamp)+" "+binascii.hexlify(data))+"'")
+		else:
+			if len(hexs) > 0:
+				unhexRows(hexTs, hexs, timestamps, parts)
+				hexTs = []
+				hexs = []
+			timestamps.append(timestamp)
+			parts.append(str(data))
+	if len(hexs) > 0:
+		unhexRows(hexTs, hexs, timestamps, parts)
+	raw = "".join(parts)
+
+	if asArray and numpy != None:
+		return (timestamps, numpy.frombuffer(raw, dtype=numpy.uint8).reshape(len(timestamps), DATA_LEN))
+
+	buf = bytearray(raw)
+	rows = []
+	for i in range(0, len(buf), DATA_LEN):
+		rows.append(buf[i:i+DATA_LEN])
+	return (timestamps, rows)
+
+##Decode hexadecimal rows and append them to decoded datas
+#
+# @param hexTs The rows timestamps
+# @param hexs The rows hexadecimal datas
+# @param timestamps The timestamps list where valid rows timestamps are appended
+# @param parts The list where decoded datas are appended
+def unhexRows(hexTs, hexs, timestamps, parts):
+	try:
+		parts.append(binascii.unhexlify("".join(hexs)))
+		timestamps += hexTs
+	except (TypeError, binascii.Error):
+		#Invalid digits somewhere, decoding row by row to find them
+		for i in range(len(hexs)):
+			try:
+				parts.append(binascii.unhexlify(hexs[i]))
+				timestamps.append(hexTs[i])
+			except (TypeError, binascii.Error):
+				logger.warning("Invalid hexadecimal data : '"+str(hexTs[i])+" "+hexs[i]+"'")
@@ -20,10 +20,23 @@
 
 ##@package p2dbstore Define the P2DbStore object, used to store P2's datas in a database
 
+import sys
 import sqlite3
+import struct
+import time
+import binascii
 import logging
 import utils
 
+import p2schema
+from p2schema import SCHEMA
+
+import p2spool
+from p2spool import P2Spool
+
+import p2partition
+from p2partition import P2Partitions
+
 ##Use to log
 #@see utils.getLogger()
 logger = utils.getLogger()
@@ -33,59 +46,1091 @@ logger = utils.getLogger()
 class P2DbStore:
 
 	INSERTBUFFSZ = 60
+	##Default number of rows fetched at once when iterating over datas
+	FETCH_BATCH = 4096
+	##Number of rows copied by a migration step
+	MIGRATE_CHUNK = 5000
+	##Number of spooled rows inserted after a successful commit
+	SPOOL_BATCH = 5000
+
+	##Schema migrations, in order
+	#
+	# Migration n (starting at 1) is the method named MIGRATIONS[n-1], the
+	# database schema version is stored in the sqlite user_version pragma.
+	# A migration's method is run in a transaction and can leave work to do
+	# in chunks with P2DbStore::migrateStep().
+	MIGRATIONS = ['migrateDateIndex', 'migrateMeta']
+
+	##Length of a day in the p2days table, in seconds
+	DAY = 86400
+	##Maximum number of partition databases attached at once
+	ATTACH_MAX = 8
+	##Rollup tables time slices lengths in seconds, from the finest
+	ROLLUPS = [60, 3600]
+
+	##Valid values of the synchronous pragma
+	SYNCHRONOUS = ['off', 'normal', 'full']
+
+	##Default time in seconds sqlite waits for a lock before failing (busy timeout)
+	BUSY_TIMEOUT = 1.0
+	##First delay in seconds before retrying a request failed because of a lock
+	BACKOFF_MIN = 0.05
+	##Maximum delay in seconds before retrying a request failed because of a lock
+	BACKOFF_MAX = 5.0
 
 	##Create the Database object
 	#
 	#@param filename The Sqlite file name
-	def __init__(self, filename="p2.db"):
+	#@param blob If True datas are stored as binary blobs instead of hexadecimal text
+	#@param fields If True decoded fields are also stored in the p2fields table (always done if the table exists)
+	#@param commitRows If not 0, inserted datas are commited when this number of rows is buffered
+	#@param commitInterval If not 0, inserted datas are commited when the first buffered row is older than this number of seconds
+	#@param wal If True the database journal mode is set to WAL
+	#@param synchronous If not None, the synchronous pragma value : "off", "normal" or "full"
+	#@param busyTimeout The time in seconds sqlite waits for a lock before failing, if None P2DbStore::BUSY_TIMEOUT
+	#@param spool If not None, the spool file name where datas that can not be commited are saved (see P2DbStore::flush())
+	#@param spoolQuota The spool file size limit in bytes
+	#@param partition If not None, new datas are stored in a database file per period : "day", "month" or "year" (see p2partition)
+	#@param rollups If True the rollup tables are maintained (always done if the tables exist, never for partitioned databases)
+	#
+	#@note With commitRows and commitInterval set to 0 each data is commited when inserted
+	#@note Once partitioned a database is always opened as partitioned
+	#@see P2DbStore::flush()
+	#
+	#@exception ValueError On invalid synchronous value or partition period
+	def __init__(self, filename="p2.db", blob = False, fields = False, commitRows = 0, commitInterval = 0, wal = False, synchronous = None, busyTimeout = None, spool = None, spoolQuota = P2Spool.QUOTA, partition = None, rollups = False):
+		if synchronous != None and synchronous.lower() not in P2DbStore.SYNCHRONOUS:
+			raise ValueError("Invalid synchronous value '"+synchronous+"', expected one of "+', '.join(P2DbStore.SYNCHRONOUS))
+		if busyTimeout == None:
+			busyTimeout = P2DbStore.BUSY_TIMEOUT
 		
+		##The database file name
+		self.filename = filename
 		##The database connection
 		#self.conn = sqlite3.connect(filename, 5)
-		self.conn = sqlite3.connect(filename, 1, 0, None)
+		self.conn = sqlite3.connect(filename, busyTimeout, 0, None)
 		##The database cursor
 		self.c = self.conn.cursor()
+
+		##Lock counters
+		#
+		# waits : number of retries after a lock, waitTime : seconds slept
+		# before retrying, busyTime : seconds spent in failed requests (busy
+		# timeout), failedCommits : number of failed commits of inserted datas,
+		# lost : number of inserted datas lost, spooled : number of inserted datas
+		# saved in the spool file
+		self.lockStats = {'waits' : 0, 'waitTime' : 0.0, 'busyTime' : 0.0, 'failedCommits' : 0, 'lost' : 0, 'spooled' : 0}
+
+		##The spool of datas not commited, None if not used
+		self.spool = None
+		if spool != None:
+			self.spool = P2Spool(spool, spoolQuota)
+		##True if the spool file was emptied but the position reset not commited
+		self.spoolPosStale = False
 		
 		self.insertBuff = []
+		##Monotonic time of the first buffered row
+		self.buffTime = None
+		##Number of rows triggering a commit
+		self.commitRows = commitRows
+		##Number of seconds triggering a commit
+		self.commitInterval = commitInterval
+		##Number of rows buffered when the last commit was due
+		self.groupRows = 0
+		##True if the last commit failed
+		self.flushFailed = False
+
+		##Payload storage mode
+		self.blob = blob
+		##True if decoded fields are stored in the p2fields table
+		self.fields = False
+
+		##The table or sub-query to read datas from
+		self.dataTable = 'p2data'
+		##True while rows are left in p2data_v0 by the migration 1
+		self.migrating = False
+		##True if the p2meta and p2days tables are maintained
+		self.meta = False
+		##True while the metadata of the datas stored before the migration 2 are not all counted
+		self.metaFilling = False
+		##True if the rollup tables are maintained
+		self.rollups = False
+		##The partition files, None if the database is not partitioned
+		self.partitions = None
+		##Attached partition databases, keys are file names and values are schema names
+		self.attached = dict()
+		##Number of partition databases attached since the opening
+		self.attachNum = 0
 		
-		locked = True
-		while locked:
-			try:
-				##Database initialisation
-				self.c.execute('create table if not exists p2data (date integer, data collate binary)')
-				#self.conn.commit()
-				locked = False
-			except sqlite3.OperationalError:
-				locked = True
-				logger.warning("Database opening failed, database locked")
+		try:
+			self.retry(self.initDb, "Database opening", wal, synchronous, fields, rollups)
+		except sqlite3.OperationalError as e:
+			if 'readonly' not in str(e):
+				raise
+			logger.warning("Read only database, schema migrations not applied")
+			self.checkMigrating()
+			self.checkTables()
+		self.retry(self.initPartitions, "Database opening", partition)
+		if self.partitions != None and self.rollups:
+			logger.warning("Rollup tables are not maintained in partitioned databases")
+			self.rollups = False
+		if self.spool != None and self.getSpoolPos() > self.spool.size():
+			#Spool file emptied but position not reset before a crash
+			self.retry(self.transaction, "Database opening", 'insert into p2spool values (?)', [(0,)], 'immediate', 'delete from p2spool')
 		
 		pass
 
+	##Read or store the partition period
+	#
+	#@param partition The partition period or None
+	#
+	#@exception ValueError If the database is partitioned with another period
+	def initPartitions(self, partition):
+		period = None
+		if self.tableExists('p2partition'):
+			period = self.c.execute('select period from p2partition').fetchone()[0]
+		if partition != None and period == None:
+			P2Partitions(self.filename, partition) #check the period
+			self.transaction('insert into p2partition values (?)', [(partition,)], 'immediate', 'create table if not exists p2partition (period text)')
+			period = partition
+		elif partition != None and partition != period:
+			raise ValueError("Database partitioned by "+period+", not by "+partition)
+		if period != None:
+			self.partitions = P2Partitions(self.filename, period)
+
+	##Attach a partition database
+	#
+	# When ATTACH_MAX databases are attached, they are detached first.
+	#
+	#@param filename The partition file name
+	#@param create If True the partition tables are created
+	#@return The schema name of the attached database
+	def attach(self, filename, create = False):
+		if filename in self.attached:
+			return self.attached[filename]
+		if len(self.attached) >= P2DbStore.ATTACH_MAX:
+			self.detachAll()
+		alias = 'part'+str(self.attachNum)
+		self.attachNum += 1
+		self.retry(self.c.execute, "Partition attaching", 'attach database ? as '+alias, (filename,))
+		self.attached[filename] = alias
+		if create:
+			self.retry(self.initPartition, "Partition creation", alias)
+		return alias
+
+	##Detach the attached partition databases
+	#
+	# Databases still read by a cursor are left attached.
+	def detachAll(self):
+		for (filename, alias) in self.attached.items():
+			try:
+				self.c.execute('detach database '+alias)
+				del self.attached[filename]
+			except sqlite3.OperationalError as e:
+				logger.debug("Partition '"+filename+"' not detached : "+str(e))
+
+	##Create the tables of an attached partition database if needed
+	#
+	#@param db The schema name of the partition
+	def initPartition(self, db):
+		if self.c.execute('pragma '+db+'.user_version').fetchone()[0] > 0:
+			return
+		self.c.execute('begin immediate')
+		try:
+			self.createDataTable(db)
+			self.createMetaTables(db)
+			if self.fields:
+				self.createFieldsTable(db)
+			self.c.execute('pragma '+db+'.user_version = '+str(len(P2DbStore.MIGRATIONS)))
+			self.c.execute('commit')
+		except:
+			self.c.execute('rollback')
+			raise
+		logger.info("Partition database '"+db+"' created")
+
+	##Attach the partitions of rows to insert, creating them if needed
+	#
+	# Must be called before the transaction inserting the rows.
+	#
+	#@param rows A list of tuples (timestamp, data)
+	def prepareRows(self, rows):
+		if self.partitions == None:
+			return
+		filenames = sorted(set([self.partitions.filename(self.partitions.key(ts)) for (ts, d) in rows]))
+		missing = [f for f in filenames if f not in self.attached]
+		if len(self.attached) + len(missing) > P2DbStore.ATTACH_MAX:
+			self.detachAll()
+		for filename in filenames:
+			self.attach(filename, True)
+
+	##Database initialisation
+	#
+	#@param wal If True the database journal mode is set to WAL
+	#@param synchronous If not None, the synchronous pragma value
+	#@param fields If True the p2fields table is created
+	#@param rollups If True the rollup tables are created
+	def initDb(self, wal, synchronous, fields, rollups):
+		if wal:
+			self.c.execute('pragma journal_mode=wal')
+		if synchronous != None:
+			self.c.execute('pragma synchronous='+synchronous.lower())
+		self.initSchema()
+		if fields:
+			self.createFieldsTable()
+		if rollups and not self.tableExists('p2rollup'):
+			self.transaction('insert into p2rollup select 0, 0, ifnull(max(rowid), 0) from p2data', [()], 'immediate', self.rollupTablesReq())
+		self.checkTables()
+
+	##Check which optional tables exist
+	def checkTables(self):
+		self.fields = self.tableExists('p2fields')
+		self.meta = self.tableExists('p2meta')
+		self.rollups = self.tableExists('p2rollup')
+
+	##Return True if an exception is raised because of a database lock
+	#
+	#@param e An sqlite3.OperationalError
+	@staticmethod
+	def isLocked(e):
+		msg = str(e)
+		return 'locked' in msg or 'busy' in msg
+
+	##Wait before retrying a request failed because of a database lock
+	#
+	# The delay doubles at each attempt, from BACKOFF_MIN up to BACKOFF_MAX
+	# seconds. A warning is only logged for the first attempt.
+	#
+	#@param attempt The number of failed attempts
+	#@param what A description of the failed request
+	def lockWait(self, attempt, what):
+		delay = min(P2DbStore.BACKOFF_MAX, P2DbStore.BACKOFF_MIN * (2 ** (attempt - 1)))
+		if attempt == 1:
+			logger.warning(what+" failed, database locked, retrying")
+		else:
+			logger.debug(what+" failed again, database locked, retrying in "+str(delay)+"s")
+		self.lockStats['waits'] += 1
+		self.lockStats['waitTime'] += delay
+		time.sleep(delay)
+
+	##Call a function until it does not fail because of a database lock
+	#
+	# Each call waits at most the busy timeout, the calls are then delayed by
+	# P2DbStore::lockWait(). Other sqlite3.OperationalError are raised.
+	#
+	#@param func The function to call
+	#@param what A description of the request, for logging
+	#@param args The function arguments
+	#@return The function's returned value
+	def retry(self, func, what, *args):
+		attempt = 0
+		while True:
+			start = utils.monotonic()
+			try:
+				return func(*args)
+			except sqlite3.OperationalError as e:
+				if not P2DbStore.isLocked(e):
+					raise
+				self.lockStats['busyTime'] += utils.monotonic() - start
+				attempt += 1
+				self.lockWait(attempt, what)
+
+	##Run a request with many parameters sets in a transaction
+	#
+	# The transaction is rolled back on failure.
+	#
+	#@param req The SQL request
+	#@param vals A list of parameters tuples
+	#@param mode The transaction mode : '', 'immediate' or 'exclusive'
+	#@param first If not None, requests separated by ; run first in the transaction
+	def transaction(self, req, vals, mode = '', first = None):
+		try:
+			self.c.execute('begin '+mode)
+			if first != None:
+				for req1 in first.split(';'):
+					self.c.execute(req1)
+			self.c.executemany(req, vals)
+			self.c.execute('commit')
+		except sqlite3.OperationalError:
+			try:
+				self.c.execute('rollback')
+			except sqlite3.OperationalError:
+				#No transaction begun
+				pass
+			raise
+
+	##Run a select request and return every row
+	#
+	#@param req The SQL request
+	#@param val The SQL request parameters
+	def fetchAll(self, req, val = ()):
+		return self.c.execute(req, val).fetchall()
+
+	##Return a string with the lock counters
+	def getStatsStr(self):
+		res = "Database %s : %d lock waits (%.1fs waiting, %.1fs busy), %d failed commits, %d datas lost, %d datas buffered" % (self.filename, self.lockStats['waits'], self.lockStats['waitTime'], self.lockStats['busyTime'], self.lockStats['failedCommits'], self.lockStats['lost'], len(self.insertBuff))
+		if self.spool != None:
+			res += ", %d datas spooled (%d bytes in spool)" % (self.lockStats['spooled'], self.spool.size())
+		return res
+
+	##Create the tables or run the pending schema migrations
+	def initSchema(self):
+		version = self.c.execute('pragma user_version').fetchone()[0]
+		exists = self.c.execute("select count(*) from sqlite_master where type='table' and name='p2data'").fetchone()[0]
+		if version == 0 and exists == 0:
+			#New database
+			self.c.execute('begin immediate')
+			self.createDataTable()
+			self.createMetaTables()
+			self.c.execute('pragma user_version = '+str(len(P2DbStore.MIGRATIONS)))
+			self.c.execute('commit')
+		else:
+			for num in range(version, len(P2DbStore.MIGRATIONS)):
+				logger.info("Running database schema migration "+str(num+1))
+				self.c.execute('begin immediate')
+				try:
+					getattr(self, P2DbStore.MIGRATIONS[num])()
+					self.c.execute('pragma user_version = '+str(num+1))
+					self.c.execute('commit')
+				except:
+					self.c.execute('rollback')
+					raise
+		self.checkMigrating()
+
+	##Create the p2data table and its index
+	#
+	#@param db The schema name of the database
+	def createDataTable(self, db = 'main'):
+		self.c.execute('create table if not exists '+db+'.p2data (date integer, data collate binary)')
+		self.c.execute('create index if not exists '+db+'.p2data_date on p2data (date)')
+
+	##Create the metadata tables
+	#
+	# The p2meta table has a single row with the first and last timestamps and
+	# the number of datas. The p2days table has the number of datas of each
+	# day (UTC), days are identified by their first timestamp.
+	#
+	#@param db The schema name of the database
+	def createMetaTables(self, db = 'main'):
+		self.c.execute('create table if not exists '+db+'.p2meta (first integer, last integer, count integer)')
+		self.c.execute('create table if not exists '+db+'.p2days (day integer primary key, count integer)')
+		if self.c.execute('select count(*) from '+db+'.p2meta').fetchone()[0] == 0:
+			self.c.execute('insert into '+db+'.p2meta values (null, null, 0)')
+
+	##Return True if a table exists
+	#
+	#@param name The table name
+	def tableExists(self, name):
+		return self.c.execute("select count(*) from sqlite_master where type='table' and name=?", (name,)).fetchone()[0] > 0
+
+	##Create the p2fields table storing decoded fields in typed columns
+	#
+	# The table has a date column and a column per p2schema::SCHEMA field named
+	# by the field's key. Scaled fields are REAL columns, others are INTEGER.
+	#
+	#@param db The schema name of the database
+	def createFieldsTable(self, db = 'main'):
+		cols = ['date integer']
+		for field in SCHEMA.fields:
+			if field.scaled():
+				cols.append(field.key+' real')
+			else:
+				cols.append(field.key+' integer')
+		self.c.execute('create table if not exists '+db+'.p2fields ('+', '.join(cols)+')')
+		self.c.execute('create index if not exists '+db+'.p2fields_date on p2fields (date)')
+
+	##Return the request creating the rollup tables
+	#
+	# The p2rollup table has a single row with the number of invalid datas
+	# skipped, the rowid of the last p2data row counted by
+	# P2DbStore::fillRollups() and the biggest p2data rowid when the tables
+	# were created (newer rows are counted when inserted).
+	# A table per ROLLUPS slice length (p2rollup_60, ...) has the number of
+	# datas of each time slice and the min, max and sum of each
+	# p2schema::SCHEMA field (columns named key_min, key_max and key_sum).
+	# Slices are identified by their first timestamp.
+	def rollupTablesReq(self):
+		res = 'create table p2rollup (skipped integer, done integer, last integer)'
+		for length in P2DbStore.ROLLUPS:
+			cols = ['slice integer primary key', 'count integer']
+			for key in SCHEMA.keys():
+				cols += [key+'_min real', key+'_max real', key+'_sum real']
+			res += '; create table p2rollup_'+str(length)+' ('+', '.join(cols)+')'
+		return res
+
+	##Return a p2fields row given a data row
+	#
+	#@param timestamp The data's timestamp
+	#@param datas The data, an hexadecimal string or a raw string
+	#@return A tuple (timestamp, value0, value1, ...)
+	@staticmethod
+	def fieldsRow(timestamp, datas):
+		if isinstance(datas, basestring) and len(datas) == SCHEMA.dataLen * 2:
+			datas = binascii.unhexlify(datas)
+		return tuple([timestamp] + SCHEMA.decode(str(datas)))
+
+	##Return the schema version of the database
+	def getSchemaVersion(self):
+		return self.c.execute('pragma user_version').fetchone()[0]
+
+	##Migration 1 : index the p2data table on date
+	#
+	# The old table is renamed p2data_v0 and a new indexed p2data table is
+	# created. Rows are then moved by chunks with P2DbStore::migrateStep(),
+	# while they are not all moved datas are read from both tables.
+	def migrateDateIndex(self):
+		self.c.execute('alter table p2data rename to p2data_v0')
+		self.createDataTable()
+
+	##Migration 2 : metadata tables
+	#
+	# The p2meta and p2days tables are created, new datas are counted when
+	# inserted. The datas already stored are counted by chunks with
+	# P2DbStore::migrateStep() : the p2meta_fill table has the rowid of the
+	# last counted p2data row and the biggest p2data rowid before the
+	# migration, p2data_v0 rows are counted when moved. While the p2meta_fill
+	# table exists the metadata are read from the datas.
+	def migrateMeta(self):
+		self.createMetaTables()
+		self.c.execute('create table p2meta_fill (done integer, last integer)')
+		self.c.execute('insert into p2meta_fill select 0, ifnull(max(rowid), 0) from p2data')
+
+	##Check if rows are left to migrate and set the table to read datas from
+	def checkMigrating(self):
+		exists = self.c.execute("select count(*) from sqlite_master where type='table' and name='p2data_v0'").fetchone()[0]
+		self.migrating = (exists > 0)
+		if self.migrating:
+			self.dataTable = '(select date, data from p2data union all select date, data from p2data_v0)'
+		else:
+			self.dataTable = 'p2data'
+		self.metaFilling = self.tableExists('p2meta_fill')
+
+	##Run a migration step
+	#
+	# Moves a chunk of rows from the p2data_v0 table to the p2data table and
+	# counts a chunk of rows stored before the migration 2 in the metadata
+	# tables.
+	#
+	#@param chunk The maximum number of rows to move and to count
+	#@return True if rows are left to move or to count
+	def migrateStep(self, chunk = MIGRATE_CHUNK):
+		if not self.migrating and not self.metaFilling:
+			return False
+		try:
+			self.c.execute('begin immediate')
+		except sqlite3.OperationalError:
+			logger.debug("Database locked, migration step delayed")
+			return True
+		done = False
+		try:
+			if self.metaFilling:
+				done = self.metaFillStep(chunk)
+			if self.migrating:
+				first = self.c.execute('select min(rowid) from p2data_v0').fetchone()[0]
+				if first == None:
+					self.c.execute('drop table p2data_v0')
+					done = True
+				else:
+					if self.metaFilling:
+						self.updateMeta([row[0] for row in self.c.execute('select date from p2data_v0 where rowid < ? and date is not null', (first + chunk,))])
+					if self.rollups:
+						#Moved rows are not counted by P2DbStore::fillRollups()
+						self.updateRollups(self.c.execute('select date, data from p2data_v0 where rowid < ?', (first + chunk,)).fetchall())
+					self.c.execute('insert into p2data (date, data) select date, data from p2data_v0 where rowid < ? order by rowid', (first + chunk,))
+					self.c.execute('delete from p2data_v0 where rowid < ?', (first + chunk,))
+			self.c.execute('commit')
+		except sqlite3.OperationalError:
+			self.c.execute('rollback')
+			logger.warning("Database migration step failed")
+			#Maybe migrated by another process
+			self.checkMigrating()
+			return self.migrating or self.metaFilling
+		if done:
+			self.checkMigrating()
+			if not self.migrating and not self.metaFilling:
+				logger.info("Database migration done")
+		return self.migrating or self.metaFilling
+
+	##Count a chunk of the rows stored before the migration 2 in the metadata tables
+	#
+	# Must be called in a transaction. The p2meta_fill table is dropped when
+	# every row is counted and the p2data_v0 table is empty.
+	#
+	#@param chunk The maximum number of rows to count
+	#@return True if the p2meta_fill table was dropped
+	def metaFillStep(self, chunk):
+		(done, last) = self.c.execute('select done, last from p2meta_fill').fetchone()
+		if done < last:
+			end = min(done + chunk, last)
+			self.updateMeta([row[0] for row in self.c.execute('select date from p2data where rowid > ? and rowid <= ? and date is not null', (done, end))])
+			self.c.execute('update p2meta_fill set done = ?', (end,))
+			return False
+		if self.migrating:
+			#p2data_v0 rows are counted when moved
+			return False
+		self.c.execute('drop table p2meta_fill')
+		return True
+
+	##Run the pending migration steps until the end
+	#
+	#@param chunk The number of rows moved or counted by a step
+	def migrateAll(self, chunk = MIGRATE_CHUNK):
+		steps = 0
+		while self.migrateStep(chunk):
+			steps += 1
+			if steps % 100 == 0:
+				if self.migrating:
+					left = self.c.execute('select count(*) from p2data_v0').fetchone()[0]
+					logger.info(str(left)+" rows left to migrate")
+				elif self.metaFilling:
+					(done, last) = self.c.execute('select done, last from p2meta_fill').fetchone()
+					logger.info(str(max(last - done, 0))+" rows left to count in the metadata tables")
+
 	##Insert datas into database
 	#
+	# Datas are buffered and commited by P2DbStore::flush() in a single
+	# transaction, depending on commitRows and commitInterval.
+	#
 	#@param timestamp The data's timestamp
-	#@param datas The data to store
+	#@param datas The data to store, an hexadecimal string or a raw string in blob mode
 	def insert(self, timestamp, datas):
 		#Maybe add checks
 		
 		#val = (timestamp,pickle.dumps(datas))
-		val = (timestamp,datas)
+		if self.blob:
+			val = (timestamp,sqlite3.Binary(datas))
+		else:
+			val = (timestamp,datas)
 
-		req = 'insert into p2data values (?,?)'
-		
+		if len(self.insertBuff) == 0:
+			self.buffTime = utils.monotonic()
 		self.insertBuff.append(val)
 
+		if self.commitRows > 0 and len(self.insertBuff) >= self.commitRows:
+			self.flush()
+		elif self.commitInterval > 0 and utils.monotonic() - self.buffTime >= self.commitInterval:
+			self.flush()
+		elif self.commitRows <= 0 and self.commitInterval <= 0:
+			self.flush()
+		
+		logger.debug('Data stored in database')
+		pass
+
+	##Commit the buffered datas
+	#
+	# Every buffered row is inserted in a single transaction. On failure rows
+	# are kept for the next flush, but no more than INSERTBUFFSZ rows over the
+	# commit size (commitRows, or the number of rows buffered during
+	# commitInterval) are kept : older rows are saved in the spool file if
+	# any, else they are lost. Failures other than a locked database (disk
+	# full, I/O error...) are logged as errors. After a successful commit a
+	# batch of spooled rows is inserted (see P2DbStore::drainSpool()).
+	#
+	#@return True if the buffer is empty
+	def flush(self):
+		if len(self.insertBuff) == 0:
+			return True
+
+		if not self.flushFailed:
+			self.groupRows = len(self.insertBuff)
+		start = utils.monotonic()
 		try:
-			self.c.executemany(req, self.insertBuff)
+			self.prepareRows(self.insertBuff)
+			self.c.execute('begin')
+			self.insertRows(self.insertBuff)
+			self.c.execute('commit')
 			logger.debug("Inserted "+str(len(self.insertBuff))+" datas")
 			self.insertBuff = []
+			self.flushFailed = False
+			#Online migration, a chunk at a time
+			self.migrateStep()
+			self.drainSpool()
+		except sqlite3.OperationalError as e:
+			try:
+				self.c.execute('rollback')
+			except sqlite3.OperationalError:
+				#No transaction begun
+				pass
+			#migrateStep() or drainSpool() failure after the commit
+			self.flushFailed = len(self.insertBuff) > 0
+			self.lockStats['failedCommits'] += 1
+			self.lockStats['busyTime'] += utils.monotonic() - start
+			if P2DbStore.isLocked(e):
+				logger.debug("Commit of "+str(len(self.insertBuff))+" datas failed : "+str(e))
+			else:
+				logger.error("Commit of "+str(len(self.insertBuff))+" datas failed : "+str(e))
+			maxSz = P2DbStore.INSERTBUFFSZ + max(self.commitRows, self.groupRows)
+			if len(self.insertBuff) > maxSz:
+				self.spoolRows(self.insertBuff[:-maxSz])
+				self.insertBuff = self.insertBuff[-maxSz:]
+			return False
+		return True
+
+	##Insert rows in the p2data table (and p2fields table if used)
+	#
+	# Must be called in a transaction. In a partitioned database rows are
+	# inserted in their partition, see P2DbStore::prepareRows().
+	#
+	#@param rows A list of tuples (timestamp, data)
+	def insertRows(self, rows):
+		if self.partitions != None:
+			parts = dict()
+			for row in rows:
+				filename = self.partitions.filename(self.partitions.key(row[0]))
+				if filename not in parts:
+					parts[filename] = []
+				parts[filename].append(row)
+			for filename in parts:
+				self.insertRowsIn(parts[filename], self.attached[filename], True)
+		else:
+			self.insertRowsIn(rows, 'main', self.meta)
+			if self.rollups:
+				self.updateRollups(rows)
+
+	##Insert rows in the tables of a database
+	#
+	#@param rows A list of tuples (timestamp, data)
+	#@param db The schema name of the database
+	#@param meta If True the metadata tables are updated
+	def insertRowsIn(self, rows, db, meta):
+		self.c.executemany('insert into '+db+'.p2data values (?,?)', rows)
+		if self.fields:
+			self.c.executemany(self.fieldsInsertReq(db), [P2DbStore.fieldsRow(ts, d) for (ts, d) in rows])
+		if meta:
+			self.updateMeta([ts for (ts, d) in rows], db)
+
+	##Update the metadata tables with new datas
+	#
+	# Must be called in a transaction.
+	#
+	#@param timestamps The new datas timestamps
+	#@param db The schema name of the database
+	def updateMeta(self, timestamps, db = 'main'):
+		if len(timestamps) == 0:
+			return
+		days = dict()
+		for ts in timestamps:
+			day = (int(ts) / P2DbStore.DAY) * P2DbStore.DAY
+			if day in days:
+				days[day] += 1
+			else:
+				days[day] = 1
+		first = min([int(ts) for ts in timestamps])
+		last = max([int(ts) for ts in timestamps])
+		self.c.execute('update '+db+'.p2meta set first = ifnull(min(first, ?), ?), last = ifnull(max(last, ?), ?), count = count + ?', (first, first, last, last, len(timestamps)))
+		self.c.executemany('insert or ignore into '+db+'.p2days values (?, 0)', [(day,) for day in days])
+		self.c.executemany('update '+db+'.p2days set count = count + ? where day = ?', [(days[day], day) for day in days])
+
+	##Update the rollup tables with new datas
+	#
+	# Must be called in a transaction. Invalid datas are only counted as
+	# skipped.
+	#
+	#@param rows A list of tuples (timestamp, data)
+	def updateRollups(self, rows):
+		decoded = []
+		for (ts, d) in rows:
+			try:
+				decoded.append(P2DbStore.fieldsRow(int(ts), d))
+			except (TypeError, binascii.Error, struct.error):
+				logger.warning("Invalid data at date "+str(ts)+" not counted in rollups")
+		if len(decoded) < len(rows):
+			self.c.execute('update p2rollup set skipped = skipped + ?', (len(rows) - len(decoded),))
+		if len(decoded) == 0:
+			return
+
+		nfields = len(SCHEMA)
+		for length in P2DbStore.ROLLUPS:
+			#slice : [count, mins, maxs, sums]
+			slices = dict()
+			for row in decoded:
+				first = (row[0] / length) * length
+				if first not in slices:
+					slices[first] = [1, list(row[1:]), list(row[1:]), list(row[1:])]
+					continue
+				cur = slices[first]
+				cur[0] += 1
+				for i in range(nfields):
+					val = row[i+1]
+					if val < cur[1][i]:
+						cur[1][i] = val
+					if val > cur[2][i]:
+						cur[2][i] = val
+					cur[3][i] += val
+			vals = []
+			for first in slices:
+				(count, mins, maxs, sums) = slices[first]
+				val = [count]
+				for i in range(nfields):
+					val += [mins[i], mins[i], maxs[i], maxs[i], sums[i]]
+				vals.append(tuple(val + [first]))
+			table = 'p2rollup_'+str(length)
+			sets = ['count = count + ?']
+			for key in SCHEMA.keys():
+				sets += [key+'_min = ifnull(min('+key+'_min, ?), ?)', key+'_max = ifnull(max('+key+'_max, ?), ?)', key+'_sum = ifnull('+key+'_sum, 0) + ?']
+			self.c.executemany('insert or ignore into '+table+' (slice, count) values (?, 0)', [(first,) for first in slices])
+			self.c.executemany('update '+table+' set '+', '.join(sets)+' where slice = ?', vals)
+
+	##Fill the rollup tables with the datas of the p2data table
+	#
+	# Pending schema migrations are run first. The rollup tables are created if
+	# needed and the rows stored before their creation are counted by chunks
+	# of rowids (newer datas are counted by the monitor). An interrupted
+	# filling goes on from where it stopped.
+	#
+	#@param chunk The number of rowids counted in a transaction
+	def fillRollups(self, chunk = MIGRATE_CHUNK):
+		if self.partitions != None:
+			logger.error("Rollup tables are not maintained in partitioned databases")
+			return
+		self.migrateAll()
+		if not self.rollups:
+			self.retry(self.transaction, "Rollups creation", 'insert into p2rollup select 0, 0, ifnull(max(rowid), 0) from p2data', [()], 'immediate', self.rollupTablesReq())
+			self.rollups = True
+		(done, last) = self.c.execute('select done, last from p2rollup').fetchone()
+		while done < last:
+			end = min(done + chunk, last)
+			self.retry(self.rollupTransaction, "Rollups filling", done, end)
+			done = end
+			logger.info(str(last - done)+" rowids left to count in the rollup tables")
+
+	##Count a range of p2data rows in the rollup tables in a transaction
+	#
+	#@param done The rowid of the last counted row
+	#@param end The rowid of the last row to count
+	def rollupTransaction(self, done, end):
+		try:
+			self.c.execute('begin immediate')
+			self.updateRollups(self.c.execute('select date, data from p2data where rowid > ? and rowid <= ?', (done, end)).fetchall())
+			self.c.execute('update p2rollup set done = ?', (end,))
+			self.c.execute('commit')
 		except sqlite3.OperationalError:
-			if len(self.insertBuff) > P2DbStore.INSERTBUFFSZ:
+			try:
+				self.c.execute('rollback')
+			except sqlite3.OperationalError:
+				#No transaction begun
+				pass
+			raise
+
+	##Return True if the rollup tables count every stored data
+	#
+	# The number of counted and skipped datas is compared with the number of
+	# stored datas : the tables are not complete when the monitor storing
+	# datas does not update them. Always False for partitioned databases.
+	def rollupsComplete(self):
+		if not self.rollups or self.migrating or self.partitions != None:
+			return False
+		last = str(P2DbStore.ROLLUPS[-1])
+		(count, skipped) = self.retry(self.fetchAll, "Database reading", 'select (select ifnull(sum(count), 0) from p2rollup_'+last+'), skipped from p2rollup')[0]
+		return count + skipped == self.getCount()
+
+	##Return the coarsest rollup slice length usable for a query
+	#
+	# The dates range is reduced to the stored datas one. Without
+	# aggregation a rollup table is only used when more than points datas are
+	# stored in the range and when the days with datas have at least points
+	# slices.
+	#
+	#@param dateMin The smaller timestamp of the query
+	#@param dateMax The higher timestamp of the query
+	#@param points The minimum number of slices in the dates range
+	#@param group If not 0, the query's aggregation slice length, that has to be a multiple of the rollup's one
+	#@return A slice length or 0 if no rollup table is usable
+	def rollupFor(self, dateMin, dateMax, points, group = 0):
+		lengths = list(P2DbStore.ROLLUPS)
+		lengths.reverse()
+		if group > 0:
+			for length in lengths:
+				if int(group) % length == 0:
+					return length
+			return 0
+
+		(first, last, count) = self.getMeta()
+		if first == None:
+			return 0
+		dateMin = max(dateMin, first)
+		dateMax = min(dateMax, last)
+		days = self.getDayCounts(dateMin, dateMax)
+		if sum([n for (day, n) in days]) <= points:
+			return 0
+		span = min(dateMax - dateMin, len(days) * P2DbStore.DAY)
+		for length in lengths:
+			if span / length >= points:
+				return length
+		return 0
+
+	##Select values from a rollup table
+	#
+	#@param key The field key (see p2schema::P2Field)
+	#@param length The rollup table slice length
+	#@param dateMin Slices ending before this timestamp are not returned
+	#@param dateMax Slices beginning after this timestamp are not returned
+	#@param group If not 0, the slices inside the dates range are aggregated by time slices of group seconds
+	#@param agg The aggregate function : avg, min, max, sum or count
+	#
+	#@return An array of tuples (slice's first timestamp, value) ordered by date
+	#
+	#@exception ValueError On unknown aggregate function
+	def queryRollup(self, key, length, dateMin, dateMax, group = 0, agg = 'avg'):
+		SCHEMA.index(key) #check the column name
+		table = 'p2rollup_'+str(int(length))
+		if group > 0:
+			exprs = {'avg' : 'sum(%s_sum) / sum(count)', 'min' : 'min(%s_min)', 'max' : 'max(%s_max)', 'sum' : 'sum(%s_sum)', 'count' : 'sum(count)'}
+		else:
+			exprs = {'avg' : '%s_sum / count', 'min' : '%s_min', 'max' : '%s_max', 'sum' : '%s_sum', 'count' : 'count'}
+		if agg not in exprs:
+			raise ValueError("Unknown aggregate function '"+agg+"'")
+		expr = exprs[agg].replace('%s', key)
+
+		if group > 0:
+			#slices partially outside the range would add foreign datas to the aggregates
+			val = (dateMin, dateMax - length + 1)
+			group = str(int(group))
+			req = 'select (slice / '+group+') * '+group+' as grp, '+expr+' from '+table+' where slice >= ? and slice <= ? group by grp order by grp'
+		else:
+			val = (dateMin - length, dateMax)
+			req = 'select slice, '+expr+' from '+table+' where slice > ? and slice <= ? order by slice'
+
+		res = []
+		for batch in self.iterRequest(req, val):
+			res += batch
+		return res
+
+	##Save rows that can not be commited in the spool file
+	#
+	# Without spool file or when its quota is reached rows are lost.
+	#
+	#@param rows A list of tuples (timestamp, data)
+	def spoolRows(self, rows):
+		done = 0
+		if self.spool != None:
+			done = self.spool.append(rows)
+			self.lockStats['spooled'] += done
+			logger.info(str(done)+" datas saved in spool file '"+self.spool.filename+"'")
+		if done < len(rows):
+			if self.spool != None:
+				logger.warning("Data lost after failing too many times to insert because of database lock, spool quota reached.")
+			else:
 				logger.warning("Data lost after failing too many times to insert because of database lock.")
-				self.insertBuff.pop(0)
-		
-		logger.debug('Data inserted in db')
-		logger.debug('Data stored in database')
-		pass
+			self.lockStats['lost'] += len(rows) - done
+
+	##Return the position of the next spooled row to insert
+	def getSpoolPos(self):
+		if not self.tableExists('p2spool'):
+			return 0
+		res = self.c.execute('select pos from p2spool').fetchone()
+		if res == None:
+			return 0
+		return res[0]
+
+	##Set the position of the next spooled row to insert
+	#
+	# Must be called in a transaction.
+	#
+	#@param pos The spool file position
+	def setSpoolPos(self, pos):
+		self.c.execute('create table if not exists p2spool (pos integer)')
+		self.c.execute('delete from p2spool')
+		self.c.execute('insert into p2spool values (?)', (pos,))
+
+	##Insert a batch of spooled rows
+	#
+	# The spool position is stored in the p2spool table in the same transaction
+	# as the rows, so rows are inserted once even after a crash. The spool file
+	# is emptied when every row is inserted, see P2DbStore::clearSpool().
+	#
+	#@param batch The maximum number of rows to insert
+	#@return True if spooled rows are left
+	def drainSpool(self, batch = SPOOL_BATCH):
+		if self.spool == None:
+			return False
+		stored = self.getSpoolPos()
+		size = self.spool.size()
+		pos = stored
+		if pos > size or self.spoolPosStale:
+			#Spool file emptied but position not reset
+			pos = 0
+		if pos >= size:
+			if stored == 0 and size == 0:
+				return False
+			return self.clearSpool()
+
+		(rows, newPos) = self.spool.read(pos, batch)
+		if newPos == pos:
+			#Only an incomplete last line left
+			return self.clearSpool()
+		if self.blob:
+			rows = [(ts, sqlite3.Binary(binascii.unhexlify(data))) for (ts, data) in rows]
+		try:
+			self.prepareRows(rows)
+			self.c.execute('begin')
+			self.insertRows(rows)
+			self.setSpoolPos(newPos)
+			self.c.execute('commit')
+			self.spoolPosStale = False
+		except sqlite3.OperationalError:
+			try:
+				self.c.execute('rollback')
+			except sqlite3.OperationalError:
+				#No transaction begun
+				pass
+			logger.debug("Database locked, spool draining delayed")
+			return True
+		logger.info(str(len(rows))+" spooled datas inserted, "+str(size - newPos)+" bytes left in spool")
+		return newPos < size
+
+	##Empty the spool file once every spooled row is inserted
+	#
+	# The file is emptied while the database is locked, before the position
+	# reset is commited : after a crash between the two the position is
+	# beyond the end of the file and is taken as 0, spooled rows are never
+	# inserted twice.
+	#
+	#@return True if the spool file could not be emptied
+	def clearSpool(self):
+		try:
+			self.c.execute('begin immediate')
+			self.setSpoolPos(0)
+			self.spool.clear()
+			self.spoolPosStale = True
+			self.c.execute('commit')
+			self.spoolPosStale = False
+		except sqlite3.OperationalError:
+			try:
+				self.c.execute('rollback')
+			except sqlite3.OperationalError:
+				#No transaction begun
+				pass
+			logger.debug("Database locked, spool emptying delayed")
+			return True
+		logger.info("Spool file '"+self.spool.filename+"' emptied")
+		return False
+
+	##Commit the buffered datas and close the database
+	#
+	# Datas that can not be commited are saved in the spool file if any.
+	def close(self):
+		if not self.flush():
+			if self.spool == None:
+				logger.error(str(len(self.insertBuff))+" datas lost, database locked at close")
+			self.spoolRows(self.insertBuff)
+		self.insertBuff = []
+		self.c.close()
+		self.conn.close()
+
+	##Return the insert request of the p2fields table
+	#
+	#@param db The schema name of the database
+	@staticmethod
+	def fieldsInsertReq(db = 'main'):
+		return 'insert into '+db+'.p2fields values ('+', '.join(['?'] * (len(SCHEMA) + 1))+')'
+
+	##Fill the p2fields table with the datas of the p2data table
+	#
+	# Pending schema migrations are run first. The p2fields table is created if
+	# needed and rows older than its first date are added by chunks (newer rows
+	# are added by the monitor).
+	#
+	#@param chunk The number of rows decoded and inserted in a transaction
+	def fillFields(self, chunk = MIGRATE_CHUNK):
+		self.migrateAll()
+		self.createFieldsTable()
+		self.fields = True
+		first = self.c.execute('select min(date) from p2fields').fetchone()[0]
+		if first == None:
+			req = 'select date, data from p2data order by date'
+			val = ()
+		else:
+			req = 'select date, data from p2data where date < ? order by date'
+			val = (first,)
+		done = 0
+		for batch in self.iterRequest(req, val, chunk):
+			rows = []
+			for (ts, data) in batch:
+				try:
+					rows.append(P2DbStore.fieldsRow(ts, data))
+				except (TypeError, binascii.Error, struct.error):
+					logger.warning("Invalid data at date "+str(ts)+" not decoded")
+			self.retry(self.transaction, "Fields filling", self.fieldsInsertReq(), rows)
+			done += len(rows)
+			logger.info(str(done)+" rows decoded in the p2fields table")
+
+	##Return True if the p2fields table has every stored data
+	#
+	# The first and last dates are compared with the stored datas ones : the
+	# table is not complete when the monitor storing datas does not fill it.
+	# Always False for partitioned databases.
+	def fieldsComplete(self):
+		if not self.fields or self.migrating or self.partitions != None:
+			return False
+		(first, last) = self.retry(self.fetchAll, "Database reading", 'select min(date), max(date) from p2fields')[0]
+		(dataFirst, dataLast, count) = self.getMeta()
+		if dataFirst == None:
+			return True
+		return first != None and first <= dataFirst and last >= dataLast
+
+	##Select values from the p2fields table
+	#
+	# Projection, range predicates and aggregation are run by sqlite.
+	#
+	#@param key The field key (see p2schema::P2Field), 'date' for the timestamp
+	#@param dateMin is the smaller data's timestamp returned
+	#@param dateMax is the higher data's timestamp returned
+	#@param where A list of tuples (operator, value) for predicates on the field value, operators are <, <=, >, >=, = and !=
+	#@param group If not 0, rows are grouped by time slices of group seconds, the date of a slice is its begin
+	#@param agg The aggregate function used with group : avg, min, max, sum or count
+	#
+	#@return An array of tuples (date, value) ordered by date
+	def queryFields(self, key, dateMin, dateMax, where = [], group = 0, agg = 'avg'):
+		if key != 'date':
+			SCHEMA.index(key) #check the column name
+		if agg not in ['avg', 'min', 'max', 'sum', 'count']:
+			raise ValueError("Unknown aggregate function '"+agg+"'")
+
+		val = (dateMin, dateMax)
+		cond = 'date >= ? and date <= ?'
+		for (op, value) in where:
+			if op not in ['<', '<=', '>', '>=', '=', '!=']:
+				raise ValueError("Unknown operator '"+op+"'")
+			cond += ' and '+key+' '+op+' ?'
+			val += (value,)
+
+		if group > 0:
+			group = int(group)
+			req = 'select (date / '+str(group)+') * '+str(group)+' as slice, '+agg+'('+key+') from p2fields where '+cond+' group by slice order by slice'
+		else:
+			req = 'select date, '+key+' from p2fields where '+cond+' order by date'
+
+		res = []
+		for batch in self.iterRequest(req, val):
+			res += batch
+		return res
+
+	##Convert the hexadecimal text datas to binary blobs
+	#
+	# Pending schema migrations are run first. Rows are converted by chunks,
+	# the database file is then vacuumed to give back the freed space.
+	#
+	#@param chunk The number of rows converted in a transaction
+	def convertToBlob(self, chunk = MIGRATE_CHUNK):
+		self.migrateAll()
+		done = 0
+		last = 0
+		while True:
+			rows = self.c.execute("select rowid, data from p2data where rowid > ? and typeof(data) = 'text' order by rowid limit ?", (last, chunk)).fetchall()
+			if len(rows) == 0:
+				break
+			last = rows[-1][0]
+			vals = []
+			for (rowid, data) in rows:
+				try:
+					vals.append((sqlite3.Binary(binascii.unhexlify(data)), rowid))
+				except (TypeError, binascii.Error):
+					logger.warning("Invalid hexadecimal data at rowid "+str(rowid)+", left as text : '"+data+"'")
+			self.retry(self.transaction, "Database conversion", 'update p2data set data = ? where rowid = ?', vals, 'immediate')
+			done += len(vals)
+			logger.info(str(done)+" rows converted to blob")
+		logger.info("Vacuuming the database")
+		self.c.execute('vacuum')
 
 	##Retrieve data from database
 	#
@@ -94,57 +1139,215 @@ class P2DbStore:
 	#
 	#@return An array of selected datas
 	def getData(self, dateMin=0, dateMax=0):
+		res = []
+		for batch in self.iterData(dateMin, dateMax):
+			res += batch
+		return res
+	
+	##Retrieve data from database for a list of time intervals
+	#
+	#@param intervals A list of tuples (dateMin, dateMax), bounds are included
+	#
+	#@return An array of selected datas ordered by date
+	#@see P2DbStore::iterDataIntervals()
+	def getDataIntervals(self, intervals):
+		res = []
+		for batch in self.iterDataIntervals(intervals):
+			res += batch
+		return res
+
+	##Iterate over data from database by batches
+	#
+	#@param dateMin is the smaller data's timestamp returned
+	#@param dateMax is the higher data's timestamp returned (0 or less mean no limit)
+	#@param batchSize The maximum number of rows in a batch
+	#
+	#@return An iterator of arrays of selected datas ordered by date
+	def iterData(self, dateMin=0, dateMax=0, batchSize = FETCH_BATCH):
 		val = () #Store SQL query parameters
 		
-		#SQL query construction
-		req = 'select * from p2data'
+		#SQL condition construction
+		conds = []
 		if dateMin > 0:
-			req += ' where date >= ?'
+			conds.append('date >= ?')
 			val += (dateMin,)
 		if dateMax > 0:
-			if len(val) == 0:
-				req += ' where '
-			else:
-				req += ' and '
-			req += ' date <= ?'
+			conds.append('date <= ?')
 			val += (dateMax,)
-		req += ' order by date'
+		else:
+			dateMax = sys.maxint
+		if len(conds) == 0:
+			conds.append('1')
 		
+		return self.iterSelect(' and '.join(conds), val, dateMin, dateMax, batchSize)
+
+	##Iterate over data from database for a list of time intervals by batches
+	#
+	# Every row is read once with a single ordered query, even when intervals overlap.
+	#
+	#@param intervals A list of tuples (dateMin, dateMax), bounds are included
+	#@param batchSize The maximum number of rows in a batch
+	#
+	#@return An iterator of arrays of selected datas ordered by date
+	def iterDataIntervals(self, intervals, batchSize = FETCH_BATCH):
+		if len(intervals) == 0:
+			return iter([])
+
+		val = ()
+		conds = []
+		for (dateMin, dateMax) in intervals:
+			conds.append('(date >= ? and date <= ?)')
+			val += (dateMin, dateMax)
+
+		return self.iterSelect(' or '.join(conds), val, min([i[0] for i in intervals]), max([i[1] for i in intervals]), batchSize)
+
+	##Iterate over the datas matching a condition by batches
+	#
+	# In a partitioned database only the partitions overlapping the dates
+	# range are attached, by groups of ATTACH_MAX. Each group is read with
+	# a single ordered request on the group's time range, along with the
+	# datas left in the main database.
+	#
+	#@param cond The SQL condition
+	#@param val The SQL condition parameters
+	#@param dateMin The smaller timestamp matching the condition
+	#@param dateMax The higher timestamp matching the condition
+	#@param batchSize The maximum number of rows in a batch
+	#
+	#@return An iterator of arrays of selected datas ordered by date
+	def iterSelect(self, cond, val, dateMin, dateMax, batchSize = FETCH_BATCH):
+		if self.partitions == None:
+			return self.iterRequest('select * from '+self.dataTable+' where '+cond+' order by date', val, batchSize)
+		return self.iterPartitions(cond, val, dateMin, dateMax, batchSize)
+
+	##Iterate over the datas of a partitioned database matching a condition
+	#
+	#@see P2DbStore::iterSelect()
+	def iterPartitions(self, cond, val, dateMin, dateMax, batchSize):
+		parts = self.partitions.list(dateMin, dateMax)
+		groups = [parts[i:i+P2DbStore.ATTACH_MAX] for i in range(0, len(parts), P2DbStore.ATTACH_MAX)]
+		if len(groups) == 0:
+			groups = [[]]
+
+		groupMin = dateMin
+		for i in range(len(groups)):
+			groupMax = dateMax
+			if i < len(groups) - 1:
+				groupMax = groups[i][-1][1]
+			self.detachAll()
+			tables = [self.dataTable]
+			for (first, last, filename) in groups[i]:
+				tables.append(self.attach(filename)+'.p2data')
+			reqs = []
+			vals = ()
+			for table in tables:
+				reqs.append('select date, data from '+table+' where ('+cond+') and date >= ? and date <= ?')
+				vals += val + (groupMin, groupMax)
+			for batch in self.iterRequest(' union all '.join(reqs)+' order by date', vals, batchSize):
+				yield batch
+			groupMin = groupMax + 1
+		self.detachAll()
+
+	##Run a select request and iterate over its results by batches
+	#
+	# A dedicated cursor is used, so other requests can be run while iterating.
+	#
+	#@param req The SQL request
+	#@param val The SQL request parameters
+	#@param batchSize The maximum number of rows in a batch
+	#
+	#@return An iterator of arrays of rows
+	def iterRequest(self, req, val, batchSize = FETCH_BATCH):
 		logger.debug('Executing : \''+req+'\' on database')
+		cursor = self.conn.cursor()
 		
-		#Getting results
-		locked = True
-		while locked:
-			try:
-				#SQL query execution
-				self.c.execute(req, val)
-				res = self.c.fetchall()
-				locked = False
-			except sqlite3.OperationalError:
-				locked = True
-				logger.warning("Database reading failed, database locked")
-		
-		#Return selected rows as an array
-		
-		return res
-	
+		#SQL query execution
+		self.retry(cursor.execute, "Database reading", req, val)
+
+		while True:
+			batch = self.retry(cursor.fetchmany, "Database reading", batchSize)
+			if len(batch) == 0:
+				break
+			yield batch
+		cursor.close()
+
+	##Return the datas metadata
+	#
+	# Without metadata tables (read only database not migrated) or while they
+	# are filled datas are read.
+	#
+	#@return A tuple (first, last, count) with the smallest and biggest timestamps (None without datas) and the number of datas
+	def getMeta(self):
+		if self.meta and not self.metaFilling:
+			res = self.retry(self.fetchAll, "Database reading", 'select first, last, count from p2meta')[0]
+		else:
+			res = self.retry(self.fetchAll, "Database reading", 'select min(date), max(date), count(*) from '+self.dataTable)[0]
+		if self.partitions == None:
+			return res
+
+		(first, last, count) = res
+		for (start, end, filename) in self.partitions.list():
+			db = self.attach(filename)
+			(pFirst, pLast, pCount) = self.retry(self.fetchAll, "Database reading", 'select first, last, count from '+db+'.p2meta')[0]
+			if pCount == 0:
+				continue
+			if first == None or pFirst < first:
+				first = pFirst
+			if last == None or pLast > last:
+				last = pLast
+			count += pCount
+		self.detachAll()
+		return (first, last, count)
+
+	##Return the number of datas
+	def getCount(self):
+		return self.getMeta()[2]
+
+	##Return the newest timestamp in the db or None
+	def getLast(self):
+		return self.getMeta()[1]
+
+	##Return the number of datas of each day
+	#
+	#@param dateMin Days ending before this timestamp are not returned
+	#@param dateMax Days beginning after this timestamp are not returned (0 or less mean no limit)
+	#
+	#@return A list of tuples (day's first timestamp, number of datas) ordered by day, days without datas are not returned
+	def getDayCounts(self, dateMin = 0, dateMax = 0):
+		if dateMax <= 0:
+			dateMax = sys.maxint
+		dayMin = (int(dateMin) / P2DbStore.DAY) * P2DbStore.DAY
+		if self.meta and not self.metaFilling:
+			req = 'select day, count from p2days where day >= ? and day <= ? order by day'
+		else:
+			day = str(P2DbStore.DAY)
+			req = 'select (date / '+day+') * '+day+' as day, count(*) from '+self.dataTable+' where date >= ? and date <= ? group by day order by day'
+		res = self.retry(self.fetchAll, "Database reading", req, (dayMin, dateMax))
+		if self.partitions == None:
+			return res
+
+		days = dict(res)
+		for (first, last, filename) in self.partitions.list(dateMin, dateMax):
+			db = self.attach(filename)
+			for (day, count) in self.retry(self.fetchAll, "Database reading", 'select day, count from '+db+'.p2days where day >= ? and day <= ?', (dayMin, dateMax)):
+				days[day] = days.get(day, 0) + count
+		self.detachAll()
+		return sorted(days.items())
+
 	##Retrieve the oldest date in the db
 	#
+	# Read from the metadata tables if any.
+	#
 	#@return The smallest timestamp in the db
 	def getFirst(self, oldest=True):
-		locked = True
-		while locked:
-			try:
-				req = 'SELECT * FROM p2data ORDER BY date LIMIT 1'
-				self.c.execute(req, ())
-				res = self.c.fetchone()
-				locked = False
-			except sqlite3.OperationalError:
-				locked = True
-				logger.warning("Database reading failed, database locked")
+		if (self.meta and not self.metaFilling) or self.partitions != None:
+			return self.getMeta()[0]
+		req = 'SELECT * FROM '+self.dataTable+' ORDER BY date LIMIT 1'
+		rows = self.retry(self.fetchAll, "Database reading", req)
 		
-		if res != None:
-			res = res[0]
+		res = None
+		if len(rows) > 0:
+			res = rows[0][0]
 		return res
 	
 	##Retrieve the last (newest) data in db
@@ -153,19 +1356,28 @@ class P2DbStore:
   #
 	#@return The bigger timestamp
 	def getLastData(self):
-		locked = True
-		while locked:
-			try:
-				req = 'SELECT * FROM p2data ORDER BY date DESC LIMIT 10'
-				self.c.execute(req,())
-				res =  self.c.fetchall()
-				locked = False
-			except sqlite3.OperationalError:
-				locked = True
-				logger.warning("Database reading failed, database locked")
-		
-		return res
+		req = 'SELECT * FROM '+self.dataTable+' ORDER BY date DESC LIMIT 10'
+		res = self.retry(self.fetchAll, "Database reading", req)
+		if self.partitions == None:
+			return res
+
+		#From the newest partition until 10 datas are found
+		parts = self.partitions.list()
+		parts.reverse()
+		for (first, last, filename) in parts:
+			db = self.attach(filename)
+			rows = self.retry(self.fetchAll, "Database reading", 'SELECT * FROM '+db+'.p2data ORDER BY date DESC LIMIT 10')
+			res += rows
+			if len(rows) >= 10:
+				break
+		self.detachAll()
+		res.sort(reverse = True)
+		return res[:10]
 	
 	##P2DbStore destructor
 	def __del__(self):
-		self.c.close()
+		try:
+			self.c.close()
+		except sqlite3.ProgrammingError:
+			#Already closed
+			pass
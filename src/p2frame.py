@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-#
+
+# Copyright 2013, 2014 Weber Yann, Weber Laurent
+#
+# This file is part of pyP2Monitor.
+#
+#        pyP2Monitor is free software: you can redistribute it and/or modify
+#        it under the terms of the GNU General Public License as published by
+#        the Free Software Foundation, either version 3 of the License, or
+#        (at your option) any later version.
+#
+#        pyP2Monitor is distributed in the hope that it will be useful,
+#        but WITHOUT ANY WARRANTY; without even the implied warranty of
+#        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#        GNU General Public License for more details.
+#
+#        You should have received a copy of the GNU General Public License
+#        along with pyP2Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+##@package p2frame Incremental frame reassembly
+#
+# This package define a byte ring buffer and a stateful parser extracting
+# furnace frames from the serial byte stream, whatever the way bytes are
+# split or merged by the serial port reads.
+#
+
+import logging
+
+import p2msg
+from p2msg import P2Frame
+
+import utils
+
+##Use to log
+#@see utils.getLogger()
+logger = utils.getLogger()
+
+##A fixed size byte ring buffer
+#
+# The buffer storage is allocated once and reused for the whole life of the
+# object.
+# @ingroup lowlevel
+class P2RingBuffer:
+
+	##Instanciate a new P2RingBuffer
+	#
+	# @param size The buffer capacity in bytes
+	def __init__(self, size = 4096):
+		##The buffer storage
+		self.buff = bytearray(size)
+		##The buffer capacity
+		self.size = size
+		##Index of the first stored byte
+		self.head = 0
+		##Number of stored bytes
+		self.count = 0
+
+	##Return the number of stored bytes
+	def __len__(self):
+		return self.count
+
+	##Return the number of bytes that can be written without loss
+	def free(self):
+		return self.size - self.count
+
+	##Append bytes at the end of the buffer
+	#
+	# If there is not enough room the oldest bytes are dropped
+	#
+	# @param data A raw string or a bytearray
+	# @return The number of dropped bytes
+	def write(self, data):
+		dlen = len(data)
+		dropped = 0
+		if dlen > self.size:
+			#Only the last bytes can be kept
+			dropped = dlen - self.size
+			data = data[dropped:]
+			dlen = self.size
+		if dlen > self.free():
+			dropped += dlen - self.free()
+			self.skip(dlen - self.free())
+
+		tail = (self.head + self.count) % self.size
+		first = min(dlen, self.size - tail)
+		self.buff[tail:tail+first] = data[:first]
+		if first < dlen:
+			self.buff[0:dlen-first] = data[first:]
+		self.count += dlen
+		return dropped
+
+	##Return a stored byte given its offset from the buffer head
+	#
+	# @param offset The byte offset
+	# @return An integer
+	def peek(self, offset):
+		return self.buff[(self.head + offset) % self.size]
+
+	##Return stored bytes without removing them from the buffer
+	#
+	# @param offset Offset of the first byte from the buffer head
+	# @param length The number of bytes
+	# @return A raw string
+	def peekStr(self, offset, length):
+		start = (self.head + offset) % self.size
+		end = start + length
+		if end <= self.size:
+			return str(self.buff[start:end])
+		return str(self.buff[start:]) + str(self.buff[:end - self.size])
+
+	##Return the sum of stored bytes
+	#
+	# @param offset Offset of the first byte from the buffer head
+	# @param length The number of bytes
+	# @return An integer
+	def sum(self, offset, length):
+		start = (self.head + offset) % self.size
+		end = start + length
+		if end <= self.size:
+			return sum(self.buff[start:end])
+		return sum(self.buff[start:]) + sum(self.buff[:end - self.size])
+
+	##Remove bytes from the buffer head
+	#
+	# @param length The number of bytes to drop
+	def skip(self, length):
+		length = min(length, self.count)
+		self.head = (self.head + length) % self.size
+		self.count -= length
+		if self.count == 0:
+			self.head = 0
+
+	##Remove and return bytes from the buffer head
+	#
+	# @param length The number of bytes
+	# @return A raw string
+	def read(self, length):
+		length = min(length, self.count)
+		res = self.peekStr(0, length)
+		self.skip(length)
+		return res
+
+	##Remove and return bytes from the buffer head without string conversion
+	#
+	# @param length The number of bytes
+	# @return A bytearray
+	def readArray(self, length):
+		length = min(length, self.count)
+		start = self.head
+		end = start + length
+		if end <= self.size:
+			res = self.buff[start:end]
+		else:
+			res = self.buff[start:] + self.buff[:end - self.size]
+		self.skip(length)
+		return res
+
+	##Drop all the stored bytes
+	def clear(self):
+		self.head = 0
+		self.count = 0
+
+
+##Stateful frame parser
+#
+# Bytes read on the serial port are given to P2FrameParser::feed() and
+# complete frames are retrieved with P2FrameParser::next(). Frame boundaries
+# are found using the data size byte : a frame is 2 header bytes, 1 data size
+# byte, the datas and 2 checksum bytes. Bytes following a frame are kept for
+# the next call.
+#
+# When the bytes at the buffer head do not form a valid frame the parser
+# looks for the next valid frame in the buffer and drops the garbage before
+# it.
+# @ingroup lowlevel
+class P2FrameParser:
+
+	##Number of bytes in a frame that are not datas
+	FRAME_OVERHEAD = 5
+	##The biggest possible frame
+	FRAME_MAX = FRAME_OVERHEAD + 0xFF
+
+	##Instanciate a new P2FrameParser
+	#
+	# @param bufSz The ring buffer size in bytes
+	# @param frameEnd If not None, a byte value ending each frame (0x0D for frames sent to the furnace)
+	def __init__(self, bufSz = 4096, frameEnd = None):
+		##The ring buffer storing received bytes
+		self.buff = P2RingBuffer(bufSz)
+		##The frame end byte value
+		self.frameEnd = frameEnd
+		##The number of bytes dropped while resynchronising
+		self.garbage = 0
+		##The raw bytes of the last returned frame
+		self.lastRaw = ""
+
+	##Return the number of buffered bytes
+	def __len__(self):
+		return len(self.buff)
+
+	##Add received bytes to the parser
+	#
+	# @param data A raw string
+	def feed(self, data):
+		if len(data) > 0:
+			dropped = self.buff.write(data)
+			if dropped > 0:
+				self.garbage += dropped
+				logger.warning("Frame parser buffer full, "+str(dropped)+" bytes lost")
+
+	##Drop all the buffered bytes
+	def reset(self):
+		self.buff.clear()
+
+	##Return the size of the frame starting at a given offset
+	#
+	# @param offset The offset of the frame's first byte
+	# @return The frame size in bytes or None if the data size byte is not received yet
+	def frameSize(self, offset):
+		if len(self.buff) < offset + 3:
+			return None
+		res = P2FrameParser.FRAME_OVERHEAD + self.buff.peek(offset + 2)
+		if self.frameEnd != None:
+			res += 1
+		return res
+
+	##Return True if a complete and valid frame starts at offset
+	#
+	# @param offset The offset of the frame's first byte
+	# @param strict If True the header bytes have to be printable ascii characters
+	def validAt(self, offset, strict = False):
+		fsz = self.frameSize(offset)
+		if fsz == None or len(self.buff) < offset + fsz:
+			return False
+		if strict and not self.plausible(offset):
+			return False
+		end = fsz
+		if self.frameEnd != None:
+			end -= 1
+			if self.buff.peek(offset + end) != self.frameEnd:
+				return False
+		chk = self.buff.sum(offset, end - 2) & 0xFFFF
+		recv = self.buff.peek(offset + end - 2) * 0x100 + self.buff.peek(offset + end - 1)
+		return chk == recv
+
+	##Look for a valid frame after the buffer head
+	#
+	# Only frames with printable headers are considered, to avoid taking
+	# datas (often zeros) for a frame.
+	#
+	# @return The offset of the frame or None if not found
+	def resync(self):
+		for offset in range(1, len(self.buff) - P2FrameParser.FRAME_OVERHEAD + 1):
+			if self.validAt(offset, True):
+				return offset
+		return None
+
+	##Remove the frame at the buffer head and return it as a P2Frame
+	#
+	# @param fsz The frame size
+	# @return A p2msg::P2Frame object
+	def popFrame(self, fsz):
+		raw = self.buff.readArray(fsz)
+		self.lastRaw = raw
+		if self.frameEnd != None:
+			raw = raw[:-1]
+		return P2Frame(raw)
+
+	##Return the next received frame
+	#
+	# When the bytes at the buffer head are not a complete and valid frame,
+	# a valid frame following them is returned and the bytes before it are
+	# dropped. A complete frame with an invalid checksum is returned (marked
+	# as not valid) only if no valid frame follows it and its header looks
+	# like a frame header.
+	#
+	# @return A p2msg::P2Frame or None if no complete frame is buffered
+	def next(self):
+		fsz = self.frameSize(0)
+		if fsz == None:
+			return None
+
+		complete = len(self.buff) >= fsz
+		if complete and self.validAt(0):
+			return self.popFrame(fsz)
+
+		offset = self.resync()
+		if offset != None:
+			self.dropGarbage(offset)
+			return self.popFrame(self.frameSize(0))
+
+		if complete and self.plausible(0):
+			return self.popFrame(fsz)
+		#Waiting for more bytes
+		return None
+
+	##Return the frame ending at the buffer end, even with an invalid checksum
+	#
+	# Used when the line is idle : the last received bytes are the end of a
+	# frame, bytes before its begining are dropped as garbage.
+	#
+	# @return A p2msg::P2Frame or None if no frame ends at the buffer end
+	def salvage(self):
+		blen = len(self.buff)
+		for offset in range(0, blen - P2FrameParser.FRAME_OVERHEAD + 1):
+			if self.plausible(offset) and offset + self.frameSize(offset) == blen:
+				if offset > 0:
+					self.dropGarbage(offset)
+				return self.popFrame(blen - offset)
+		return None
+
+	##Return True if the header at offset is made of printable characters
+	#
+	# @param offset The offset of the frame's first byte
+	def plausible(self, offset):
+		for i in (0,1):
+			b = self.buff.peek(offset + i)
+			if b < 0x20 or b > 0x7E:
+				return False
+		return True
+
+	##Drop bytes from the buffer head while resynchronising
+	#
+	# @param length The number of bytes to drop
+	def dropGarbage(self, length):
+		logger.warning("Dropping "+str(length)+" bytes of garbage : '"+self.buff.peekStr(0, length).encode('hex')+"'")
+		self.garbage += length
+		self.buff.skip(length)
+
+	##Remove and return the buffered bytes of an incomplete frame
+	#
+	# Used when giving up waiting for the end of a frame.
+	#
+	# @return A partial p2msg::P2Frame with the received part of the frame
+	def flush(self):
+		raw = self.buff.readArray(len(self.buff))
+		self.lastRaw = raw
+		return P2Frame(raw, True)
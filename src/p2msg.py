@@ -21,6 +21,7 @@
 ##@package p2msg Used to handle P2 messages
 
 import logging
+import binascii
 import utils
 
 ##Use to log
@@ -92,10 +93,14 @@ class P2Msg:
 	#@return An array of integers
 	@staticmethod
 	def hex2list(strArg):
+		if len(strArg) % 2 == 0:
+			try:
+				return list(bytearray(binascii.unhexlify(strArg)))
+			except (TypeError, binascii.Error):
+				pass
 		res = []
-		while len(strArg) > 0:
-			res.append( int(strArg[0:2],16) )
-			strArg = strArg[2:]
+		for i in range(0, len(strArg), 2):
+			res.append( int(strArg[i:i+2],16) )
 		return res;
 
 	##Set the P2msg header
@@ -465,5 +470,265 @@ class P2Msg:
 	#
 	# @return A boolean value
 	def check(self):
-		return (self.getChecksum() == self.checksum)
+		return ((self.calcChecksum() & 0xFFFF) == self.checksum)
 
+
+
+##A compact received frame
+#
+# The whole frame is kept in a single bytearray. Header, data size, datas and
+# checksum are views on it computed when asked for, the hexadecimal string
+# and the integer lists are built once on first use. The checksum is checked
+# when the frame is created, with one pass on the bytes.
+#
+# P2Frame has the same read accessors than P2Msg, P2Frame::toMsg() returns
+# an equivalent P2Msg when the message has to be modified.
+# @ingroup msgprocess
+class P2Frame(object):
+	__slots__ = ('buf', 'partial', 'valid', 'hexStr', 'headerList', 'dataList')
+
+	##Instanciate a new P2Frame
+	#
+	# @param buf The frame bytes as a bytearray (a raw string is converted)
+	# @param partial If True the frame is incomplete : it has no checksum and is marked as not valid
+	def __init__(self, buf, partial = False):
+		if not isinstance(buf, bytearray):
+			buf = bytearray(buf)
+		##The frame bytes
+		self.buf = buf
+		##True if the frame is incomplete
+		self.partial = partial
+		##Cached hexadecimal representation of the whole frame
+		self.hexStr = None
+		##Cached header integer list
+		self.headerList = None
+		##Cached data integer list
+		self.dataList = None
+		##A flag telling wether the message is in a valid state or not
+		self.valid = (not partial) and len(buf) >= 5 and self.check()
+		if not partial and not self.valid:
+			logger.warn("Warning invalid checksum for : "+self.getStr())
+
+	##The header as an integer list
+	@property
+	def header(self):
+		return self.getHeader(P2Msg.FMT_LIST)
+
+	##The data as an integer list
+	@property
+	def datas(self):
+		return self.getData(P2Msg.FMT_LIST)
+
+	##The data size
+	@property
+	def dataSz(self):
+		return self.getDataSz()
+
+	##The message checksum
+	@property
+	def checksum(self):
+		return self.getChecksum()
+
+	##Return the index of the first checksum byte
+	def dataEnd(self):
+		if self.partial:
+			return len(self.buf)
+		return len(self.buf) - 2
+
+	##Return the hexadecimal representation of the whole frame
+	def hexAll(self):
+		if self.hexStr == None:
+			self.hexStr = binascii.hexlify(self.buf).upper()
+		return self.hexStr
+
+	##Return the header
+	#
+	# @param fmt The wanted data format
+	# @see P2Msg::getHeader()
+	def getHeader(self, fmt = P2Msg.FMT_LIST):
+		if fmt == P2Msg.FMT_LIST:
+			if self.headerList == None:
+				self.headerList = list(self.buf[0:2])
+			return self.headerList
+		elif fmt == P2Msg.FMT_HEX_STR:
+			return self.hexAll()[0:4]
+		elif fmt == P2Msg.FMT_RAW_STR:
+			return str(self.buf[0:2])
+		raise TypeError("Unknow or invalid format")
+
+	##Return the data size
+	#
+	# @param fmt The wanted data format
+	# @see P2Msg::getDataSz()
+	def getDataSz(self, fmt = P2Msg.FMT_INT):
+		if len(self.buf) < 3:
+			if fmt == P2Msg.FMT_INT:
+				return 0
+			return ""
+		if fmt == P2Msg.FMT_INT:
+			return self.buf[2]
+		elif fmt == P2Msg.FMT_HEX_STR:
+			return self.hexAll()[4:6]
+		elif fmt == P2Msg.FMT_RAW_STR:
+			return str(self.buf[2:3])
+		raise TypeError("Unknow or invalid format")
+
+	##Return the data
+	#
+	# @param fmt The wanted data format
+	# @see P2Msg::getData()
+	def getData(self, fmt = P2Msg.FMT_LIST):
+		end = self.dataEnd()
+		if fmt == P2Msg.FMT_LIST:
+			if self.dataList == None:
+				self.dataList = list(self.buf[3:end])
+			return self.dataList
+		elif fmt == P2Msg.FMT_HEX_STR:
+			return self.hexAll()[6:end*2]
+		elif fmt == P2Msg.FMT_RAW_STR:
+			return str(self.buf[3:end])
+		raise TypeError("Unknow or invalid format")
+
+	##Return the checksum
+	#
+	# @param fmt The wanted data format
+	# @see P2Msg::getChecksum()
+	def getChecksum(self, fmt = P2Msg.FMT_INT):
+		if self.partial:
+			return None
+		if fmt == P2Msg.FMT_INT:
+			return self.buf[-2] * 0x100 + self.buf[-1]
+		elif fmt == P2Msg.FMT_HEX_STR:
+			return self.hexAll()[-4:]
+		elif fmt == P2Msg.FMT_RAW_STR:
+			return str(self.buf[-2:])
+		elif fmt == P2Msg.FMT_LIST:
+			return list(self.buf[-2:])
+		raise TypeError("Unknow format")
+
+	##Return a string representing the message in hexadecimal notation
+	def getStr(self):
+		return self.hexAll()
+
+	##Return the raw str representing the message
+	def getRaw(self):
+		return str(self.buf)
+
+	##Return the checksum as an integer for this message
+	def calcChecksum(self):
+		return sum(self.buf) - sum(self.buf[self.dataEnd():])
+
+	##Check the message checksum
+	#
+	# @return A boolean value
+	def check(self):
+		if self.partial:
+			return False
+		#Single pass on the bytes : the checksum bytes are substracted
+		chk = sum(self.buf) - self.buf[-2] - self.buf[-1]
+		return (chk & 0xFFFF) == self.buf[-2] * 0x100 + self.buf[-1]
+
+	##Return the not valid flag
+	def failed(self):
+		return (not self.valid)
+
+	##Reset the value of the P2Frame::valid flag
+	#
+	#@param val The wanted value for the flag
+	def resetValid(self, val=True):
+		self.valid = bool(val)
+
+	##Return an equivalent P2Msg
+	def toMsg(self):
+		res = P2Msg()
+		res.setHeader(self.getHeader(P2Msg.FMT_RAW_STR))
+		if len(self.buf) >= 3:
+			res.setDataSz(self.buf[2])
+			res.setData(self.getData(P2Msg.FMT_RAW_STR), False)
+		if not self.partial:
+			res.checksum = self.getChecksum()
+		res.valid = self.valid
+		return res
+
+	##Alias for P2Frame::getStr()
+	def __print__(self):
+		return self.getStr()
+
+	##Display all the informations on the message
+	def dump(self):
+		self.toMsg().dump()
+
+	##A try to display initialisation message
+	#@see P2Msg::dispInitMsg()
+	def dispInitMsg(self):
+		return self.toMsg().dispInitMsg()
+
+
+##A precompiled outgoing frame
+#
+# The frame's wire bytes (including the "\r" frame end) and its string
+# representations are built once, when the object is created.
+# @ingroup msgprocess
+class P2ConstFrame:
+
+	##Instanciate a new P2ConstFrame
+	#
+	# @param header The frame header as an integer list
+	# @param datas The frame data as an integer list
+	def __init__(self, header, datas):
+		msg = P2Msg()
+		msg.prepare(list(header), list(datas))
+		##The frame as a P2Msg
+		self.msg = msg
+		##The bytes to write on the serial port
+		self.wire = msg.getRaw()+"\r"
+		##The header as an hexadecimal string
+		self.headerHex = msg.getHeader(P2Msg.FMT_HEX_STR)
+		##The frame as an hexadecimal string
+		self.str = msg.getStr()
+
+	##Return the bytes to write on the serial port
+	def getWire(self):
+		return self.wire
+
+	##Return the header
+	#
+	# @param fmt The wanted data format
+	# @see P2Msg::getHeader()
+	def getHeader(self, fmt = P2Msg.FMT_LIST):
+		if fmt == P2Msg.FMT_HEX_STR:
+			return self.headerHex
+		return self.msg.getHeader(fmt)
+
+	##Return a string representing the frame in hexadecimal notation
+	def getStr(self):
+		return self.str
+
+
+##Registry of precompiled outgoing frames
+#
+# Constant requests (M1, M2, M3, rb...) are compiled once by
+# P2FrameRegistry::get() and then reused.
+# @ingroup msgprocess
+class P2FrameRegistry:
+
+	##Compiled frames, keys are tuples (header, datas)
+	frames = dict()
+	##Maximum number of cached frames, headers are sometimes taken from (possibly invalid) replies
+	MAX_FRAMES = 64
+
+	##Return the precompiled frame for a header and datas
+	#
+	# When the registry is full an uncached frame is returned
+	# @param header The frame header as an integer list
+	# @param datas The frame data as an integer list (default is [0x01], the data of requests)
+	# @return A P2ConstFrame
+	@staticmethod
+	def get(header, datas = [0x01]):
+		key = (tuple(header), tuple(datas))
+		if key in P2FrameRegistry.frames:
+			return P2FrameRegistry.frames[key]
+		frame = P2ConstFrame(header, datas)
+		if len(P2FrameRegistry.frames) < P2FrameRegistry.MAX_FRAMES:
+			P2FrameRegistry.frames[key] = frame
+		return frame
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-#
+
+# Copyright 2013, 2014 Weber Yann, Weber Laurent
+#
+# This file is part of pyP2Monitor.
+#
+#        pyP2Monitor is free software: you can redistribute it and/or modify
+#        it under the terms of the GNU General Public License as published by
+#        the Free Software Foundation, either version 3 of the License, or
+#        (at your option) any later version.
+#
+#        pyP2Monitor is distributed in the hope that it will be useful,
+#        but WITHOUT ANY WARRANTY; without even the implied warranty of
+#        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#        GNU General Public License for more details.
+#
+#        You should have received a copy of the GNU General Public License
+#        along with pyP2Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+##@package p2partition Time partitioned database files naming
+#
+# Datas of a partitioned database are stored in a database file per period
+# (day, month or year, UTC). Partition files are named after the main
+# database file : p2.db datas of october 2014 are stored in p2-2014-10.db
+# when partitioned by month. Removing old datas only means deleting files.
+#
+
+import sys
+import glob
+import time
+import calendar
+import logging
+
+import utils
+
+##Use to log
+#@see utils.getLogger()
+logger = utils.getLogger()
+
+##Partition files of a database
+# @ingroup msgprocess
+class P2Partitions:
+
+	##Partition periods and their file name date format
+	PERIODS = {'day' : '%Y-%m-%d', 'month' : '%Y-%m', 'year' : '%Y'}
+
+	##Instanciate a new P2Partitions
+	#
+	# @param filename The main database file name
+	# @param period The partition period : "day", "month" or "year"
+	#
+	# @exception ValueError On invalid period
+	def __init__(self, filename, period):
+		if period not in P2Partitions.PERIODS:
+			raise ValueError("Invalid partition period '"+str(period)+"', expected one of "+', '.join(sorted(P2Partitions.PERIODS.keys())))
+		##The partition period
+		self.period = period
+		##The date format of the partition keys
+		self.fmt = P2Partitions.PERIODS[period]
+		##Partition file names prefix
+		self.root = filename
+		if filename.endswith('.db'):
+			self.root = filename[:-3]
+
+	##Return the key of the partition holding a timestamp
+	#
+	# @param timestamp The timestamp
+	def key(self, timestamp):
+		return time.strftime(self.fmt, time.gmtime(int(timestamp)))
+
+	##Return the file name of a partition
+	#
+	# @param key The partition key
+	def filename(self, key):
+		return self.root+'-'+key+'.db'
+
+	##Return the first and last timestamps of a partition
+	#
+	# @param key The partition key
+	# @return A tuple (first, last)
+	#
+	# @exception ValueError On invalid key
+	def bounds(self, key):
+		begin = time.strptime(key, self.fmt)
+		(year, month, day) = begin[:3]
+		if self.period == 'day':
+			start = calendar.timegm((year, month, day, 0, 0, 0))
+			end = start + 86400
+		elif self.period == 'month':
+			start = calendar.timegm((year, month, 1, 0, 0, 0))
+			end = calendar.timegm((year + month / 12, month % 12 + 1, 1, 0, 0, 0))
+		else:
+			start = calendar.timegm((year, 1, 1, 0, 0, 0))
+			end = calendar.timegm((year + 1, 1, 1, 0, 0, 0))
+		return (start, end - 1)
+
+	##List the existing partition files
+	#
+	# @param dateMin Partitions ending before this timestamp are not listed
+	# @param dateMax Partitions beginning after this timestamp are not listed
+	# @return A list of tuples (first timestamp, last timestamp, file name) ordered by date
+	def list(self, dateMin = 0, dateMax = sys.maxint):
+		res = []
+		for filename in glob.glob(self.root+'-*.db'):
+			key = filename[len(self.root)+1:-3]
+			try:
+				(first, last) = self.bounds(key)
+			except ValueError:
+				#Not a partition file
+				continue
+			if self.key(first) != key:
+				continue
+			if last >= dateMin and first <= dateMax:
+				res.append((first, last, filename))
+		res.sort()
+		return res
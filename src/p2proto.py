@@ -21,6 +21,7 @@
 ##@package p2proto
 # Handle the P2 communication protocol
 
+import csv
 import time
 import datetime
 import sys
@@ -32,6 +33,18 @@ from p2com import *
 import p2dbstore
 from p2dbstore import *
 
+import p2capture
+from p2capture import P2CaptureWriter
+
+import p2stats
+from p2stats import P2ComStats
+
+import p2sched
+from p2sched import P2Scheduler, P2RequestSchedule
+
+import p2msg
+from p2msg import P2Msg, P2FrameRegistry
+
 ##Use to log
 #@see utils.getLogger()
 logger = utils.getLogger()
@@ -79,13 +92,26 @@ class P2Furn:
 
 	##Instanciate a new P2Furn
 	#
-	# @param serial_port The serial port filename (eg : /dev/ttyS0 )
-	def __init__(self, serial_port):
+	# @param serial_port The transport URL (eg : /dev/ttyS0 or tcp://host:port, see p2transport)
+	# @param capture If not None, the file name where every sent and received frames are recorded (see p2capture)
+	# @param stats A p2stats::P2ComStats kept when the serial port is restarted, if None a new one is created
+	def __init__(self, serial_port, capture = None, stats = None):
 		
-		##The serial port filename
+		##The transport URL
 		self.port = serial_port
+		##The capture file name
+		self.captureFile = capture
+		##The communication statistics
+		if stats == None:
+			stats = P2ComStats()
+		self.stats = stats
+		##The data request scheduler, set by P2Furn::readData()
+		self.sched = None
+		##The data storages, set by P2Furn::readData()
+		self.storObj = []
 		##The Associated P2Com object
-		self.com = P2Com(serial_port)
+		self.com = None
+		self.openCom()
 		##Stores the current stage
 		#@see P2ProtoStages
 		self.curStage = P2Furn.STAGE_PREINIT
@@ -110,12 +136,30 @@ class P2Furn:
 
 		return res
 	
+	##Open the serial port and the capture file
+	def openCom(self):
+		self.com = P2Com(self.port, self.stats)
+		if self.captureFile != None:
+			self.com.setCapture(P2CaptureWriter(self.captureFile))
+
 	##Restart the serial port
 	def restartSerialPort(self):
 		self.com.close()
-		self.com = P2Com(0)
+		self.openCom()
 		pass
 	
+	##Return the communication statistics
+	#
+	#@return A p2stats::P2ComStats object
+	def getStats(self):
+		return self.stats
+
+	##Return the data request scheduler
+	#
+	#@return A p2sched::P2Scheduler or None if the data exchange stage was not run
+	def getScheduler(self):
+		return self.sched
+
 	##Read a message from the furnace
 	#
 	# Simply call P2Com::read()
@@ -177,11 +221,9 @@ class P2Furn:
 			Waiting for the initialisation to end
 		"""
 		inMsg = None
-		outMsg = P2Msg()
 		#First headers value
 		firstHeader = [0x4D,0x41]
-		outData = [0x01]
-		outMsg.prepare(firstHeader, outData)
+		outFrame = P2FrameRegistry.get(firstHeader)
 
 		self.curStage = P2Furn.STAGE_INIT
 		
@@ -192,18 +234,19 @@ class P2Furn:
 		"""
 		while self.curStage == P2Furn.STAGE_INIT:
 			logger.debug("Init message exchange #"+str(counter))
-			self.com.sendMsg(outMsg)
+			self.com.sendFrame(outFrame)
 			
 			try:
 				inMsg = self.com.read()
 			except P2ComError as e:
-				if e.getErrno() == 9:
+				if e.getErrno() == 9 or e.getErrno() == P2ComError.ERR_LINK:
 					raise e
 					
 				if e.getData() == None:
+					#No header to reply with
 					logger.error("Message failure : no message")
-				else:
-					logger.error("Message failure : "+e.getData().getStr())
+					raise e
+				logger.error("Message failure : "+e.getData().getStr())
 
 				##########################
 				#
@@ -225,7 +268,7 @@ class P2Furn:
 			if recvHeader[0] == 0x4D and (recvHeader[1] & 0xF0) == 0x30:
 				self.curStage = P2Furn.STAGE_POST_INIT
 			else:
-				outMsg.prepare(recvHeader)
+				outFrame = P2FrameRegistry.get(recvHeader)
 
 		logger.info("Initialisation successfully terminated with "+str(counter)+" exchange between computer and furnace")
 
@@ -233,13 +276,13 @@ class P2Furn:
 			First initialisaion stage end
 		"""
 		#Read 32 times M2 values
-		outMsg.prepare([0x4D,0x32],[0x01])
+		m2Frame = P2FrameRegistry.get([0x4D,0x32])
 		nbMaxTs = 33
-		ser = self.com.getCom()
 		for i in range(nbMaxTs):
-			self.com.sendMsg(outMsg)
+			#Replies are not waited for, no round trip time
+			self.com.sendFrame(m2Frame, False)
 			time.sleep(0.15) #Important sleep !
-			if ser.inWaiting() > 0:
+			if self.com.inWaiting() > 0:
 				inMsg = self.com.read()
 				logger.info("2nd init message received")
 				logger.debug("Message : "+inMsg.getStr())
@@ -250,13 +293,14 @@ class P2Furn:
 
 		#Send rb request
 		logger.info("Sending rb request")
-		outMsg.prepare([0x52,0x62],[0x00,0x00,0x01])
 		try:
-			self.com.sendMsg(outMsg)
+			self.com.sendFrame(P2FrameRegistry.get([0x52,0x62],[0x00,0x00,0x01]))
 			#Read ack
 			inMsg = self.com.read() #usually "0x52 0x62 0x01 0x01 0x00 0xb6"
 			logger.info("Rb acknowledge received")
 		except P2ComError as e:
+			if e.getErrno() == P2ComError.ERR_LINK:
+				raise e
 			logger.error("Timeout waiting rb aknowledge")
 		
 
@@ -266,18 +310,19 @@ class P2Furn:
 		logger.info("Waiting 3s before sending the first M2 request")
 		time.sleep(3)
 		logger.debug("Sending the first M2 request")
-		outMsg.prepare([0x4D,0x32],[0x01])
 
 		retryMax = 20
 		i=0
 		while i<retryMax:
 			try:
-				self.com.sendMsg(outMsg)
+				self.com.sendFrame(m2Frame)
 				#Read ack
 				inMsg = self.com.read()
 				logger.debug("M2 Acknowledge received")
 				break
 			except P2ComError as e:
+				if e.getErrno() == P2ComError.ERR_LINK:
+					raise e
 				i+=1
 				logger.warning(str(i)+" timeout waiting acknowledge for 3th init stage M2 message, retrying...")
 				
@@ -292,111 +337,179 @@ class P2Furn:
 
 	##Run the data retrieve function
 	#
+	# Requests are sent on a fixed time grid (see p2sched::P2Scheduler), the
+	# time spent waiting for replies and storing datas does not delay the
+	# next request. The request sent on each slot is choosen by a
+	# p2sched::P2RequestSchedule, a request whose reply has an invalid
+	# checksum is sent again immediately.
+	#
+	# @param waitdata The time between two requests in seconds
 	# @param storage is a dict storing each data storage. Possible keys values are "sqlite" for sqlite db (value is the db file) or "file" for ascii dump (value is the dump file)
 	# @param dateFromP2 is True when we want the furnace date and time, if false we take the date and time from the computer
+	# @param schedule The request schedule string (see p2sched::P2RequestSchedule)
 	#
 	# @exception TypeError On invalid type for parameter storage
-	def readData(self, waitdata = 0.5, storage=[("sqlite", "p2.db")], dateFromP2 = False):
+	# @exception ValueError On invalid schedule
+	def readData(self, waitdata = 0.5, storage=[("sqlite", "p2.db")], dateFromP2 = False, schedule = P2RequestSchedule.DEFAULT):
 		
 		logger.info("Entering data exchange mode")
 		
 		#Local variable initialisation
 		inMsg = P2Msg()
-		outMsg = P2Msg()
 
-		headers = {"m1" : [0x4D,0x31], "m2" : [0x4D,0x32], "m3" : [0x4D,0x33]}
-
-		#m1sending = True
-		m1sending = False
+		reqSchedule = P2RequestSchedule(schedule)
 
 		#Storage initialisation
-		storObj = []
-		for (method,name) in storage:
-			if method == "sqlite":
-				storObj.append(("sqlite", P2DbStore(name)))
-			elif method == "lastdata":
-				storObj.append(("lastdata", name))
-			elif method == "file":
-				storObj.append(("file", open(name, 'a')))
-			elif method == "csv":
-				storObj.append(('csv',csv.writer(open(name, 'wb'), delimiter=',')))
-			else:
-				raise TypeError('Waiting for a tuple of the form (["file" | "sqlite" | "csv", filename), but got ('+str(method)+','+str(name)+')')
+		storObj = P2Furn.openStorage(storage)
+		self.storObj = storObj
 
-		outMsg.prepare(headers["m2"], [0x01])
 		#Fake m2 receive
 		inMsg.prepare([0x4D,0x32],[0x01])
 		
 		curDate = None
+		#Last date received from the furnace and its monotonic time
+		p2Date = None
+		p2DateMono = None
 
-		#infinite loop...
-		while True:
-			#Test wich header we have
-			inHead = inMsg.getHeader(P2Msg.FMT_HEX_STR)
-			if inHead == "4D33":
-				#We received a M3
-				outMsg.prepare(headers["m3"])
-				logger.info("M3 message received")
-			else:
-				if m1sending:
-					logger.debug("Sending a M1 message")
-					outMsg.prepare(headers["m1"])
-					m1sending = False
+		retrying = False
+
+		self.sched = P2Scheduler(waitdata)
+		self.sched.start()
+
+		#Buffered datas are commited when leaving (on error or on exit signal)
+		try:
+			#infinite loop...
+			while True:
+				#waiting for the next request slot
+				if not retrying:
+					self.sched.wait()
+
+				#Test wich header we have
+				inHead = inMsg.getHeader(P2Msg.FMT_HEX_STR)
+				if inHead == "4D33" and not retrying:
+					#We received a M3
+					reqName = "m3"
+					logger.info("M3 message received")
 				else:
-					logger.debug("Sending a M2 message")
-					outMsg.prepare(headers["m2"])
-					m1sending = True
-			#Send the prepared message
-			self.com.sendMsg(outMsg)
-
-			#And read the reply
-			inMsg = self.com.read()
+					reqName = reqSchedule.next()
+					if reqName == None:
+						continue
+				logger.debug("Sending a "+reqName.upper()+" message")
+				#Send the precompiled request
+				self.com.sendFrame(P2FrameRegistry.get(P2RequestSchedule.header(reqName)))
+
+				#And read the reply
+				inMsg = self.com.read()
+
+				if inMsg.failed() and not retrying:
+					#Invalid checksum, asking again without waiting for the next slot
+					logger.info("Invalid reply to "+reqName.upper()+" request, sending it again")
+					reqSchedule.retry(reqName)
+					retrying = True
+					continue
+				retrying = False
 			
-			"""
-			Incoming frame process
-			"""
-			if inMsg.getHeader(P2Msg.FMT_HEX_STR) == "4D31" and (curDate != None or not dateFromP2):
+				"""
+				Incoming frame process
+				"""
+				if inMsg.getHeader(P2Msg.FMT_HEX_STR) == "4D31" and (p2Date != None or not dateFromP2):
 				
-				logger.debug("M1 received")
-				#If we dont want the date from the P2 we take the computer's date and time
-				if not dateFromP2:
-					curDate = datetime.datetime.now()
+					logger.debug("M1 received")
+					#If we dont want the date from the P2 we take the computer's date and time
+					if not dateFromP2:
+						curDate = datetime.datetime.now()
+					else:
+						#Furnace date extrapolated since the last M2 reply
+						curDate = p2Date + datetime.timedelta(seconds = utils.monotonic() - p2DateMono)
 				
-				#Store data on each selected storage
-				for (family, obj) in storObj:
-					if family == "sqlite":
-						#Only store frame with valid checksum
-						if inMsg.check():
-							obj.insert(curDate.strftime("%s"), inMsg.getData(P2Msg.FMT_HEX_STR))
-					elif family == "lastdata":
-						if inMsg.check():
-							lfile = open(obj, "w+")
-							lfile.write(curDate.strftime("%s")+"\n"+inMsg.getData(P2Msg.FMT_HEX_STR))
-							lfile.close()
-					elif family == "csv":
-						if inMsg.check():
-							obj.writerow([curDate.strftime("%s")]+inMsg.getData(P2Msg.FMT_LIST))
-					elif family == "file":
-						if inMsg.check():
-							obj.write(str(curDate.strftime("%s"))+" ::"+inMsg.getData(P2Msg.FMT_HEX_STR))
-						else:
-							obj.write(str(curDate.strftime("%s"))+" :invalid:"+inMsg.getData(P2Msg.FMT_HEX_STR))
+					#Store data on each selected storage
+					P2Furn.storeData(storObj, curDate, inMsg)
 				
-				curTimestamp = None
-			elif dateFromP2:
-				logger.debug("M2 received")
-				#If we want date and time from the furnace take it...
-				if inMsg.getHeader(P2Msg.FMT_HEX_STR) == "4D32":
-					#we got a date
-					msgData = inMsg.getData(P2Msg.FMT_LIST)
-					#msgData[2] is day of week. !!! Warning : Y3K problem ;o) !!!
-					curDate = datetime.datetime(msgData[0]+2000,msgData[2],msgData[3],msgData[4],msgData[5],msgData[6])
-
-			logger.debug("Received message : "+inMsg.getStr())
-			#sleeping as asked
-			time.sleep(waitdata)
+				elif dateFromP2:
+					logger.debug("M2 received")
+					#If we want date and time from the furnace take it...
+					if inMsg.getHeader(P2Msg.FMT_HEX_STR) == "4D32" and not inMsg.failed():
+						#we got a date
+						msgData = inMsg.getData(P2Msg.FMT_LIST)
+						#msgData[2] is day of week. !!! Warning : Y3K problem ;o) !!!
+						p2Date = datetime.datetime(msgData[0]+2000,msgData[2],msgData[3],msgData[4],msgData[5],msgData[6])
+						p2DateMono = utils.monotonic()
+
+				logger.debug("Received message : "+inMsg.getStr())
+		finally:
+			P2Furn.closeStorage(storObj)
+			self.storObj = []
 		pass
 		
+	##Open data storages
+	#
+	# @param storage A list of tuples (method, filename) with method one of "sqlite", "lastdata", "file" or "csv"
+	# @return A list of tuples (method, storage object)
+	#
+	# @exception TypeError On invalid storage method
+	@staticmethod
+	def openStorage(storage):
+		storObj = []
+		for st in storage:
+			(method, name) = st[:2]
+			if method == "sqlite":
+				#Options dict as third item, keys are P2DbStore constructor's arguments
+				opts = dict()
+				if len(st) > 2:
+					opts = st[2]
+				storObj.append(("sqlite", P2DbStore(name, **opts)))
+			elif method == "lastdata":
+				storObj.append(("lastdata", name))
+			elif method == "file":
+				storObj.append(("file", open(name, 'a')))
+			elif method == "csv":
+				storObj.append(('csv',csv.writer(open(name, 'wb'), delimiter=',')))
+			else:
+				raise TypeError('Waiting for a tuple of the form (["file" | "sqlite" | "csv", filename), but got ('+str(method)+','+str(name)+')')
+		return storObj
+
+	##Flush and close data storages
+	#
+	# Buffered rows of sqlite storages are commited.
+	#
+	# @param storObj A list of storages returned by P2Furn::openStorage()
+	@staticmethod
+	def closeStorage(storObj):
+		for (family, obj) in storObj:
+			if family == "sqlite":
+				obj.close()
+			elif family == "file":
+				obj.close()
+
+	##Store a data frame on each storage
+	#
+	# @param storObj A list of storages returned by P2Furn::openStorage()
+	# @param curDate The data's date and time (a datetime object)
+	# @param inMsg The received M1 P2Msg
+	@staticmethod
+	def storeData(storObj, curDate, inMsg):
+		for (family, obj) in storObj:
+			if family == "sqlite":
+				#Only store frame with valid checksum
+				if inMsg.check():
+					if obj.blob:
+						obj.insert(curDate.strftime("%s"), inMsg.getData(P2Msg.FMT_RAW_STR))
+					else:
+						obj.insert(curDate.strftime("%s"), inMsg.getData(P2Msg.FMT_HEX_STR))
+			elif family == "lastdata":
+				if inMsg.check():
+					lfile = open(obj, "w+")
+					lfile.write(curDate.strftime("%s")+"\n"+inMsg.getData(P2Msg.FMT_HEX_STR))
+					lfile.close()
+			elif family == "csv":
+				if inMsg.check():
+					obj.writerow([curDate.strftime("%s")]+inMsg.getData(P2Msg.FMT_LIST))
+			elif family == "file":
+				if inMsg.check():
+					obj.write(str(curDate.strftime("%s"))+" ::"+inMsg.getData(P2Msg.FMT_HEX_STR))
+				else:
+					obj.write(str(curDate.strftime("%s"))+" :invalid:"+inMsg.getData(P2Msg.FMT_HEX_STR))
+
 	##Close the serial port and reset stage lag
 	def stop(self):
 		self.curStage = P2Furn.STAGE_PREINIT
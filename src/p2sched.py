@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-#
+
+# Copyright 2013, 2014 Weber Yann, Weber Laurent
+#
+# This file is part of pyP2Monitor.
+#
+#        pyP2Monitor is free software: you can redistribute it and/or modify
+#        it under the terms of the GNU General Public License as published by
+#        the Free Software Foundation, either version 3 of the License, or
+#        (at your option) any later version.
+#
+#        pyP2Monitor is distributed in the hope that it will be useful,
+#        but WITHOUT ANY WARRANTY; without even the implied warranty of
+#        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#        GNU General Public License for more details.
+#
+#        You should have received a copy of the GNU General Public License
+#        along with pyP2Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+##@package p2sched Data request scheduling
+#
+# This package define the scheduler used to send data requests on a fixed
+# time grid.
+#
+
+import time
+import logging
+
+import p2stats
+from p2stats import P2Histogram
+
+import utils
+
+##Use to log
+#@see utils.getLogger()
+logger = utils.getLogger()
+
+##Deadline based scheduler
+#
+# Slots are on a fixed grid on the monotonic clock : slot n begins at
+# start + n * period, whatever the time spent between two calls to
+# P2Scheduler::wait(). When a slot is already over, the scheduler skips
+# ahead to the next slot on the grid instead of running late slots.
+# @ingroup comproto
+class P2Scheduler:
+
+	##Instanciate a new P2Scheduler
+	#
+	# @param period Time between two slots in seconds
+	def __init__(self, period):
+		##Time between two slots
+		self.period = float(period)
+		##Monotonic time of the next slot
+		self.next = None
+		##Number of slots run
+		self.slots = 0
+		##Number of skipped slots
+		self.missed = 0
+		##Jitter histogram in milliseconds (delay between slot time and wake up)
+		self.jitter = P2Histogram()
+
+	##Start the grid now
+	def start(self):
+		self.next = utils.monotonic()
+
+	##Wait for the next slot
+	#
+	# @return The number of slots skipped before this one
+	def wait(self):
+		if self.next == None:
+			self.start()
+
+		#A signal (SIGUSR2 for the statistics) interrupts the sleep
+		now = utils.monotonic()
+		while now < self.next:
+			time.sleep(self.next - now)
+			now = utils.monotonic()
+
+		late = now - self.next
+		skipped = 0
+		if self.period > 0 and late >= self.period:
+			skipped = int(late / self.period)
+			self.next += skipped * self.period
+			late -= skipped * self.period
+			self.missed += skipped
+			logger.warning(str(skipped)+" data request slot(s) missed")
+
+		self.jitter.add(late * 1000)
+		self.slots += 1
+		self.next += self.period
+		return skipped
+
+	##Return a string with scheduler statistics
+	def getStr(self):
+		return "Scheduler (period %.3fs) : %d slots, %d missed, jitter(ms) %s" % (self.period, self.slots, self.missed, self.jitter.getStr())
+
+
+##Declarative data request schedule
+#
+# A schedule is described by a string like "m1=1,m2=60s" : a comma
+# separated list of request=cadence. A cadence is either a number of slots
+# ("1" for each slot, "10" for one slot out of ten) or a time interval with
+# a unit suffix (s, m, h) meaning at most one request per interval.
+#
+# Requests with a cadence of 1 slot fill the slots that are not used by other
+# requests. A request can be sent again on the next slot with
+# P2RequestSchedule::retry(), for example after a checksum failure.
+# @ingroup comproto
+class P2RequestSchedule:
+
+	##Request headers given their name
+	HEADERS = {"m1" : [0x4D,0x31], "m2" : [0x4D,0x32], "m3" : [0x4D,0x33]}
+
+	##Default schedule
+	DEFAULT = "m1=1,m2=60s"
+
+	##Instanciate a new P2RequestSchedule
+	#
+	# @param spec The schedule string
+	#
+	# @exception ValueError On invalid schedule string
+	def __init__(self, spec = DEFAULT):
+		##Periodic requests : lists [name, slots, seconds, last slot, last time]
+		self.periodic = []
+		##Requests filling free slots
+		self.base = []
+		##Due periodic requests waiting for a free slot
+		self.pending = []
+		##Request to send again on the next slot
+		self.retryName = None
+		##Current slot number
+		self.cycle = 0
+		##Index of the next base request
+		self.baseIdx = 0
+
+		for item in spec.split(','):
+			item = item.strip()
+			if len(item) == 0:
+				continue
+			if '=' not in item:
+				raise ValueError("Waiting request=cadence in schedule but got '"+item+"'")
+			(name, cadence) = item.split('=', 1)
+			name = name.strip().lower()
+			cadence = cadence.strip()
+			if name not in P2RequestSchedule.HEADERS:
+				raise ValueError("Unknown request '"+name+"' in schedule, waiting one of "+str(sorted(P2RequestSchedule.HEADERS.keys())))
+			if len(cadence) == 0:
+				raise ValueError("Missing cadence for request '"+name+"'")
+			if cadence[-1] in "smh":
+				try:
+					secs = float(cadence[:-1]) * {'s' : 1, 'm' : 60, 'h' : 3600}[cadence[-1]]
+				except ValueError:
+					raise ValueError("Invalid cadence '"+cadence+"' for request '"+name+"'")
+				self.periodic.append([name, None, secs, None, None])
+			else:
+				try:
+					slots = int(cadence)
+				except ValueError:
+					raise ValueError("Invalid cadence '"+cadence+"' for request '"+name+"'")
+				if slots < 1:
+					raise ValueError("Invalid cadence '"+cadence+"' for request '"+name+"'")
+				if slots == 1:
+					self.base.append(name)
+				else:
+					self.periodic.append([name, slots, None, None, None])
+
+	##Return the header of a request
+	#
+	# @param name The request name
+	# @return An integer list
+	@staticmethod
+	def header(name):
+		return P2RequestSchedule.HEADERS[name]
+
+	##Return the request to send in the next slot
+	#
+	# @return A request name or None if no request is due
+	def next(self):
+		if self.retryName != None:
+			res = self.retryName
+			self.retryName = None
+			return res
+
+		self.cycle += 1
+		now = utils.monotonic()
+		for entry in self.periodic:
+			(name, slots, secs, lastCycle, lastTime) = entry
+			if name in self.pending:
+				continue
+			if lastCycle == None \
+					or (slots != None and self.cycle - lastCycle >= slots) \
+					or (secs != None and now - lastTime >= secs):
+				self.pending.append(name)
+
+		if len(self.pending) > 0:
+			res = self.pending.pop(0)
+			for entry in self.periodic:
+				if entry[0] == res:
+					entry[3] = self.cycle
+					entry[4] = now
+			return res
+
+		if len(self.base) == 0:
+			return None
+		res = self.base[self.baseIdx % len(self.base)]
+		self.baseIdx += 1
+		return res
+
+	##Send a request again on the next slot
+	#
+	# @param name The request name
+	def retry(self, name):
+		self.retryName = name
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-#
+
+# Copyright 2013, 2014 Weber Yann, Weber Laurent
+#
+# This file is part of pyP2Monitor.
+#
+#        pyP2Monitor is free software: you can redistribute it and/or modify
+#        it under the terms of the GNU General Public License as published by
+#        the Free Software Foundation, either version 3 of the License, or
+#        (at your option) any later version.
+#
+#        pyP2Monitor is distributed in the hope that it will be useful,
+#        but WITHOUT ANY WARRANTY; without even the implied warranty of
+#        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#        GNU General Public License for more details.
+#
+#        You should have received a copy of the GNU General Public License
+#        along with pyP2Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+##@package p2schema Data frame field schema
+#
+# This package describe the fields of the furnace's data frames (M1 replies).
+# The schema is compiled once into a struct.Struct and scale factors, a frame
+# is then decoded with a single unpack call and blocks of frames are decoded
+# as NumPy arrays when NumPy is available.
+#
+
+import struct
+import logging
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+import utils
+
+##Use to log
+#@see utils.getLogger()
+logger = utils.getLogger()
+
+##A data frame field
+# @ingroup msgprocess
+class P2Field:
+
+	##Instanciate a new P2Field
+	#
+	# @param name The field name, as displayed
+	# @param key An ascii identifier for the field
+	# @param offset The offset of the field's first byte in the frame's data
+	# @param width The field size in bytes (1, 2 or 4)
+	# @param signed True if the field is a two's complement integer
+	# @param scale A factor applied to the raw value
+	# @param div A divisor applied to the raw value
+	# @param unit The value unit
+	def __init__(self, name, key, offset, width = 2, signed = False, scale = 1, div = 1, unit = ""):
+		##The field name
+		self.name = name
+		##The field ascii identifier
+		self.key = key
+		##Offset in the frame's data
+		self.offset = offset
+		##Size in bytes
+		self.width = width
+		##Signedness
+		self.signed = signed
+		##Scale factor
+		self.scale = scale
+		##Divisor
+		self.div = div
+		##Unit
+		self.unit = unit
+
+	##Return the struct format character of the field
+	def fmtChar(self):
+		res = {1 : 'b', 2 : 'h', 4 : 'i'}[self.width]
+		if not self.signed:
+			res = res.upper()
+		return res
+
+	##Return the NumPy type string of the field
+	def dtypeStr(self):
+		if self.signed:
+			return '>i'+str(self.width)
+		return '>u'+str(self.width)
+
+	##Return True if the raw value is modified when decoded
+	def scaled(self):
+		return self.scale != 1 or self.div != 1
+
+
+##A compiled data frame schema
+# @ingroup msgprocess
+class P2Schema:
+
+	##Instanciate and compile a new P2Schema
+	#
+	# @param fields A list of P2Field sorted by offset
+	# @param dataLen The frame's data length in bytes
+	#
+	# @exception ValueError If fields overlap or do not fit in the data
+	def __init__(self, fields, dataLen):
+		##The fields
+		self.fields = fields
+		##The frame's data length
+		self.dataLen = dataLen
+
+		fmt = '>'
+		pos = 0
+		for field in fields:
+			if field.offset < pos:
+				raise ValueError("Field '"+field.key+"' overlaps the previous one")
+			if field.offset > pos:
+				fmt += str(field.offset - pos)+'x'
+			fmt += field.fmtChar()
+			pos = field.offset + field.width
+		if pos > dataLen:
+			raise ValueError("Fields are longer than the data ("+str(pos)+" > "+str(dataLen)+")")
+		if pos < dataLen:
+			fmt += str(dataLen - pos)+'x'
+
+		##The compiled struct
+		self.struct = struct.Struct(fmt)
+		##Scaled fields as tuples (field index, scale, divisor)
+		self.scales = []
+		for i in range(len(fields)):
+			if fields[i].scaled():
+				self.scales.append((i, fields[i].scale, float(fields[i].div)))
+
+		##NumPy dtype decoding every field of a frame, or None without NumPy
+		self.dtype = None
+		if numpy != None:
+			self.dtype = numpy.dtype({
+				'names' : [f.key for f in fields],
+				'formats' : [f.dtypeStr() for f in fields],
+				'offsets' : [f.offset for f in fields],
+				'itemsize' : dataLen})
+
+	##Return the number of fields
+	def __len__(self):
+		return len(self.fields)
+
+	##Return the fields names
+	def names(self):
+		return [f.name for f in self.fields]
+
+	##Return the fields ascii identifiers
+	def keys(self):
+		return [f.key for f in self.fields]
+
+	##Return a schema decoding only some of the fields
+	#
+	# Bytes of the other fields are skipped by the compiled struct.
+	#
+	# @param indexes The fields indexes, values are decoded in increasing index order
+	# @return A P2Schema
+	def subset(self, indexes):
+		return P2Schema([self.fields[i] for i in sorted(set(indexes))], self.dataLen)
+
+	##Return the index of a field given its ascii identifier
+	#
+	# @param key The field identifier
+	# @exception KeyError If there is no such field
+	def index(self, key):
+		for i in range(len(self.fields)):
+			if self.fields[i].key == key:
+				return i
+		raise KeyError("No field '"+key+"'")
+
+	##Decode the data of a frame
+	#
+	# Fields without scale are returned as integers, scaled fields as floats.
+	#
+	# @param data The frame's data as a raw string or a bytearray
+	# @return A list of values
+	def decode(self, data):
+		res = list(self.struct.unpack_from(data))
+		for (i, scale, div) in self.scales:
+			if scale != 1:
+				res[i] = res[i] * scale
+			if div != 1:
+				res[i] = res[i] / div
+		return res
+
+	##Decode the data of many frames as a NumPy array
+	#
+	# @param block The frames data as a (rows, dataLen) uint8 numpy array or a raw string
+	# @return A (rows, fields) float64 numpy array
+	#
+	# @exception RuntimeError If NumPy is not available
+	def decodeBlock(self, block):
+		if self.dtype == None:
+			raise RuntimeError("NumPy is needed to decode blocks")
+		if isinstance(block, numpy.ndarray):
+			rec = numpy.ascontiguousarray(block).view(self.dtype).reshape(-1)
+		else:
+			rec = numpy.frombuffer(block, dtype = self.dtype)
+		res = numpy.empty((len(rec), len(self.fields)))
+		for i in range(len(self.fields)):
+			res[:, i] = rec[self.fields[i].key]
+		for (i, scale, div) in self.scales:
+			if scale != 1:
+				res[:, i] *= scale
+			if div != 1:
+				res[:, i] /= div
+		return res
+
+	##Encode raw field values as frame's data
+	#
+	# @param values A list of raw integer values, one per field
+	# @return A raw string
+	def encode(self, values):
+		return self.struct.pack(*values)
+
+
+##Fields of the furnace's data frames
+#@see p2data::colNames()
+FIELDS = [
+	P2Field("a", "a", 0),
+	P2Field("Etat", "etat", 2),
+	P2Field("c", "c", 4),
+	P2Field("d", "d", 6),
+	P2Field("Temp chaudiere", "temp_chaudiere", 8, div = 2, unit = "C"),
+	P2Field("Temp fumee", "temp_fumee", 10, unit = "C"),
+	P2Field("Temp gaz brules", "temp_gaz_brules", 12, unit = "C"),
+	P2Field("Puissance momentanee", "puissance", 14, unit = "%"),
+	P2Field("Ventil. depart", "ventil_depart", 16, unit = "%"),
+	P2Field("Ventil. air combustion", "ventil_air", 18, unit = "%"),
+	P2Field("Alimentation", "alimentation", 20, unit = "%"),
+	P2Field("O2 residuel", "o2_residuel", 22, div = 10, unit = "%"),
+	P2Field("Regulation O2", "regulation_o2", 24, unit = "%"),
+	P2Field("Pellets restants (kg)", "pellets_restants", 26, scale = 0.0029, unit = "kg"),
+	P2Field("o", "o", 28, div = 2),
+	P2Field("Temp exterieur", "temp_exterieur", 30, signed = True, div = 2, unit = "C"),
+	P2Field("Temp consigne depart 1", "temp_consigne_depart1", 32, div = 2, unit = "C"),
+	P2Field("Temp depart 1", "temp_depart1", 34, div = 2, unit = "C"),
+	P2Field("s", "s", 36),
+	P2Field("t", "t", 38),
+	P2Field("Demarages", "demarrages", 40),
+	P2Field("Duree fonctionnement (h)", "duree_fonctionnement", 42, unit = "h"),
+	P2Field("Temp tableau", "temp_tableau", 44, unit = "C"),
+	P2Field("Consigne temp chaudiere", "consigne_temp_chaudiere", 46, div = 2, unit = "C"),
+]
+
+##The compiled schema of the furnace's data frames
+SCHEMA = P2Schema(FIELDS, 48)
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-#
+
+# Copyright 2013, 2014 Weber Yann, Weber Laurent
+#
+# This file is part of pyP2Monitor.
+#
+#        pyP2Monitor is free software: you can redistribute it and/or modify
+#        it under the terms of the GNU General Public License as published by
+#        the Free Software Foundation, either version 3 of the License, or
+#        (at your option) any later version.
+#
+#        pyP2Monitor is distributed in the hope that it will be useful,
+#        but WITHOUT ANY WARRANTY; without even the implied warranty of
+#        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#        GNU General Public License for more details.
+#
+#        You should have received a copy of the GNU General Public License
+#        along with pyP2Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+##@package p2sim Furnace simulator
+#
+# This package define a furnace simulator speaking the P2 protocol. It
+# answers the authentication, the initialisation exchanges, the M2 date
+# requests, the rb request and the M1 data requests, with configurable
+# faults (latency, splitted frames, corrupted checksums, garbage and
+# dropouts).
+#
+
+import os
+import time
+import math
+import errno
+import random
+import select
+import datetime
+import logging
+
+import p2msg
+from p2msg import P2Msg
+
+import p2frame
+from p2frame import P2FrameParser
+
+import p2transport
+from p2transport import P2FdTransport, P2TransportError
+
+import p2schema
+from p2schema import SCHEMA
+
+import utils
+
+##Use to log
+#@see utils.getLogger()
+logger = utils.getLogger()
+
+##The furnace simulator
+#
+# Frames are read from a p2transport::P2Transport and replies are written
+# on the same transport.
+# @ingroup comproto
+class P2FurnSim:
+
+	##Header letters of the initialisation exchange, in order
+	#
+	# The first one is sent by the computer, the others are replies.
+	INIT_SEQ = "ABMDTLFW"
+
+	##Texts sent in initialisation replies
+	INIT_TXT = {'A' : "pyP2 simulator", 'B' : "P2 SIM", 'M' : "Kessel", 'D' : "Datum",
+			'T' : "Text", 'L' : "Laufzeit", 'F' : "Fehler", 'W' : "Wert"}
+
+	##Number of bytes before the text in initialisation replies
+	#@see p2msg::P2Msg::dispInitMsg()
+	INIT_PREFIX = {'A' : 5, 'B' : 5, 'M' : 5, 'D' : 7, 'T' : 1, 'L' : 11, 'F' : 3, 'W' : 3}
+
+	##Instanciate a new simulator
+	#
+	# @param transport The transport to serve on
+	# @param latency Seconds to wait before sending a reply
+	# @param split If not 0, replies are written by chunks of split bytes
+	# @param splitDelay Seconds to wait between two chunks
+	# @param corrupt Probability of a corrupted reply checksum
+	# @param dropout Probability of not replying to a request
+	# @param garbage Probability of sending garbage bytes before a reply
+	# @param seed The random generator seed
+	def __init__(self, transport, latency = 0.0, split = 0, splitDelay = 0.002, corrupt = 0.0, dropout = 0.0, garbage = 0.0, seed = None):
+		##The transport
+		self.transport = transport
+		##Reply latency in seconds
+		self.latency = latency
+		##Chunk size for splitted replies
+		self.split = split
+		##Delay between two chunks
+		self.splitDelay = splitDelay
+		##Corrupted checksum probability
+		self.corrupt = corrupt
+		##Dropout probability
+		self.dropout = dropout
+		##Garbage probability
+		self.garbage = garbage
+		##The random generator
+		self.rand = random.Random(seed)
+		##Parser for frames sent by the computer
+		self.parser = P2FrameParser(frameEnd = 0x0D)
+		##Stop flag
+		self.running = False
+
+		##Time of the simulator start
+		self.startTime = utils.monotonic()
+		##Counters
+		self.stats = {'recv' : 0, 'sent' : 0, 'dropped' : 0, 'corrupted' : 0, 'garbage' : 0, 'm1' : 0}
+
+	##Serve requests until P2FurnSim::stop() is called or the link is closed
+	#
+	# @param statsInterval Seconds between two statistics log, 0 to disable
+	def serve(self, statsInterval = 0):
+		self.running = True
+		fd = self.transport.fileno()
+		nextStats = utils.monotonic() + statsInterval
+		while self.running:
+			try:
+				ready = select.select([fd], [], [], 0.5)[0]
+			except select.error as e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+			if len(ready) > 0:
+				try:
+					self.parser.feed(self.transport.read(4096))
+				except P2TransportError:
+					logger.info("Simulator link closed")
+					break
+				msg = self.parser.next()
+				while msg != None:
+					self.handle(msg)
+					msg = self.parser.next()
+
+			if statsInterval > 0 and utils.monotonic() >= nextStats:
+				logger.info(self.getStatsStr())
+				nextStats += statsInterval
+		self.running = False
+
+	##Stop serving
+	def stop(self):
+		self.running = False
+
+	##Return a string describing simulator statistics
+	def getStatsStr(self):
+		elapsed = utils.monotonic() - self.startTime
+		res = "Simulator : "
+		for k in sorted(self.stats.keys()):
+			res += k+"="+str(self.stats[k])+" "
+		if elapsed > 0:
+			res += "frames/s=%.2f m1/s=%.2f" % (self.stats['sent'] / elapsed, self.stats['m1'] / elapsed)
+		return res
+
+	##Process a frame sent by the computer
+	#
+	# @param msg The received P2Msg
+	def handle(self, msg):
+		self.stats['recv'] += 1
+		logger.debug("Simulator received "+msg.getStr())
+		if msg.failed():
+			logger.warning("Simulator received an invalid frame")
+			return
+
+		reply = self.reply(msg)
+		if reply == None:
+			return
+		if self.rand.random() < self.dropout:
+			self.stats['dropped'] += 1
+			logger.debug("Simulator dropout")
+			return
+		self.send(reply)
+
+	##Return the reply to a frame sent by the computer
+	#
+	# @param msg The received P2Msg
+	# @return A P2Msg or None
+	def reply(self, msg):
+		header = msg.getHeader(P2Msg.FMT_LIST)
+		res = P2Msg()
+
+		if header == [0x52, 0x61]:
+			#Authentication
+			res.prepare([0x52, 0x61], [0x01])
+		elif header == [0x52, 0x62]:
+			#rb request acknowledge
+			res.prepare([0x52, 0x62], [0x01])
+		elif header == [0x4D, 0x31]:
+			self.stats['m1'] += 1
+			res.prepare([0x4D, 0x31], self.dataFrame())
+		elif header == [0x4D, 0x32]:
+			res.prepare([0x4D, 0x32], self.dateFrame())
+		elif header == [0x4D, 0x33]:
+			res.prepare([0x4D, 0x33], [0x01])
+		elif header[0] == 0x4D and chr(header[1]) in P2FurnSim.INIT_SEQ:
+			idx = P2FurnSim.INIT_SEQ.index(chr(header[1])) + 1
+			if idx < len(P2FurnSim.INIT_SEQ):
+				res.prepare([0x4D, ord(P2FurnSim.INIT_SEQ[idx])], self.initFrame(P2FurnSim.INIT_SEQ[idx]))
+			else:
+				#End of the initialisation
+				res.prepare([0x4D, 0x33], [0x01])
+		else:
+			logger.warning("Simulator received an unknown frame : "+msg.getStr())
+			return None
+		return res
+
+	##Return the data of an initialisation reply
+	#
+	# @param letter The reply's header second letter
+	# @return An integer list
+	def initFrame(self, letter):
+		res = [0] * P2FurnSim.INIT_PREFIX[letter]
+		res[0] = self.rand.randint(0, 0xFF)
+		return res + P2Msg.str2list(P2FurnSim.INIT_TXT[letter])
+
+	##Return the data of a M2 date reply
+	#
+	# @return An integer list [year-2000, day of week, month, day, hour, min, sec]
+	def dateFrame(self):
+		now = datetime.datetime.now()
+		return [now.year - 2000, now.isoweekday(), now.month, now.day, now.hour, now.minute, now.second]
+
+	##Return the 48 bytes of a M1 data reply
+	#
+	# Values slowly change with time and are encoded with p2schema::SCHEMA
+	#
+	# @return An integer list
+	def dataFrame(self):
+		t = utils.monotonic() - self.startTime
+		wave = math.sin(t / 600.0)
+		values = [0] * 24
+		values[1] = 4				#Etat
+		values[4] = int((72 + 5 * wave) * 2)	#Temp chaudiere
+		values[5] = int(150 + 20 * wave)	#Temp fumee
+		values[6] = int(600 + 80 * wave)	#Temp gaz brules
+		values[7] = int(60 + 30 * wave)		#Puissance momentanee
+		values[8] = 55				#Ventil. depart
+		values[9] = int(45 + 10 * wave)		#Ventil. air combustion
+		values[10] = 30				#Alimentation
+		values[11] = int((7.5 - 1.5 * wave) * 10)	#O2 residuel
+		values[12] = 50				#Regulation O2
+		values[13] = int(120 / 0.0029)		#Pellets restants
+		values[15] = int(round(-3.5 * 2 + 4 * wave))	#Temp exterieur
+		values[16] = 110			#Temp consigne depart 1
+		values[17] = int((52 + 3 * wave) * 2)	#Temp depart 1
+		values[20] = 1234			#Demarages
+		values[21] = 5678 + int(t / 3600)	#Duree fonctionnement
+		values[22] = 60				#Temp tableau
+		values[23] = 150			#Consigne temp chaudiere
+
+		return list(bytearray(SCHEMA.encode(values)))
+
+	##Write a reply on the transport applying faults
+	#
+	# @param msg The P2Msg to send
+	def send(self, msg):
+		raw = msg.getRaw()
+		if self.rand.random() < self.corrupt:
+			self.stats['corrupted'] += 1
+			raw = raw[:-1] + chr((ord(raw[-1]) + 1 + self.rand.randint(0, 0xFD)) & 0xFF)
+		if self.rand.random() < self.garbage:
+			self.stats['garbage'] += 1
+			noise = ""
+			for i in range(self.rand.randint(1, 8)):
+				noise += chr(self.rand.randint(0, 0xFF))
+			raw = noise + raw
+
+		if self.latency > 0:
+			time.sleep(self.latency)
+
+		if self.split > 0:
+			for i in range(0, len(raw), self.split):
+				self.transport.write(raw[i:i+self.split])
+				if self.splitDelay > 0:
+					time.sleep(self.splitDelay)
+		else:
+			self.transport.write(raw)
+		self.stats['sent'] += 1
+		logger.debug("Simulator sent "+msg.getStr())
+
+
+##Open a pseudo terminal for the simulator
+#
+# The slave side is set in raw mode and kept open, so the computer side can
+# close and reopen it.
+#
+# @return A tuple (P2FdTransport on the master side, slave file name, slave fd)
+def openPty():
+	(master, slave) = os.openpty()
+	P2FdTransport.setRaw(slave, 9600)
+	return (P2FdTransport(master), os.ttyname(slave), slave)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-#
+
+# Copyright 2013, 2014 Weber Yann, Weber Laurent
+#
+# This file is part of pyP2Monitor.
+#
+#        pyP2Monitor is free software: you can redistribute it and/or modify
+#        it under the terms of the GNU General Public License as published by
+#        the Free Software Foundation, either version 3 of the License, or
+#        (at your option) any later version.
+#
+#        pyP2Monitor is distributed in the hope that it will be useful,
+#        but WITHOUT ANY WARRANTY; without even the implied warranty of
+#        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#        GNU General Public License for more details.
+#
+#        You should have received a copy of the GNU General Public License
+#        along with pyP2Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+##@package p2spool Durable spool for datas not yet stored in a database
+#
+# A spool file is an append only text file, each line is a data : its
+# timestamp and its hexadecimal data separated by a space. Lines are synced
+# to disk when appended. The file is read from a position (a byte offset)
+# kept by the reader, see p2dbstore::P2DbStore::drainSpool().
+#
+
+import os
+import binascii
+import logging
+
+import utils
+
+##Use to log
+#@see utils.getLogger()
+logger = utils.getLogger()
+
+##Append only data spool file
+# @ingroup msgprocess
+class P2Spool:
+
+	##Default spool file size limit in bytes
+	QUOTA = 64 * 1024 * 1024
+
+	##Instanciate a new P2Spool
+	#
+	# @param filename The spool file name
+	# @param quota The spool file size limit in bytes, datas are lost when reached
+	def __init__(self, filename, quota = QUOTA):
+		##The spool file name
+		self.filename = filename
+		##The file size limit
+		self.quota = quota
+
+	##Return the spool file size in bytes
+	def size(self):
+		if not os.path.exists(self.filename):
+			return 0
+		return os.path.getsize(self.filename)
+
+	##Append datas to the spool file and sync it
+	#
+	# Datas are appended in order until the quota is reached.
+	#
+	# @param rows A list of tuples (timestamp, data) with data an hexadecimal string or a buffer (blob)
+	# @return The number of appended datas
+	def append(self, rows):
+		left = self.quota - self.size()
+		lines = []
+		for (ts, data) in rows:
+			if not isinstance(data, basestring):
+				data = binascii.hexlify(str(data)).upper()
+			line = str(ts)+" "+data+"\n"
+			if len(line) > left:
+				break
+			left -= len(line)
+			lines.append(line)
+		if len(lines) > 0:
+			fd = open(self.filename, "ab")
+			fd.write("".join(lines))
+			fd.flush()
+			os.fsync(fd.fileno())
+			fd.close()
+		return len(lines)
+
+	##Read datas from the spool file
+	#
+	# An incomplete last line is not read, invalid lines are skipped.
+	#
+	# @param pos The position to read from
+	# @param count The maximum number of datas to read
+	# @return A tuple (rows, pos) with rows a list of tuples (timestamp, hexadecimal data) and pos the position of the next line
+	def read(self, pos, count):
+		res = []
+		if not os.path.exists(self.filename):
+			return (res, pos)
+		fd = open(self.filename, "rb")
+		fd.seek(pos)
+		while len(res) < count:
+			line = fd.readline()
+			if not line.endswith("\n"):
+				break
+			pos += len(line)
+			try:
+				(ts, data) = line.split()
+				binascii.unhexlify(data)
+				res.append((int(ts), data))
+			except (ValueError, TypeError):
+				logger.warning("Invalid spool line skipped : '"+line.strip()+"'")
+		fd.close()
+		return (res, pos)
+
+	##Empty the spool file
+	def clear(self):
+		open(self.filename, "wb").close()
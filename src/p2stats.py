@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-#
+
+# Copyright 2013, 2014 Weber Yann, Weber Laurent
+#
+# This file is part of pyP2Monitor.
+#
+#        pyP2Monitor is free software: you can redistribute it and/or modify
+#        it under the terms of the GNU General Public License as published by
+#        the Free Software Foundation, either version 3 of the License, or
+#        (at your option) any later version.
+#
+#        pyP2Monitor is distributed in the hope that it will be useful,
+#        but WITHOUT ANY WARRANTY; without even the implied warranty of
+#        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#        GNU General Public License for more details.
+#
+#        You should have received a copy of the GNU General Public License
+#        along with pyP2Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+##@package p2stats Communication statistics
+#
+# This package define fixed buckets histograms and the statistics object
+# used by P2Com to record request/reply round trip times and errors.
+#
+
+import bisect
+import logging
+
+import utils
+
+##Use to log
+#@see utils.getLogger()
+logger = utils.getLogger()
+
+##Fixed buckets histogram
+# @ingroup lowlevel
+class P2Histogram:
+
+	##Default buckets upper bounds in milliseconds
+	BOUNDS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+	##Instanciate a new histogram
+	#
+	# @param bounds Sorted buckets upper bounds, values bigger than the last bound go in an overflow bucket
+	def __init__(self, bounds = BOUNDS):
+		##Buckets upper bounds
+		self.bounds = bounds
+		##Buckets counters, the last one is the overflow bucket
+		self.counts = [0] * (len(bounds) + 1)
+		##Number of values
+		self.count = 0
+		##Sum of values
+		self.total = 0.0
+		##Smallest value
+		self.min = None
+		##Biggest value
+		self.max = None
+
+	##Add a value
+	#
+	# @param value The value to add
+	def add(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.total += value
+		if self.min == None or value < self.min:
+			self.min = value
+		if self.max == None or value > self.max:
+			self.max = value
+
+	##Return the mean value or None if empty
+	def mean(self):
+		if self.count == 0:
+			return None
+		return self.total / self.count
+
+	##Return an approximated percentile (the upper bound of the bucket holding it)
+	#
+	# @param pct The percentile between 0 and 100
+	# @return A value or None if empty
+	def percentile(self, pct):
+		if self.count == 0:
+			return None
+		rank = self.count * pct / 100.0
+		acc = 0
+		for i in range(len(self.counts)):
+			acc += self.counts[i]
+			if acc >= rank and self.counts[i] > 0:
+				if i < len(self.bounds):
+					return self.bounds[i]
+				return self.max
+		return self.max
+
+	##Return a string representing the histogram
+	def getStr(self):
+		if self.count == 0:
+			return "n=0"
+		res = "n=%d min=%.1f mean=%.1f p90<=%s max=%.1f |" % (self.count, self.min, self.mean(), str(self.percentile(90)), self.max)
+		for i in range(len(self.counts)):
+			if self.counts[i] > 0:
+				if i < len(self.bounds):
+					res += " <=%s:%d" % (str(self.bounds[i]), self.counts[i])
+				else:
+					res += " >%s:%d" % (str(self.bounds[-1]), self.counts[i])
+		return res
+
+
+##Communication statistics
+#
+# Round trip times are stored in milliseconds in a P2Histogram for each
+# request header. Receive errors are counted given their p2com::P2ComError
+# code, frames with an invalid checksum are counted with the
+# P2ComError::ERR_CHKSUM code.
+# @ingroup lowlevel
+class P2ComStats:
+
+	##Instanciate a new P2ComStats
+	def __init__(self):
+		self.reset()
+
+	##Reset every counter
+	def reset(self):
+		##Round trip time histograms, keys are request headers as hex string
+		self.rtt = dict()
+		##Error counters, keys are error codes
+		self.errors = dict()
+		##Number of sent frames
+		self.sent = 0
+		##Number of received frames
+		self.recv = 0
+		##Header of the last request
+		self.lastHeader = None
+		##Time of the last request, None when a reply was received
+		self.lastSend = None
+		##Time of the statistics reset
+		self.since = utils.monotonic()
+
+	##Record a sent request
+	#
+	# @param header The request header as an hex string
+	# @param timed If False no round trip time is recorded for this request (no reply is waited for)
+	def requestSent(self, header, timed = True):
+		self.sent += 1
+		self.lastHeader = header
+		if timed:
+			self.lastSend = utils.monotonic()
+		else:
+			self.lastSend = None
+
+	##Record a received frame
+	#
+	# The round trip time is only recorded for the first frame received after a request
+	#
+	# @param valid False if the frame checksum is invalid
+	def replyReceived(self, valid = True):
+		self.recv += 1
+		if not valid:
+			self.error(2)
+		if self.lastSend != None:
+			rtt = (utils.monotonic() - self.lastSend) * 1000
+			self.lastSend = None
+			if self.lastHeader not in self.rtt:
+				self.rtt[self.lastHeader] = P2Histogram()
+			self.rtt[self.lastHeader].add(rtt)
+
+	##Record a receive error
+	#
+	# @param errno The p2com::P2ComError code
+	def error(self, errno):
+		self.lastSend = None
+		if errno in self.errors:
+			self.errors[errno] += 1
+		else:
+			self.errors[errno] = 1
+
+	##Return the round trip time histogram of a request header or None
+	#
+	# @param header The request header as an hex string
+	def getRtt(self, header):
+		if header in self.rtt:
+			return self.rtt[header]
+		return None
+
+	##Return the number of errors given an error code
+	#
+	# @param errno The p2com::P2ComError code
+	def getErrors(self, errno):
+		if errno in self.errors:
+			return self.errors[errno]
+		return 0
+
+	##Return a multiline string with every statistics
+	def getStr(self):
+		import p2com
+		res = "Communication statistics for the last %.0fs : %d frames sent, %d received\n" % (utils.monotonic() - self.since, self.sent, self.recv)
+		for header in sorted(self.rtt.keys()):
+			res += "  rtt(ms) "+header+" : "+self.rtt[header].getStr()+"\n"
+		for errno in sorted(self.errors.keys()):
+			res += "  error %d (%s) : %d\n" % (errno, p2com.P2ComError.ERR_STR[errno], self.errors[errno])
+		return res
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-#
+
+# Copyright 2013, 2014 Weber Yann, Weber Laurent
+#
+# This file is part of pyP2Monitor.
+#
+#        pyP2Monitor is free software: you can redistribute it and/or modify
+#        it under the terms of the GNU General Public License as published by
+#        the Free Software Foundation, either version 3 of the License, or
+#        (at your option) any later version.
+#
+#        pyP2Monitor is distributed in the hope that it will be useful,
+#        but WITHOUT ANY WARRANTY; without even the implied warranty of
+#        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#        GNU General Public License for more details.
+#
+#        You should have received a copy of the GNU General Public License
+#        along with pyP2Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+##@package p2transport Byte transports used to talk with the furnace
+#
+# This package define the transports P2Com can use : serial port (using
+# pyserial), raw tty or pty file descriptor, TCP socket (for ser2net like
+# bridges) and in-memory pipe.
+#
+# A transport is choosen given an URL-like string :
+# - /dev/ttyS0 or serial:///dev/ttyS0 for a serial port
+# - tty:///dev/pts/3 (or pty:///dev/pts/3) for a raw tty or pty
+# - tcp://host:port for a TCP socket
+# - mem://name for an in-memory pipe registered with P2MemTransport::listen()
+#
+
+import os
+import errno
+import socket
+import logging
+
+import utils
+
+##Use to log
+#@see utils.getLogger()
+logger = utils.getLogger()
+
+##Class handling transport errors
+#
+# Raised on invalid transport URL, when the link can not be opened, on write
+# errors or when the link is closed by the peer
+# @ingroup lowlevel
+class P2TransportError(Exception):
+	pass
+
+##Base class of every transport
+#
+# A transport is a bidirectional byte link. P2Transport::read() never blocks
+# more than P2Transport::timeout, P2Com waits for bytes using
+# P2Transport::fileno() when it is not None.
+# @ingroup lowlevel
+class P2Transport:
+
+	##Instanciate a new P2Transport
+	#
+	# @param timeout Maximum time a read can block when there is no file descriptor to watch
+	def __init__(self, timeout = 0.01):
+		##Read timeout in seconds
+		self.timeout = timeout
+
+	##Read bytes
+	#
+	# @param size Maximum number of bytes to read
+	# @return A raw string, empty if no bytes are available
+	# @exception P2TransportError When the link is closed
+	def read(self, size):
+		raise NotImplementedError()
+
+	##Write bytes
+	#
+	# @param data A raw string
+	# @exception P2TransportError On link error
+	def write(self, data):
+		raise NotImplementedError()
+
+	##Return the number of bytes that can be read without blocking
+	def inWaiting(self):
+		raise NotImplementedError()
+
+	##Return a file descriptor that can be watched with select() or None
+	def fileno(self):
+		return None
+
+	##Close the transport
+	def close(self):
+		pass
+
+
+##Serial port transport using pyserial
+# @ingroup lowlevel
+class P2SerialTransport(P2Transport):
+
+	##Open a serial port
+	#
+	# @param portFile The serial port file name (eg : /dev/ttyS0)
+	# @param baudrate The port speed
+	# @param timeout Read timeout in seconds
+	# @exception P2TransportError If the port can not be opened
+	def __init__(self, portFile, baudrate = 9600, timeout = 0.01):
+		P2Transport.__init__(self, timeout)
+		try:
+			import serial
+		except ImportError:
+			raise P2TransportError("python-serial is needed to open serial port '"+str(portFile)+"'")
+		##The pyserial module
+		self.serial = serial
+		##The pyserial object
+		try:
+			self.ser = serial.Serial(portFile,baudrate,serial.EIGHTBITS,serial.PARITY_NONE,serial.STOPBITS_ONE,timeout)
+		except (serial.SerialException, OSError) as e:
+			raise P2TransportError("Unable to open serial port '"+str(portFile)+"' : "+str(e))
+
+	def read(self, size):
+		return self.ser.read(size)
+
+	def write(self, data):
+		try:
+			self.ser.write(data)
+		except (self.serial.SerialException, OSError) as e:
+			raise P2TransportError("Link error : "+str(e))
+
+	def inWaiting(self):
+		return self.ser.inWaiting()
+
+	def fileno(self):
+		try:
+			return self.ser.fileno()
+		except (AttributeError, ValueError, NotImplementedError, self.serial.SerialException):
+			return None
+
+	def close(self):
+		self.ser.close()
+
+
+##Transport using raw file descriptors
+#
+# Used for tty and pty, and as base class for P2MemTransport
+# @ingroup lowlevel
+class P2FdTransport(P2Transport):
+
+	##Instanciate a transport on already opened file descriptors
+	#
+	# @param rfd The file descriptor to read from
+	# @param wfd The file descriptor to write to (default is rfd)
+	def __init__(self, rfd, wfd = None):
+		P2Transport.__init__(self)
+		if wfd == None:
+			wfd = rfd
+		##Read file descriptor
+		self.rfd = rfd
+		##Write file descriptor
+		self.wfd = wfd
+		P2FdTransport.setNonBlock(rfd)
+
+	##Open a tty or a pty and set it in raw mode
+	#
+	# @param path The device file name
+	# @param baudrate The port speed (ignored for pty)
+	# @return A P2FdTransport
+	# @exception P2TransportError If the device can not be opened
+	@staticmethod
+	def open(path, baudrate = 9600):
+		try:
+			fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+		except OSError as e:
+			raise P2TransportError("Unable to open '"+path+"' : "+str(e))
+		if os.isatty(fd):
+			P2FdTransport.setRaw(fd, baudrate)
+		return P2FdTransport(fd)
+
+	##Set the O_NONBLOCK flag on a file descriptor
+	@staticmethod
+	def setNonBlock(fd):
+		import fcntl
+		flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+		fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+	##Set a tty in raw mode, 8N1
+	#
+	# @param fd The tty file descriptor
+	# @param baudrate The port speed
+	@staticmethod
+	def setRaw(fd, baudrate):
+		import tty, termios
+		tty.setraw(fd)
+		attr = termios.tcgetattr(fd)
+		speed = getattr(termios, 'B'+str(baudrate), None)
+		if speed != None:
+			attr[4] = speed
+			attr[5] = speed
+		attr[2] &= ~(termios.CSTOPB | termios.PARENB)
+		attr[2] |= termios.CLOCAL | termios.CREAD
+		termios.tcsetattr(fd, termios.TCSANOW, attr)
+
+	def read(self, size):
+		try:
+			res = os.read(self.rfd, size)
+		except OSError as e:
+			if e.errno == errno.EAGAIN or e.errno == errno.EINTR:
+				return ""
+			if e.errno == errno.EIO:
+				#pty master closed
+				raise P2TransportError("Link closed")
+			raise
+		if len(res) == 0:
+			raise P2TransportError("Link closed")
+		return res
+
+	def write(self, data):
+		while len(data) > 0:
+			try:
+				sent = os.write(self.wfd, data)
+			except OSError as e:
+				if e.errno == errno.EAGAIN or e.errno == errno.EINTR:
+					import select
+					select.select([], [self.wfd], [], 1)
+					continue
+				#EIO when a pty master is closed, EPIPE for a closed pipe
+				raise P2TransportError("Link error : "+str(e))
+			data = data[sent:]
+
+	def inWaiting(self):
+		import fcntl, termios, struct
+		buf = fcntl.ioctl(self.rfd, termios.FIONREAD, struct.pack('i', 0))
+		return struct.unpack('i', buf)[0]
+
+	def fileno(self):
+		return self.rfd
+
+	def close(self):
+		for fd in set([self.rfd, self.wfd]):
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+
+##In-memory pipe transport
+#
+# Two connected P2MemTransport are created with P2MemTransport::pair(). One
+# end can be registered with a name using P2MemTransport::listen() and then
+# opened with a "mem://name" URL. A registered end stays open when closed,
+# so it can be opened again (like a reconnected serial port), until
+# P2MemTransport::unlisten() is called.
+# @ingroup lowlevel
+class P2MemTransport(P2FdTransport):
+
+	##Registered endpoints waiting to be opened
+	endpoints = dict()
+
+	##Return two connected transports
+	#
+	# @return A tuple with two P2MemTransport
+	@staticmethod
+	def pair():
+		(r1, w1) = os.pipe()
+		(r2, w2) = os.pipe()
+		return (P2MemTransport(r1, w2), P2MemTransport(r2, w1))
+
+	##Register an endpoint that can be opened with "mem://name"
+	#
+	# @param name The endpoint name
+	# @return The other end of the pipe
+	@staticmethod
+	def listen(name):
+		(local, remote) = P2MemTransport.pair()
+		P2MemTransport.endpoints[name] = remote
+		return local
+
+	##Unregister an endpoint and close it
+	#
+	# @param name The endpoint name
+	@staticmethod
+	def unlisten(name):
+		if name in P2MemTransport.endpoints:
+			P2FdTransport.close(P2MemTransport.endpoints.pop(name))
+
+	##Open a registered endpoint
+	#
+	# The endpoint stays registered and can be opened again once closed.
+	#
+	# @param name The endpoint name
+	# @return A P2MemTransport
+	# @exception P2TransportError If no endpoint is registered with this name
+	@staticmethod
+	def connect(name):
+		if name not in P2MemTransport.endpoints:
+			raise P2TransportError("No in-memory endpoint named '"+name+"'")
+		return P2MemTransport.endpoints[name]
+
+	##Close the transport, registered endpoints are kept open
+	def close(self):
+		if self in P2MemTransport.endpoints.values():
+			return
+		P2FdTransport.close(self)
+
+
+##TCP socket transport
+#
+# Used with ser2net like bridges
+# @ingroup lowlevel
+class P2TcpTransport(P2Transport):
+
+	##Connect to a TCP bridge
+	#
+	# @param host The host name
+	# @param port The TCP port
+	# @param connTimeout Connection timeout in seconds
+	# @exception P2TransportError If the connection fails
+	def __init__(self, host, port, connTimeout = 10):
+		P2Transport.__init__(self)
+		##The socket object
+		try:
+			self.sock = socket.create_connection((host, int(port)), connTimeout)
+		except (socket.error, ValueError) as e:
+			raise P2TransportError("Unable to connect to "+str(host)+":"+str(port)+" : "+str(e))
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.sock.setblocking(0)
+
+	def read(self, size):
+		try:
+			res = self.sock.recv(size)
+		except socket.error as e:
+			if e.args[0] == errno.EAGAIN or e.args[0] == errno.EINTR:
+				return ""
+			raise P2TransportError("Link error : "+str(e))
+		if len(res) == 0:
+			raise P2TransportError("Link closed")
+		return res
+
+	def write(self, data):
+		self.sock.setblocking(1)
+		try:
+			self.sock.sendall(data)
+		except socket.error as e:
+			#EPIPE or ECONNRESET when the bridge is restarted
+			raise P2TransportError("Link error : "+str(e))
+		finally:
+			self.sock.setblocking(0)
+
+	def inWaiting(self):
+		import fcntl, termios, struct
+		buf = fcntl.ioctl(self.sock.fileno(), termios.FIONREAD, struct.pack('i', 0))
+		return struct.unpack('i', buf)[0]
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def close(self):
+		self.sock.close()
+
+
+##Open a transport given an URL-like string
+#
+# @param url The transport URL (see p2transport)
+# @return A P2Transport
+# @exception P2TransportError On invalid URL or if the link can not be opened
+def openTransport(url):
+	url = str(url)
+	if '://' not in url:
+		return P2SerialTransport(url)
+
+	(scheme, path) = url.split('://', 1)
+	if scheme == 'serial':
+		return P2SerialTransport(path)
+	elif scheme == 'tty' or scheme == 'pty':
+		return P2FdTransport.open(path)
+	elif scheme == 'tcp':
+		if ':' not in path:
+			raise P2TransportError("Waiting tcp://host:port but got '"+url+"'")
+		(host, port) = path.rsplit(':', 1)
+		return P2TcpTransport(host, port)
+	elif scheme == 'mem':
+		return P2MemTransport.connect(path)
+	else:
+		raise P2TransportError("Unknown transport '"+scheme+"' in '"+url+"'")
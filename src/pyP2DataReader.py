@@ -39,9 +39,29 @@ utils.initLogging(args['verbosity'])
 
 logger = utils.getLogger()
 
-
 if args['csvdump'] != None and args['database']:
-	p2data.csvDump(args['database'], args['csvdump'])
+	p2data.csvDump(args['database'], args['csvdump'], busyTimeout = args['busy_timeout'])
+	exit(0)
+
+if args['migrate'] and args['database']:
+	db = p2dbstore.P2DbStore(args['database'], busyTimeout = args['busy_timeout'])
+	db.migrateAll()
+	logger.info("Database schema version "+str(db.getSchemaVersion()))
+	exit(0)
+
+if args['to_blob'] and args['database']:
+	db = p2dbstore.P2DbStore(args['database'], busyTimeout = args['busy_timeout'])
+	db.convertToBlob()
+	exit(0)
+
+if args['fill_fields'] and args['database']:
+	db = p2dbstore.P2DbStore(args['database'], busyTimeout = args['busy_timeout'])
+	db.fillFields()
+	exit(0)
+
+if args['fill_rollups'] and args['database']:
+	db = p2dbstore.P2DbStore(args['database'], busyTimeout = args['busy_timeout'])
+	db.fillRollups()
 	exit(0)
 
 if args['last_data'] != None:
@@ -57,7 +77,7 @@ if 'field_list' in args and args['field_list']:
 
 if args['database']:
 	if args['query'] != None:
-		datas = p2data.P2Datas(args['database'],args['query'],args['separator'])
+		datas = p2data.P2Datas(args['database'],args['query'],args['separator'], args['busy_timeout'], args['use_rollups'])
 		
 		datas.populate()
 		
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-#
+
+# Copyright 2013, 2014 Weber Yann, Weber Laurent
+#
+# This file is part of pyP2Monitor.
+#
+#        pyP2Monitor is free software: you can redistribute it and/or modify
+#        it under the terms of the GNU General Public License as published by
+#        the Free Software Foundation, either version 3 of the License, or
+#        (at your option) any later version.
+#
+#        pyP2Monitor is distributed in the hope that it will be useful,
+#        but WITHOUT ANY WARRANTY; without even the implied warranty of
+#        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#        GNU General Public License for more details.
+#
+#        You should have received a copy of the GNU General Public License
+#        along with pyP2Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sys, os
+import signal
+
+import p2sim
+import utils
+
+sim = None
+
+##Gentle exit to manage sigint
+def gentle_exit(signal, frame):
+	sim.stop()
+
+args = utils.argParse('simulator')
+
+#Init output (logging and verbosity)
+utils.initLogging(args['verbosity'])
+
+logger = utils.getLogger()
+
+(transport, ptyName, slave) = p2sim.openPty()
+
+if args['link'] != None:
+	if os.path.islink(args['link']):
+		os.unlink(args['link'])
+	os.symlink(ptyName, args['link'])
+
+sim = p2sim.P2FurnSim(transport, args['latency'], args['split'], args['split_delay'],
+		args['corrupt'], args['dropout'], args['garbage'], args['seed'])
+
+signal.signal(signal.SIGINT, gentle_exit)
+signal.signal(signal.SIGTERM, gentle_exit)
+
+print ptyName
+sys.stdout.flush()
+
+sim.serve(args['stats_interval'])
+
+logger.info(sim.getStatsStr())
+
+if args['link'] != None:
+	os.unlink(args['link'])
+transport.close()
+os.close(slave)
@@ -20,7 +20,7 @@
 #
 
 #Python libs import
-import serial, signal, time, sys, os, traceback
+import signal, time, sys, os, traceback
 import time
 
 #pyP2Monitor import
@@ -30,14 +30,37 @@ import p2proto
 from p2proto import *
 import p2msg
 from p2msg import *
+import p2capture
+import p2stats
 import utils
 
 com = None
 pidfile= ""
+stats = p2stats.P2ComStats()
+
+##Dump communication statistics
+#
+# Used as SIGUSR2 handler, statistics (with the data request scheduler and
+# the databases lock ones) are written in the file given with --stats-file or logged
+def dump_stats(signal = None, frame = None):
+	res = stats.getStr()
+	if com != None and com.getScheduler() != None:
+		res += com.getScheduler().getStr()+"\n"
+	if com != None:
+		for (family, obj) in com.storObj:
+			if family == "sqlite":
+				res += obj.getStatsStr()+"\n"
+	if args['stats_file'] != None:
+		fd = open(args['stats_file'], "w+")
+		fd.write(res)
+		fd.close()
+	else:
+		logger.info(res)
 
 ##Gentle exit to manage sigint
 def gentle_exit(signal, frame):
 	logger.critical("signal caught, exiting")
+	dump_stats()
 	#Serial port closing
 	com.stop()
 	os.unlink(pidfile)
@@ -62,6 +85,7 @@ def start_daemon(pidfile):
 
 signal.signal(signal.SIGINT, gentle_exit)
 signal.signal(10, gentle_exit)
+signal.signal(signal.SIGUSR2, dump_stats)
 
 #Argument parse
 args = utils.argParse('monitor')
@@ -90,7 +114,10 @@ elif args['stop']: #or kill an existing daemon
 storage = []
 if args['database'] != None:
 	for c in args['database']:
-		storage.append(('sqlite',c))
+		spool = None
+		if args['spool']:
+			spool = c+'.spool'
+		storage.append(('sqlite',c,{'blob' : args['blob'], 'fields' : args['fields'], 'commitRows' : args['commit_rows'], 'commitInterval' : args['commit_interval'], 'wal' : args['wal'], 'synchronous' : args['synchronous'], 'busyTimeout' : args['busy_timeout'], 'spool' : spool, 'spoolQuota' : args['spool_quota'] * 1024 * 1024, 'partition' : args['partition'], 'rollups' : args['rollup']}))
 if args['last_data'] != None:
   #Testing if this file is openable
   lfile=open(args['last_data'], "w+")
@@ -104,8 +131,24 @@ if args['csv'] != None:
 	for c in args['csv']:
 		storage.append(('csv',c))
 
+#Checking the request schedule before opening the serial port
+try:
+	P2RequestSchedule(args['schedule'])
+except ValueError as e:
+	logger.critical("Invalid request schedule : "+str(e))
+	exit(1)
+
+#Capture replay, no serial port needed
+if args['replay'] != None:
+	p2capture.P2Replay(args['replay'], P2Furn.openStorage(storage), args['replay_speed']).run()
+	exit(0)
+
 #Serial port opening
-com = P2Furn(args['port'])
+try:
+	com = P2Furn(args['port'], args['capture'], stats)
+except p2com.P2ComError as e:
+	logger.critical("Unable to open serial port '"+args['port']+"' : "+str(e))
+	exit(1)
 
 #Running wanted stages
 for stage in args['stage']:
@@ -165,7 +208,7 @@ for stage in args['stage']:
 				again = 0
 				while again<maxretry:
 					try:
-						com.readData(float(args['data_wait']),storage)
+						com.readData(float(args['data_wait']),storage, False, args['schedule'])
 						again = maxretry+1
 					except p2com.P2ComError as e:
 						if again < maxretry:
@@ -182,7 +225,13 @@ for stage in args['stage']:
 					com.stop()
 					time.sleep(60)
 					logger.info("Opening serial port again and trying again")
-					com = P2Furn(args['port'])
+					while True:
+						try:
+							com = P2Furn(args['port'], args['capture'], stats)
+							break
+						except p2com.P2ComError as e:
+							logger.error("Opening serial port failed, waiting 60 seconds and trying again...")
+							time.sleep(60)
 			else:
 					raise e
 		except SystemExit:
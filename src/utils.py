@@ -31,16 +31,25 @@ Doxygen main page
 # @subsection mpllfc Low level furnace communication
 #
 # - @ref p2com "Serial port communication package"
+# - @ref p2frame "Incremental frame reassembly package"
+# - @ref p2transport "Serial port, pty, TCP and in-memory transports"
+# - @ref p2capture "Raw frame capture and replay"
+# - @ref p2stats "Round trip time histograms and error counters"
 #
 # @subsection mpfmp Furnace message processing
 #
 # - @ref p2msg "Raw message processing and handling package"
 # - @ref p2dbstore "Database message storage"
 # - @ref p2data "Furnace frame formating and GnuPlot generation"
+# - @ref p2schema "Data frame field schema"
+# - @ref p2spool "Durable spool for datas not yet stored"
+# - @ref p2partition "Time partitioned database files naming"
 # 
 # @subsection mpfcp Furnace communication protocol
 #
 # - @ref p2proto Furnace protocol handling package
+# - @ref p2sched Data request scheduling
+# - @ref p2sim Furnace simulator
 #
 # @section mpthanks Thanks
 #
@@ -59,8 +68,11 @@ Doxygen main page
 VERSION="pyP2Monitor v0.3.4"
 ##Stores the reader programm version
 VERSION_READER="pyP2DataReader v0.2"
+##Stores the simulator programm version
+VERSION_SIM="pyP2FurnSim v0.1"
 
 import sys
+import time
 import argparse
 import logging
 import logging.handlers
@@ -91,6 +103,8 @@ def argParse(prog="monitor", usage = False):
 	u = usage
 	if prog=="monitor":
 		return monitorArgParse(u)
+	elif prog=="simulator":
+		return simArgParse(u)
 	else:
 		return readerArgParse(u)
 
@@ -109,6 +123,8 @@ def monitorArgParse(usage = False):
 	
 	daemon_arg = parser.add_argument_group('Daemon options')
 
+	capture_arg = parser.add_argument_group('Capture options')
+
 	log_arg = parser.add_argument_group('Logging options')
 
 
@@ -116,12 +132,34 @@ def monitorArgParse(usage = False):
 						help='Display the programm version and exit')
 
 	serial_arg.add_argument('-p', '--port', action='store', type=str, default='/dev/ttyS0',
-						help='Set the serial port file wich the furnace is plugged ( exemple /dev/ttyUSB0 )')
+						help='Set the serial port file wich the furnace is plugged ( exemple /dev/ttyUSB0 ) or a transport URL : serial:///dev/ttyUSB0, tty:///dev/pts/3, tcp://host:port')
 	serial_arg.add_argument('-D', '--delay', action='store', type=int, metavar='MICROSEC',
 						help='Set the number of microseconds to wait between to send on the serial port')
 
 	data_arg.add_argument('-d', '--database', action='append', type=str, metavar='SQLITE_DB_FILE',
 						help='Tell the programm to store data in SQLITE_DB_FILE sqlite database')
+	data_arg.add_argument('--blob', action='store_const', const=True, default=False,
+						help='Store data in sqlite databases as binary blobs instead of hexadecimal text (half the size)')
+	data_arg.add_argument('--fields', action='store_const', const=True, default=False,
+						help='Also store decoded fields in typed columns of the p2fields table of sqlite databases (filtering and aggregation in sqlite)')
+	data_arg.add_argument('--rollup', action='store_const', const=True, default=False,
+						help='Maintain per minute and per hour min, max and average tables in sqlite databases (fast queries over long periods)')
+	data_arg.add_argument('--commit-rows', action='store', type=int, default=0, metavar='INTEGER',
+						help='Commit data in sqlite databases by groups of INTEGER rows (default 0 : commit each data)')
+	data_arg.add_argument('--commit-interval', action='store', type=float, default=0, metavar='SECS',
+						help='Commit data in sqlite databases at most every SECS seconds (default 0 : commit each data)')
+	data_arg.add_argument('--wal', action='store_const', const=True, default=False,
+						help='Set the journal mode of sqlite databases to WAL (write ahead log)')
+	data_arg.add_argument('--synchronous', action='store', choices=['off', 'normal', 'full'], default=None,
+						help='Set the synchronous pragma of sqlite databases (normal is safe with --wal and syncs less often)')
+	data_arg.add_argument('--busy-timeout', action='store', type=float, default=1, metavar='SECS',
+						help='Time waited for a locked sqlite database before delaying a commit (default 1)')
+	data_arg.add_argument('--partition', action='store', choices=['day', 'month', 'year'], default=None,
+						help='Store data of each period in its own sqlite database file, named after the database file (eg : p2-2014-10.db). Datas are read from the partitions by the reader')
+	data_arg.add_argument('--spool', action='store_const', const=True, default=False,
+						help='Save data that can not be commited in a locked sqlite database in a spool file (the database file name followed by .spool), they are inserted later')
+	data_arg.add_argument('--spool-quota', action='store', type=int, default=64, metavar='MB',
+						help='Spool file size limit in megabytes, data are lost when reached (default 64)')
 	data_arg.add_argument('-l', '--last-data', action='store', type=str, metavar='FILENAME',
 						help='Tell the programm to store the latest readed data in FILENAME (used with -L option of the reader)')
 	data_arg.add_argument('-c', '--csv', action='append', type=str, metavar='CSV_FILE',
@@ -132,6 +170,8 @@ def monitorArgParse(usage = False):
 							help='Print received data on stdout')
 	data_arg.add_argument('-w', '--data-wait', action='store', type=float, default=1, metavar='SECS',
 						help='Time to wait between two data request')
+	data_arg.add_argument('-S', '--schedule', action='store', type=str, default="m1=1,m2=60s", metavar='SCHEDULE',
+						help='Data request schedule as a list of request=cadence, cadence being a number of requests slots or a time interval with s, m or h suffix (default is "m1=1,m2=60s" : M1 on each slot and one M2 per minute)')
 						
 	run_arg.add_argument('-t', '--max-time', action='store', type=int, metavar='SECS',
 						help='Tell the programm to stop after SECS seconds')
@@ -150,6 +190,13 @@ def monitorArgParse(usage = False):
 						help='Pidfile name (used with -B or -K)')
 
 
+	capture_arg.add_argument('--capture', action='store', type=str, default=None, metavar='CAPTURE_FILE',
+						help='Record every sent and received frame in CAPTURE_FILE')
+	capture_arg.add_argument('--replay', action='store', type=str, default=None, metavar='CAPTURE_FILE',
+						help='Do not open the serial port, replay CAPTURE_FILE frames through the data storages then exit')
+	capture_arg.add_argument('--replay-speed', action='store', type=float, default=0, metavar='FACTOR',
+						help='Replay speed relative to real time (default is 0, as fast as possible)')
+
 	log_arg.add_argument('--verbosity', action='store', choices=[ 'critical', 'error', 'warn', 'info', 'debug', 'silent'], default='error',
 						help='Set the log level for console output')
 	log_arg.add_argument('-q', '--quiet', '--silent', action='store_const', const=True, default=False,
@@ -162,6 +209,8 @@ def monitorArgParse(usage = False):
 						help='Set the maximum size for a logfile before rotating to another logfile')
 	log_arg.add_argument('--log-num', action='store', type=int, default=5, metavar='INTEGER',
 						help='Set the number of logfile to keep')
+	log_arg.add_argument('--stats-file', action='store', type=str, default=None, metavar='FILENAME',
+						help='Write communication statistics (round trip times and errors) in FILENAME on SIGUSR2 and on exit, instead of logging them')
 			
 	if usage:
 		parser.print_usage(sys.stderr)
@@ -202,6 +251,18 @@ def readerArgParse(usage = False):
 			help='One or more characters used as argument separator in a query (default is ",")')
 	db_arg.add_argument('--field-list', action='store_const', const=True, default=False,
 			help='List data fields and them numbers. Then exit.');
+	db_arg.add_argument('--busy-timeout', action='store', type=float, default=5, metavar='SECS',
+			help='Time waited for a locked database before retrying (default 5)');
+	db_arg.add_argument('--migrate', action='store_const', const=True, default=False,
+			help='Run the pending database schema migrations until the end. Then exit.');
+	db_arg.add_argument('--to-blob', action='store_const', const=True, default=False,
+			help='Convert the hexadecimal text data of the database to binary blobs. Then exit.');
+	db_arg.add_argument('--fill-fields', action='store_const', const=True, default=False,
+			help='Create and fill the p2fields table with the decoded fields of the stored data. Then exit.');
+	db_arg.add_argument('--fill-rollups', action='store_const', const=True, default=False,
+			help='Create and fill the per minute and per hour rollup tables with the stored data. Then exit.');
+	db_arg.add_argument('--use-rollups', action='store_const', const=True, default=False,
+			help='Read queries without group over more than 1000 data from the rollup tables : a value is then the average of a minute or an hour.');
 
 	out_arg.add_argument('-o', '--output', action='store', type=str, default='out', metavar='FILENAME',
 			help='Output file')
@@ -248,6 +309,48 @@ def readerArgParse(usage = False):
 
 
 
+## Use argParse to parse command line options for the simulator programm
+# 
+# @return A dict with options value
+def simArgParse(usage = False):
+	parser = argparse.ArgumentParser(prog="pyP2FurnSim",description=VERSION_SIM+' : Simulate a P2 Furnace on a pseudo terminal.',
+			epilog='pyP2FurnSim is part of pyP2Monitor wich is is under GNU GPL')
+
+	fault_arg = parser.add_argument_group('Fault injection options')
+
+	out_arg = parser.add_argument_group('Output options')
+
+	parser.add_argument('-L', '--link', action='store', type=str, default=None, metavar='FILENAME',
+			help='Create a symbolic link named FILENAME to the pseudo terminal')
+	parser.add_argument('--seed', action='store', type=int, default=None, metavar='INTEGER',
+			help='Random generator seed')
+
+	fault_arg.add_argument('-l', '--latency', action='store', type=float, default=0.0, metavar='SECS',
+			help='Time to wait before sending a reply')
+	fault_arg.add_argument('-s', '--split', action='store', type=int, default=0, metavar='BYTES',
+			help='Send replies by chunks of BYTES bytes')
+	fault_arg.add_argument('--split-delay', action='store', type=float, default=0.002, metavar='SECS',
+			help='Time to wait between two chunks (default is 0.002)')
+	fault_arg.add_argument('-c', '--corrupt', action='store', type=float, default=0.0, metavar='RATE',
+			help='Probability of a corrupted checksum in a reply (between 0 and 1)')
+	fault_arg.add_argument('-D', '--dropout', action='store', type=float, default=0.0, metavar='RATE',
+			help='Probability of not replying to a request (between 0 and 1)')
+	fault_arg.add_argument('-g', '--garbage', action='store', type=float, default=0.0, metavar='RATE',
+			help='Probability of sending garbage bytes before a reply (between 0 and 1)')
+
+	out_arg.add_argument('-S', '--stats-interval', action='store', type=float, default=10, metavar='SECS',
+			help='Time between two statistics log (0 to disable)')
+	out_arg.add_argument('--verbosity', action='store', choices=[ 'critical', 'error', 'warn', 'info', 'debug', 'silent'], default='info',
+			help='Set the log level for console output')
+
+	if usage:
+		parser.print_usage(sys.stderr)
+		exit(1)
+
+	args = parser.parse_args()
+
+	return vars(args)
+
 ##Function used to initialise the logger
 #
 # Use logging package
@@ -305,6 +408,42 @@ def getLogLevelConst(strlvl):
 		return res
 
 
+##Return a monotonic clock value in seconds
+#
+# Use time.monotonic() when available, else clock_gettime(CLOCK_MONOTONIC)
+# through ctypes. If none is available fall back to time.time()
+#
+#@return A float
+def monotonic():
+	return _monotonic()
+
+def _initMonotonic():
+	if hasattr(time, 'monotonic'):
+		return time.monotonic
+	try:
+		import ctypes, ctypes.util, os
+
+		class timespec(ctypes.Structure):
+			_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+		librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+		clock_gettime = librt.clock_gettime
+		clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+		ts = timespec()
+		CLOCK_MONOTONIC = 1
+
+		def mono():
+			if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(ts)) != 0:
+				errno = ctypes.get_errno()
+				raise OSError(errno, os.strerror(errno))
+			return ts.tv_sec + ts.tv_nsec * 1e-9
+		mono()
+		return mono
+	except (OSError, AttributeError, TypeError):
+		return time.time
+
+_monotonic = _initMonotonic()
+
 ##Return the logger used in the whole application
 def getLogger():
 	return logging.getLogger('pyP2Monitor')